@@ -0,0 +1,13 @@
+""" Benchmarks of songbird's preprocessing, training and output stages.
+
+The benchmarks run on synthetic tables from
+`songbird.simulate.random_sparse_model`, over grids of the number of
+samples, features, covariates and the sparsity of the table. Run them
+from the root of the repository with
+
+    python -m benchmarks run --grid quick --output before.json
+
+and compare two runs with
+
+    python -m benchmarks compare before.json after.json
+"""
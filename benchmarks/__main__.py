@@ -0,0 +1,82 @@
+import sys
+import tempfile
+import click
+from songbird.util import limit_threads
+from benchmarks.suite import GRIDS, BENCHMARKS, grid_datasets, run_dataset
+from benchmarks.results import run_metadata, save, load, compare
+
+
+@click.group()
+def benchmarks():
+    pass
+
+
+@benchmarks.command()
+@click.option('--grid', type=click.Choice(sorted(GRIDS)), default='quick',
+              show_default=True,
+              help='Grid of dataset sizes to run the benchmarks on.')
+@click.option('--benchmark', 'names', multiple=True,
+              type=click.Choice(BENCHMARKS),
+              help='Benchmark to run, may be repeated. Runs all of the '
+                   'benchmarks by default.')
+@click.option('--backend', 'backends', multiple=True,
+              type=click.Choice(['numpy', 'tensorflow']),
+              default=['numpy'], show_default=True,
+              help='Backend whose models are built and trained, may be '
+                   'repeated.')
+@click.option('--repeat', default=3, show_default=True,
+              help='Number of times each benchmark is timed.')
+@click.option('--epochs', default=1, show_default=True,
+              help='Number of epochs trained in the train benchmark.')
+@click.option('--batch-size', default=5, show_default=True,
+              help='Number of samples per minibatch.')
+@click.option('--threads', default=None, type=int,
+              help='Number of threads used by the linear algebra '
+                   'libraries. Uses all of the cores by default.')
+@click.option('--seed', default=0, show_default=True,
+              help='Random seed of the simulated datasets.')
+@click.option('--output', default='benchmark-results.json',
+              show_default=True,
+              help='Json file the results are written to.')
+def run(grid, names, backends, repeat, epochs, batch_size, threads, seed,
+        output):
+    limit_threads(threads)
+    names = names or BENCHMARKS
+    results = []
+    for params in grid_datasets(GRIDS[grid]):
+        click.echo('Running %s' % ', '.join(
+            '%s=%s' % item for item in params.items()), err=True)
+        with tempfile.TemporaryDirectory() as workdir:
+            results += run_dataset(params, workdir, names, backends,
+                                   repeat=repeat, epochs=epochs,
+                                   batch_size=batch_size, seed=seed)
+    metadata = run_metadata(grid=grid, backends=list(backends),
+                            repeat=repeat, epochs=epochs,
+                            batch_size=batch_size, threads=threads,
+                            seed=seed)
+    save(output, metadata, results)
+    for res in results:
+        if 'error' in res:
+            click.echo('%s failed on %s: %s' % (res['benchmark'],
+                                                res['params'], res['error']),
+                       err=True)
+
+
+@benchmarks.command(name='compare')
+@click.argument('old', type=click.Path(exists=True, dir_okay=False))
+@click.argument('new', type=click.Path(exists=True, dir_okay=False))
+@click.option('--threshold', default=1.1, show_default=True,
+              help='Ratio of the median times above which a benchmark is '
+                   'reported as a regression.')
+def compare_runs(old, new, threshold):
+    table = compare(load(old), load(new), threshold)
+    if len(table) == 0:
+        click.echo('No benchmarks in common.')
+        return
+    click.echo(table.to_string(index=False))
+    if (table['change'] == 'regressed').any():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    benchmarks()
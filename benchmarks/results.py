@@ -0,0 +1,127 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+import numpy as np
+import songbird
+
+
+# packages whose versions are recorded with every run
+PACKAGES = ('numpy', 'scipy', 'pandas', 'biom', 'tensorflow')
+
+
+def _git_commit():
+    """ Returns the commit of the songbird checkout, if there is one. """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root,
+                                      stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode().strip()
+
+
+def _package_versions():
+    versions = {}
+    for name in PACKAGES:
+        try:
+            module = __import__(name)
+        except ImportError:
+            versions[name] = None
+            continue
+        versions[name] = getattr(module, '__version__', None)
+    return versions
+
+
+def run_metadata(**options):
+    """ Describes the machine and the code a run was made with.
+
+    Parameters
+    ----------
+    **options
+        Options the benchmarks were run with.
+
+    Returns
+    -------
+    dict
+        The songbird version and commit, the versions of its dependencies,
+        the python version, platform and cpu count, the time of the run,
+        and `options`.
+    """
+    return {
+        'songbird': songbird.__version__,
+        'commit': _git_commit(),
+        'packages': _package_versions(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'options': options,
+    }
+
+
+def save(path, metadata, results):
+    """ Writes the results of a run to a json file. """
+    with open(path, 'w') as f:
+        json.dump({'metadata': metadata, 'results': results}, f, indent=2,
+                  sort_keys=True)
+
+
+def load(path):
+    """ Reads the results of a run written by `save`. """
+    with open(path) as f:
+        return json.load(f)
+
+
+def _key(result):
+    return (result['benchmark'],
+            tuple(sorted(result['params'].items())))
+
+
+def compare(old, new, threshold=1.1):
+    """ Compares the median times of two runs.
+
+    Parameters
+    ----------
+    old, new : dict
+        Runs, as returned by `load`.
+    threshold : float
+        Ratio of the new to the old median time above which a benchmark
+        is reported as a regression, and below whose inverse it is
+        reported as an improvement.
+
+    Returns
+    -------
+    pd.DataFrame
+        The old and new median times of the benchmarks found in both runs,
+        their ratio, and whether they 'regressed', 'improved' or are
+        'unchanged'. Benchmarks that failed in either run are 'failed'.
+    """
+    import pandas as pd
+
+    if threshold < 1:
+        raise ValueError('`threshold` must be at least 1, got %r'
+                         % threshold)
+    old_results = {_key(res): res for res in old['results']}
+    rows = []
+    for res in new['results']:
+        key = _key(res)
+        if key not in old_results:
+            continue
+        before, after = old_results[key].get('median'), res.get('median')
+        row = dict(benchmark=res['benchmark'], **res['params'])
+        if before is None or after is None:
+            row.update(old=before, new=after, ratio=np.nan, change='failed')
+        else:
+            ratio = after / before if before > 0 else np.inf
+            if ratio > threshold:
+                change = 'regressed'
+            elif ratio < 1 / threshold:
+                change = 'improved'
+            else:
+                change = 'unchanged'
+            row.update(old=before, new=after, ratio=ratio, change=change)
+        rows.append(row)
+    return pd.DataFrame(rows)
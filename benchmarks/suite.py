@@ -0,0 +1,261 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from songbird.simulate import random_sparse_model
+from songbird.util import (read_metadata, match_and_filter, split_training,
+                           regression_biplot, convergence_table)
+
+
+# parameters of the synthetic datasets, in the order they are reported
+DATA_PARAMETERS = ('num_samples', 'num_features', 'num_covariates',
+                   'sparsity')
+
+# every grid varies one parameter at a time around its base dataset
+GRIDS = {
+    'quick': {
+        'base': dict(num_samples=100, num_features=50, num_covariates=2,
+                     sparsity=0.5),
+        'num_samples': [100, 500],
+        'num_features': [50, 200],
+        'num_covariates': [2, 5],
+        'sparsity': [0., 0.9],
+    },
+    'default': {
+        'base': dict(num_samples=1000, num_features=500, num_covariates=2,
+                     sparsity=0.5),
+        'num_samples': [100, 1000, 5000],
+        'num_features': [100, 500, 2000],
+        'num_covariates': [2, 10, 50],
+        'sparsity': [0., 0.5, 0.9],
+    },
+}
+
+# stages that are timed for every dataset
+BENCHMARKS = ('read_metadata', 'match_and_filter', 'densify', 'to_csr',
+              'build', 'train', 'biplot', 'write')
+
+
+def grid_datasets(grid):
+    """ Lists the datasets of a grid.
+
+    Parameters
+    ----------
+    grid : dict
+        The 'base' dataset, and the values to try for each of the
+        parameters in `DATA_PARAMETERS`.
+
+    Returns
+    -------
+    list of dict
+        The base dataset, followed by the datasets that differ from it in
+        a single parameter.
+    """
+    datasets = [dict(grid['base'])]
+    for name in DATA_PARAMETERS:
+        for value in grid.get(name, []):
+            params = dict(grid['base'], **{name: value})
+            if params not in datasets:
+                datasets.append(params)
+    return datasets
+
+
+def make_dataset(num_samples, num_features, num_covariates, sparsity,
+                 seed=0):
+    """ Simulates a table and the metadata of its samples.
+
+    Parameters
+    ----------
+    num_samples : int
+        Number of samples.
+    num_features : int
+        Number of features.
+    num_covariates : int
+        Number of columns of the design matrix, including the intercept.
+    sparsity : float
+        Probability that a feature is absent from a sample.
+    seed : int
+        Random seed.
+
+    Returns
+    -------
+    table : biom.Table
+        Counts of the features in each sample.
+    metadata : pd.DataFrame
+        Covariates of each sample.
+    formula : str
+        Formula whose design matrix has `num_covariates` columns.
+    """
+    table, metadata, _ = random_sparse_model(
+        num_samples, num_features, num_covariates - 1,
+        depth=10 * num_features, sparsity=sparsity, seed=seed)
+    formula = ' + '.join(metadata.columns) or '1'
+    return table, metadata, formula
+
+
+def _timeit(func, repeat, setup=None):
+    """ Times a function, which is passed the output of `setup`. """
+    times = []
+    for _ in range(repeat):
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _result(name, params, times=None, **extra):
+    """ Summarizes the times of a benchmark. """
+    res = {'benchmark': name, 'params': dict(params)}
+    if times is not None:
+        res.update(times=times, min=min(times),
+                   median=float(np.median(times)), unit='seconds')
+    res.update(extra)
+    return res
+
+
+class _Dataset(object):
+
+    def __init__(self, params, workdir, seed=0):
+        """ A simulated dataset, with the data each stage starts from. """
+        self.params = params
+        self.workdir = workdir
+        self.table, self.metadata, self.formula = make_dataset(
+            seed=seed, **params)
+        self.metadata_file = os.path.join(workdir, 'metadata.txt')
+        self.metadata.to_csv(self.metadata_file, sep='\t')
+
+        table, metadata, design = match_and_filter(
+            self.table, self.metadata, self.formula, 0, 0)
+        self.trainX, self.testX, self.trainY, self.testY = split_training(
+            table.matrix_data.T.tocsr(), metadata, design, None,
+            max(10, params['num_samples'] // 10), seed=seed)
+        self.md_ids = np.array(design.columns)
+        self.obs_ids = table.ids(axis='observation')
+
+
+def _model(backend, batch_size):
+    """ Builds a model, without writing any summaries. """
+    if backend == 'numpy':
+        from songbird.numpy_backend import NumpyMultRegression
+        return NumpyMultRegression(batch_size=batch_size, save_path=None,
+                                   random_state=0)
+    from songbird.multinomial import MultRegression
+    return MultRegression(batch_size=batch_size, save_path=None)
+
+
+def _time_model(data, backend, repeat, batch_size, epochs=None):
+    """ Times building a model, or training it for `epochs` if given. """
+    def fit(model):
+        model.fit(epochs=epochs, summary_interval=np.inf,
+                  checkpoint_interval=None, silent=True)
+
+    if backend == 'numpy':
+        def build():
+            model = _model(backend, batch_size)
+            model(None, data.trainX, data.trainY, data.testX, data.testY)
+            return model
+        if epochs is None:
+            return _timeit(build, repeat)
+        return _timeit(fit, repeat, setup=build)
+
+    import tensorflow as tf
+    times = []
+    for _ in range(repeat):
+        with tf.Graph().as_default(), tf.Session() as session:
+            tf.set_random_seed(0)
+            model = _model(backend, batch_size)
+            start = time.perf_counter()
+            model(session, data.trainX, data.trainY, data.testX, data.testY)
+            if epochs is not None:
+                start = time.perf_counter()
+                fit(model)
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def run_dataset(params, workdir, benchmarks=BENCHMARKS,
+                backends=('numpy',), repeat=3, epochs=1, batch_size=5,
+                seed=0):
+    """ Runs the benchmarks on a simulated dataset.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters of the dataset, see `make_dataset`.
+    workdir : str
+        Empty directory that files are written to.
+    benchmarks : list of str
+        Stages to time, a subset of `BENCHMARKS`.
+    backends : list of str
+        Backends whose models are built and trained, 'numpy' or
+        'tensorflow'.
+    repeat : int
+        Number of times each stage is timed.
+    epochs : int
+        Number of epochs trained in the 'train' benchmark.
+    batch_size : int
+        Number of samples per minibatch.
+    seed : int
+        Random seed of the dataset.
+
+    Returns
+    -------
+    list of dict
+        One result per stage and backend, holding the 'benchmark' name,
+        the 'params' of the dataset, and either the 'times' of each repeat
+        with their 'min' and 'median', or the 'error' the stage raised.
+    """
+    data = _Dataset(params, workdir, seed)
+    table, metadata = data.table, data.metadata
+    steps = (data.trainX.shape[0] // batch_size) * epochs
+    differentials = pd.DataFrame(
+        np.random.RandomState(seed).normal(
+            size=(len(data.obs_ids), len(data.md_ids))),
+        index=data.obs_ids, columns=data.md_ids)
+    stats = convergence_table(np.zeros(100), np.zeros(100), np.arange(100))
+
+    def write():
+        differentials.to_csv(os.path.join(workdir, 'differentials.tsv'),
+                             sep='\t')
+        stats.to_csv(os.path.join(workdir, 'convergence_stats.tsv'),
+                     sep='\t')
+
+    stages = {
+        'read_metadata': lambda: read_metadata(data.metadata_file),
+        'match_and_filter': lambda: match_and_filter(
+            table, metadata, data.formula, 0, 0),
+        'densify': lambda: table.to_dataframe().to_dense().T,
+        'to_csr': lambda: table.matrix_data.T.tocsr(),
+        'biplot': lambda: regression_biplot(differentials),
+        'write': write,
+    }
+
+    results = []
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            raise ValueError("Unknown benchmark %r, expected one of %s"
+                             % (name, list(BENCHMARKS)))
+        if name in stages:
+            runs = [(params, lambda: _timeit(stages[name], repeat))]
+        else:
+            runs = [(dict(params, backend=backend),
+                     lambda backend=backend: _time_model(
+                         data, backend, repeat, batch_size,
+                         epochs if name == 'train' else None))
+                    for backend in backends]
+        for run_params, run in runs:
+            try:
+                times = run()
+            except Exception as e:
+                results.append(_result(name, run_params,
+                                       error='%s: %s' % (type(e).__name__,
+                                                         e)))
+                continue
+            extra = {}
+            if name == 'train':
+                median = float(np.median(times))
+                extra = dict(steps=steps, steps_per_second=steps / median,
+                             samples_per_second=steps * batch_size / median)
+            results.append(_result(name, run_params, times, **extra))
+    return results
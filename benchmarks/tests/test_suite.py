@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+from click.testing import CliRunner
+from benchmarks.__main__ import benchmarks
+from benchmarks.results import load, compare
+from benchmarks.suite import (GRIDS, BENCHMARKS, grid_datasets,
+                              make_dataset, run_dataset)
+
+
+class TestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.params = dict(num_samples=30, num_features=10,
+                           num_covariates=4, sparsity=0.5)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_grid_datasets(self):
+        datasets = grid_datasets(GRIDS['quick'])
+        self.assertEqual(datasets[0], GRIDS['quick']['base'])
+        self.assertEqual(len(datasets), 6)
+        for params in datasets[1:]:
+            diff = [k for k, v in params.items()
+                    if v != GRIDS['quick']['base'][k]]
+            self.assertEqual(len(diff), 1)
+
+    def test_make_dataset(self):
+        table, md, formula = make_dataset(**self.params)
+        self.assertEqual(table.shape, (10, 30))
+        self.assertEqual(formula, 'X1 + X2 + X3')
+        self.assertEqual(list(md.columns), ['X1', 'X2', 'X3'])
+        self.assertLessEqual(table.nnz, 0.7 * 10 * 30)
+
+    def test_run_dataset(self):
+        res = run_dataset(self.params, self.tmpdir, repeat=2)
+        self.assertEqual([r['benchmark'] for r in res], list(BENCHMARKS))
+        for r in res:
+            self.assertTrue('error' in r or len(r['times']) == 2)
+        train = res[BENCHMARKS.index('train')]
+        self.assertEqual(train['params']['backend'], 'numpy')
+        self.assertEqual(train['steps'], 4)
+        self.assertGreater(train['steps_per_second'], 0)
+
+        with self.assertRaises(ValueError):
+            run_dataset(self.params, self.tmpdir, ['fit'])
+
+    def test_cli(self):
+        before = os.path.join(self.tmpdir, 'before.json')
+        after = os.path.join(self.tmpdir, 'after.json')
+        runner = CliRunner()
+        for path in [before, after]:
+            result = runner.invoke(benchmarks, [
+                'run', '--grid', 'quick', '--repeat', '1',
+                '--benchmark', 'to_csr', '--benchmark', 'biplot',
+                '--output', path])
+            self.assertEqual(result.exit_code, 0, result.output)
+        run = load(before)
+        self.assertEqual(run['metadata']['options']['grid'], 'quick')
+        self.assertEqual(len(run['results']), 2 * 6)
+
+        table = compare(load(before), load(after), threshold=1.5)
+        self.assertEqual(len(table), 12)
+        self.assertTrue(set(table['change']) <=
+                        {'regressed', 'improved', 'unchanged'})
+        with self.assertRaises(ValueError):
+            compare(run, run, threshold=0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
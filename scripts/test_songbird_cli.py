@@ -1,8 +1,10 @@
+import os
 import unittest
 import types
 from importlib.machinery import SourceFileLoader
 from click.testing import CliRunner
 import shutil
+import pandas as pd
 import pkg_resources
 
 # _Black magic from the stack overflow gods_:
@@ -120,6 +122,115 @@ class TestSongbirdCLI(unittest.TestCase):
             error = Exception('Command failed with non-zero exit code')
             raise error .with_traceback(ex.__traceback__)
 
+    def test_cli_numpy_backend(self):
+        runner = CliRunner()
+        test_args = ['--input-biom', 'data/redsea/redsea.biom',
+                     '--metadata-file', 'data/redsea/redsea_metadata.txt',
+                     '--formula',
+                     'Depth+Temperature+Salinity+Oxygen+Fluorescence'
+                     '+Nitrate',
+                     '--epochs', '100',
+                     '--differential-prior', '0.5',
+                     '--summary-interval', '1',
+                     '--summary-dir', self.path,
+                     '--backend', 'numpy',
+                     '--silent']
+
+        result = runner.invoke(songbird.multinomial, test_args)
+        try:
+            self.assertEqual(0, result.exit_code)
+        except AssertionError:
+            ex = result.exception
+            error = Exception('Command failed with non-zero exit code')
+            raise error .with_traceback(ex.__traceback__)
+        self.assertTrue(
+            os.path.exists(os.path.join(self.path, 'differentials.tsv')))
+        self.assertTrue(
+            os.path.exists(os.path.join(self.path, 'convergence_stats.tsv')))
+
+    def test_cli_intercept(self):
+        runner = CliRunner()
+        test_args = ['--input-biom', 'data/redsea/redsea.biom',
+                     '--metadata-file', 'data/redsea/redsea_metadata.txt',
+                     '--formula', '1',
+                     '--summary-dir', self.path,
+                     '--silent']
+
+        result = runner.invoke(songbird.multinomial, test_args)
+        try:
+            self.assertEqual(0, result.exit_code)
+        except AssertionError:
+            ex = result.exception
+            error = Exception('Command failed with non-zero exit code')
+            raise error .with_traceback(ex.__traceback__)
+        stats = pd.read_csv(
+            os.path.join(self.path, 'convergence_stats.tsv'), sep='\t')
+        self.assertGreater(len(stats.index), 1)
+        self.assertTrue((stats['stop-reason'] == 'intercept-only').all())
+
+    def test_cli_resume(self):
+        runner = CliRunner()
+        test_args = ['--input-biom', 'data/redsea/redsea.biom',
+                     '--metadata-file', 'data/redsea/redsea_metadata.txt',
+                     '--formula', 'Depth+Temperature',
+                     '--summary-interval', '1',
+                     '--summary-dir', self.path,
+                     '--backend', 'numpy',
+                     '--silent']
+
+        result = runner.invoke(songbird.multinomial,
+                               test_args + ['--epochs', '10'])
+        self.assertEqual(0, result.exit_code)
+        first = pd.read_csv(
+            os.path.join(self.path, 'convergence_stats.tsv'), sep='\t')
+
+        result = runner.invoke(songbird.multinomial,
+                               test_args + ['--epochs', '20', '--resume'])
+        try:
+            self.assertEqual(0, result.exit_code)
+        except AssertionError:
+            ex = result.exception
+            error = Exception('Command failed with non-zero exit code')
+            raise error .with_traceback(ex.__traceback__)
+        second = pd.read_csv(
+            os.path.join(self.path, 'convergence_stats.tsv'), sep='\t')
+        self.assertGreater(second['iteration'].iloc[0],
+                           first['iteration'].iloc[-1])
+
+    def test_cli_sweep(self):
+        runner = CliRunner()
+        test_args = ['--input-biom', 'data/redsea/redsea.biom',
+                     '--metadata-file', 'data/redsea/redsea_metadata.txt',
+                     '--formula', 'Depth+Temperature',
+                     '--epochs', '10',
+                     '--differential-prior', '0.5',
+                     '--differential-prior', '1',
+                     '--learning-rate', '0.01',
+                     '--summary-interval', '1',
+                     '--sweep-dir', self.path,
+                     '--backend', 'numpy',
+                     '--processes', '2',
+                     '--threads', '1',
+                     '--sparse',
+                     '--silent']
+
+        result = runner.invoke(songbird.sweep, test_args)
+        try:
+            self.assertEqual(0, result.exit_code)
+        except AssertionError:
+            ex = result.exception
+            error = Exception('Command failed with non-zero exit code')
+            raise error .with_traceback(ex.__traceback__)
+        summary = pd.read_csv(os.path.join(self.path, 'sweep_summary.tsv'),
+                              sep='\t', index_col=0)
+        self.assertEqual(sorted(summary.index), ['config0', 'config1'])
+        self.assertEqual(list(summary['rank']), [1, 2])
+        for name in summary.index:
+            self.assertTrue(os.path.exists(
+                os.path.join(self.path, name, 'differentials.tsv')))
+            self.assertTrue(os.path.exists(
+                os.path.join(self.path, name, 'convergence_stats.tsv')))
+
 
 if __name__ == '__main__':
     unittest.main()
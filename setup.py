@@ -50,7 +50,7 @@ setup(name='songbird',
       author_email="jamietmorton@gmail.com",
       maintainer="gneiss development team",
       maintainer_email="jamietmorton@gmail.com",
-      packages=find_packages(),
+      packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
       scripts=glob('scripts/songbird'),
       setup_requires=['numpy >= 1.9.2'],
       install_requires=[
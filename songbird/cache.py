@@ -0,0 +1,214 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, issparse
+
+
+# bump this whenever the layout of the cached files changes
+_CACHE_VERSION = 3
+
+
+def file_digest(filepath, block_size=2 ** 20):
+    """ Computes the SHA-256 digest of a file's contents.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the file.
+    block_size : int
+        Number of bytes read at a time.
+
+    Returns
+    -------
+    str
+        Hexadecimal digest.
+    """
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def table_digest(table):
+    """ Computes the SHA-256 digest of a biom table's contents.
+
+    Parameters
+    ----------
+    table : biom.Table
+        Table of abundances
+
+    Returns
+    -------
+    str
+        Hexadecimal digest.
+    """
+    h = hashlib.sha256()
+    mat = table.matrix_data.tocsr()
+    for arr in (mat.data, mat.indices, mat.indptr):
+        h.update(np.ascontiguousarray(arr).tobytes())
+    for axis in ('observation', 'sample'):
+        h.update('\t'.join(table.ids(axis=axis)).encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+
+def metadata_digest(metadata):
+    """ Computes the SHA-256 digest of a metadata table's contents.
+
+    Parameters
+    ----------
+    metadata : pd.DataFrame
+        Sample metadata
+
+    Returns
+    -------
+    str
+        Hexadecimal digest.
+    """
+    h = hashlib.sha256()
+    h.update('\t'.join(map(str, metadata.columns)).encode('utf-8'))
+    h.update(pd.util.hash_pandas_object(metadata, index=True).values)
+    return h.hexdigest()
+
+
+def cache_path(cache_dir, **params):
+    """ Location of the cached preprocessing results for a set of inputs.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding the cache.
+    params : dict
+        Everything that determines the preprocessing results, i.e. the
+        digests of the inputs, the formula, the filters and how the
+        samples are split. Values must be serializable to JSON.
+
+    Returns
+    -------
+    str
+        Path of the cache entry, which may not exist yet.
+    """
+    params = dict(params, version=_CACHE_VERSION)
+    key = json.dumps(params, sort_keys=True)
+    name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, name)
+
+
+def save_preprocessed(path, trainX, testX, trainY, testY, md_ids, obs_ids,
+                      levels=None):
+    """ Stores preprocessed training data in the cache.
+
+    The arrays are written as individual `.npy` files into a directory,
+    which is moved into place once complete so that concurrent runs never
+    see a partial entry.
+
+    Parameters
+    ----------
+    path : str
+        Path of the cache entry, as returned by `cache_path`.
+    trainX, testX : np.array or scipy.sparse.spmatrix
+        Training and testing design matrices. These are stored sparse if
+        they are sparse.
+    trainY, testY : np.array or scipy.sparse.spmatrix
+        Training and testing count tables. These are stored sparse.
+    md_ids : array_like of str
+        Names of the columns of the design matrix.
+    obs_ids : array_like of str
+        Names of the features.
+    levels : dict of list
+        Levels of the categorical covariates of the formula, as returned
+        by `songbird.util.design_levels`.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent)
+    arrays = {'md_ids': np.asarray(md_ids, dtype=str),
+              'obs_ids': np.asarray(obs_ids, dtype=str)}
+    for name, X in (('trainX', trainX), ('testX', testX)):
+        if issparse(X):
+            arrays.update(_csr_arrays(name, X))
+        else:
+            arrays[name] = X
+    for name, Y in (('trainY', trainY), ('testY', testY)):
+        arrays.update(_csr_arrays(name, Y))
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmp, name + '.npy'), np.asarray(arr))
+    with open(os.path.join(tmp, 'levels.json'), 'w') as f:
+        json.dump(levels, f)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # another run stored the same entry first
+        shutil.rmtree(tmp)
+
+
+def load_preprocessed(path, sparse=False):
+    """ Loads preprocessed training data from the cache.
+
+    Parameters
+    ----------
+    path : str
+        Path of the cache entry, as returned by `cache_path`.
+    sparse : bool
+        Whether to return the count tables as sparse matrices.
+
+    Returns
+    -------
+    trainX, testX : np.array or scipy.sparse.csr_matrix
+        Training and testing design matrices, which are sparse if they
+        were stored sparse.
+    trainY, testY : np.array or scipy.sparse.csr_matrix
+        Training and testing count tables.
+    md_ids : np.array
+        Names of the columns of the design matrix.
+    obs_ids : np.array
+        Names of the features.
+    levels : dict of list
+        Levels of the categorical covariates, or None if they weren't
+        stored.
+    """
+    def load(name, mmap_mode='r'):
+        return np.load(os.path.join(path, name + '.npy'),
+                       mmap_mode=mmap_mode)
+
+    def load_csr(name):
+        return csr_matrix((load(name + '_data'), load(name + '_indices'),
+                           load(name + '_indptr')),
+                          shape=tuple(load(name + '_shape', None)))
+
+    designs = []
+    for name in ('trainX', 'testX'):
+        if os.path.exists(os.path.join(path, name + '_data.npy')):
+            designs.append(load_csr(name))
+        else:
+            designs.append(np.asarray(load(name)))
+    trainX, testX = designs
+
+    tables = []
+    for name in ('trainY', 'testY'):
+        Y = load_csr(name)
+        tables.append(Y if sparse else Y.toarray())
+    trainY, testY = tables
+    with open(os.path.join(path, 'levels.json')) as f:
+        levels = json.load(f)
+    return (trainX, testX, trainY, testY,
+            load('md_ids', None), load('obs_ids', None), levels)
+
+
+def _csr_arrays(name, A):
+    """ Arrays holding a matrix in CSR format, keyed by file name. """
+    A = csr_matrix(A)
+    return {name + '_data': A.data,
+            name + '_indices': A.indices,
+            name + '_indptr': A.indptr,
+            name + '_shape': np.array(A.shape)}
+
+
+def is_cached(path):
+    """ Checks whether a cache entry exists. """
+    return path is not None and os.path.isdir(path)
@@ -1,19 +1,46 @@
 import os
 import tensorflow as tf
-from tensorflow.contrib.distributions import Multinomial, Normal
+from tensorflow.contrib.distributions import Normal
 from tqdm import tqdm
 import time
 import datetime
 import numpy as np
+from scipy.sparse import issparse, coo_matrix
+from scipy.special import gammaln
+from songbird.util import (should_stop, is_intercept_only,
+                           lstsq_differentials, check_initial_differentials)
+from songbird.numpy_backend import fit_intercept, _row_sums, _gammaln1p
+from songbird.stream import BiomStream, check_stream_options
 
 
 class MultRegression(object):
 
     def __init__(self, beta_mean=0, beta_scale=1,
                  batch_size=5, learning_rate=0.001, beta_1=0.9, beta_2=0.99,
-                 clipnorm=10., save_path=""):
+                 clipnorm=10., save_path="", solver='adam',
+                 init='random', feature_chunk_size=None):
         """ Build a tensorflow model
 
+        Parameters
+        ----------
+        solver : str
+            Either 'adam' for minibatch stochastic gradient descent with the
+            Adam optimizer, or 'lbfgs' for full-batch L-BFGS optimization
+            of the same objective.
+        init : str or np.array
+            How the coefficients are initialized, either 'random' to draw
+            them from a standard normal distribution, or 'lstsq' to start
+            from the least squares fit of the design matrix to the additive
+            log ratios of the counts (see
+            `songbird.util.lstsq_differentials`). An array of shape
+            p x (D - 1) is used as the initial coefficients, e.g. from
+            `songbird.util.alr_differentials`.
+        feature_chunk_size : int
+            Number of features whose probabilities are computed at a time.
+            If None, the log softmax over all of the features is computed
+            at once. Smaller chunks bound the memory used per step for
+            tables with very many features.
+
         Returns
         -------
         loss : tf.Tensor
@@ -22,6 +49,15 @@ class MultRegression(object):
         Notes
         -----
         If save_path is None, there won't be anything saved
+
+        If the design matrix only holds an intercept, `fit` computes the
+        MAP estimate directly with `songbird.numpy_backend.fit_intercept`
+        instead of running the optimizer.
+
+        With `feature_chunk_size`, neither the minibatch nor the holdout
+        probabilities are held for all of the features at once. The
+        gradient recomputes the probabilities of each chunk instead of
+        keeping them from the forward pass.
         """
         if save_path == "":
             basename = "logdir"
@@ -37,115 +73,737 @@ class MultRegression(object):
         self.beta_mean = beta_mean
         self.beta_scale = beta_scale
         self.save_path = save_path
+        if solver not in ('adam', 'lbfgs'):
+            raise ValueError("Unknown solver %r, expected 'adam' or 'lbfgs'"
+                             % solver)
+        self.solver = solver
+        if isinstance(init, str) and init not in ('random', 'lstsq'):
+            raise ValueError("Unknown init %r, expected 'random' or 'lstsq'"
+                             % init)
+        self.init = init
+        if feature_chunk_size is not None and feature_chunk_size < 1:
+            raise ValueError("feature_chunk_size must be positive, got %r"
+                             % feature_chunk_size)
+        self.feature_chunk_size = feature_chunk_size
 
-    def __call__(self, session, trainX, trainY, testX, testY):
+    def __call__(self, session, trainX, trainY, testX, testY,
+                 num_samples=None):
         """ Initialize the actual graph
 
         Parameters
         ----------
         session : tf.Session
             Tensorflow session
-        trainX : np.array
+        trainX : np.array or scipy.sparse.spmatrix
             Input training design matrix.
-        trainY : np.array
+        trainY : np.array or scipy.sparse.spmatrix or BiomStream
             Output training OTU table, where rows are samples and columns are
             observations.
-        testX : np.array
+        testX : np.array or scipy.sparse.spmatrix
             Input testing design matrix.
-        testY : np.array
+        testY : np.array or scipy.sparse.spmatrix
             Output testing OTU table, where rows are samples and columns are
             observations.
+        num_samples : int
+            Number of training samples that the rows of `trainX` and
+            `trainY` were collapsed from by
+            `songbird.util.collapse_duplicates`. An epoch then takes as
+            many steps as it would on the samples before collapsing. If
+            None, every row is a sample.
+
+        Notes
+        -----
+        If the OTU tables are passed in as sparse matrices, only their
+        nonzero entries are stored in the graph, so memory scales with the
+        number of nonzero counts rather than with the size of the table.
+
+        The same holds for sparse design matrices. Each minibatch then
+        only gathers the coefficients of the covariates that are nonzero
+        in its samples, so the gradient is sparse as well.
+
+        If the training table is a `songbird.stream.BiomStream`, it is
+        never held in the graph. Each step is fed a minibatch that is read
+        from disk in the background, which requires the 'adam' solver.
         """
         self.session = session
         self.N, self.p = trainX.shape
+        self.num_samples = self.N if num_samples is None else num_samples
         self.D = trainY.shape[1]
         holdout_size = testX.shape[0]
+        if isinstance(trainY, BiomStream):
+            check_stream_options(self.solver, self.init)
+            self.stream = trainY
+        else:
+            self.stream = None
+        if self.stream is None and is_intercept_only(trainX):
+            self._intercept_tables = (trainY, testY)
+        else:
+            self._intercept_tables = None
 
         # Place holder variables to accept input data
-        self.X_ph = tf.constant(trainX, dtype=tf.float32, name='G_ph')
-        self.Y_ph = tf.constant(trainY, dtype=tf.float32, name='Y_ph')
-        self.X_holdout = tf.constant(testX, dtype=tf.float32, name='G_holdout')
-        self.Y_holdout = tf.constant(testY, dtype=tf.float32, name='Y_holdout')
-
-        batch_ids = tf.multinomial(tf.ones([1, self.N]), self.batch_size)
-        sample_ids = tf.squeeze(batch_ids)
-
-        Y_batch = tf.gather(self.Y_ph, sample_ids, axis=0)
-        X_batch = tf.gather(self.X_ph, sample_ids, axis=0)
+        self.sparse_design = issparse(trainX)
+        if self.sparse_design:
+            trainX = trainX.tocsr()
+            self.X_indptr = tf.constant(trainX.indptr, dtype=tf.int64,
+                                        name='G_indptr')
+            self.X_indices = tf.constant(trainX.indices, dtype=tf.int64,
+                                         name='G_indices')
+            self.X_data = tf.constant(trainX.data, dtype=tf.float32,
+                                      name='G_data')
+        else:
+            self.X_ph = tf.constant(trainX, dtype=tf.float32, name='G_ph')
+        if issparse(testX):
+            testX = testX.tocoo()
+            self.X_holdout = tf.sparse.reorder(tf.SparseTensor(
+                np.vstack((testX.row, testX.col)).T.astype(np.int64),
+                testX.data.astype(np.float32), testX.shape))
+        else:
+            self.X_holdout = tf.constant(testX, dtype=tf.float32,
+                                         name='G_holdout')
 
-        total_count = tf.reduce_sum(Y_batch, axis=1)
-        holdout_count = tf.reduce_sum(self.Y_holdout, axis=1)
+        if self.solver == 'lbfgs':
+            # quasi-Newton steps are taken on the full training set
+            batch_size = self.N
+            sample_ids = tf.range(self.N)
+        elif self.stream is not None:
+            # minibatches are read from disk and fed to every step
+            batch_size = min(self.batch_size, self.N)
+            sample_ids = tf.placeholder(tf.int64, [batch_size],
+                                        name='sample_ids')
+            self.batch_rows = tf.placeholder(tf.int64, [None],
+                                             name='batch_rows')
+            self.batch_cols = tf.placeholder(tf.int64, [None],
+                                             name='batch_cols')
+            self.batch_counts = tf.placeholder(tf.float32, [None],
+                                               name='batch_counts')
+            self.batch_log_norm = tf.placeholder(tf.float32, [],
+                                                 name='batch_log_norm')
+            self.sample_ids = sample_ids
+        else:
+            # batches are drawn without replacement
+            batch_size = min(self.batch_size, self.N)
+            self._batches = self._batch_iterator(batch_size)
+            sample_ids = self._sample_ids()
 
         # Define PointMass Variables first
-        self.qbeta = tf.Variable(
-            tf.random_normal([self.p, self.D-1]), name='qB')
+        if not isinstance(self.init, str):
+            initial = tf.constant(check_initial_differentials(
+                self.init, self.p, self.D), dtype=tf.float32)
+        elif self.init == 'lstsq':
+            initial = tf.constant(lstsq_differentials(trainX, trainY),
+                                  dtype=tf.float32)
+        else:
+            initial = tf.random_normal([self.p, self.D-1])
+        self.qbeta = tf.Variable(initial, name='qB')
 
         # regression coefficents distribution
-        beta = Normal(loc=tf.zeros([self.p, self.D-1]) + self.beta_mean,
-                      scale=tf.ones([self.p, self.D-1]) * self.beta_scale,
-                      name='B')
-
-        eta = tf.matmul(X_batch, self.qbeta, name='eta')
-
-        phi = tf.nn.log_softmax(
-            tf.concat(
-                [tf.zeros([self.batch_size, 1]), eta], axis=1), name='phi'
-        )
+        self.beta = Normal(
+            loc=tf.zeros([self.p, self.D-1]) + self.beta_mean,
+            scale=tf.ones([self.p, self.D-1]) * self.beta_scale,
+            name='B')
 
-        Y = Multinomial(total_count=total_count, logits=phi, name='Y')
+        self.sparse = issparse(trainY)
+        if self.stream is None:
+            if self.sparse:
+                trainY = trainY.tocsr()
+                self.Y_indptr = tf.constant(trainY.indptr, dtype=tf.int64,
+                                            name='Y_indptr')
+                self.Y_indices = tf.constant(trainY.indices, dtype=tf.int64,
+                                             name='Y_indices')
+                self.Y_data = tf.constant(trainY.data, dtype=tf.float32,
+                                          name='Y_data')
+            else:
+                self.Y_ph = tf.constant(trainY, dtype=tf.float32,
+                                        name='Y_ph')
+            # beta-independent part of each sample's log likelihood, which
+            # is left out of the objective and only added back to the loss
+            self.Y_log_norm = tf.constant(
+                gammaln(_row_sums(trainY) + 1) -
+                _row_sums(_gammaln1p(trainY)),
+                dtype=tf.float32, name='Y_log_norm')
 
         # cross validation
         with tf.name_scope('accuracy'):
-            pred = tf.reshape(
-                holdout_count, [-1, 1]) * tf.nn.softmax(
-                    tf.concat([
-                        tf.zeros([holdout_size, 1]),
-                        tf.matmul(self.X_holdout, self.qbeta)
-                    ], axis=1), name='phi'
-                )
-
-            self.cv = tf.reduce_mean(
-                tf.squeeze(tf.abs(pred - self.Y_holdout))
-            )
-            tf.summary.scalar('cv_error', self.cv)
+            if self.feature_chunk_size is not None:
+                self.cv = self._chunked_cv(testY, holdout_size)
+            else:
+                self.cv = self._holdout_cv(testY, holdout_size)
+            cv_summary = tf.summary.scalar('cv_error', self.cv)
 
-        self.loss = -(tf.reduce_sum(beta.log_prob(self.qbeta)) +
-                      tf.reduce_sum(Y.log_prob(Y_batch)) *
-                      (self.N / self.batch_size))
+        self.objective = self._objective(sample_ids, batch_size)
+        if self.stream is not None:
+            log_norm = self.batch_log_norm
+        else:
+            log_norm = tf.reduce_sum(tf.gather(self.Y_log_norm, sample_ids))
+        self.loss = self.objective - log_norm * (self.N / batch_size)
+        # number of steps taken, restored along with the parameters
+        self.global_step = tf.train.get_or_create_global_step()
 
-        optimizer = tf.train.AdamOptimizer(
-            self.learning_rate, beta1=self.beta_1, beta2=self.beta_2)
+        if self.solver == 'adam':
+            self.optimizer = tf.train.AdamOptimizer(
+                self.learning_rate, beta1=self.beta_1, beta2=self.beta_2)
 
-        gradients, variables = zip(*optimizer.compute_gradients(self.loss))
-        self.gradients, _ = tf.clip_by_global_norm(gradients, self.clipnorm)
-        self.train = optimizer.apply_gradients(zip(gradients, variables))
+            gradients, variables = zip(
+                *self.optimizer.compute_gradients(self.objective))
+            # the clipped gradients are applied, like the numpy backend
+            self.gradients, _ = tf.clip_by_global_norm(
+                gradients, self.clipnorm)
+            self.train = self.optimizer.apply_gradients(
+                zip(self.gradients, variables), global_step=self.global_step)
+            self._fused_train = None
 
-        tf.summary.scalar('loss', self.loss)
-        tf.summary.histogram('qbeta', self.qbeta)
-        self.merged = tf.summary.merge_all()
+        loss_summary = tf.summary.scalar('loss', self.loss)
+        self.scalar_summaries = tf.summary.merge(
+            [cv_summary, loss_summary])
+        self.histogram_summaries = tf.summary.histogram('qbeta', self.qbeta)
         if self.save_path is not None:
             self.writer = tf.summary.FileWriter(self.save_path,
                                                 self.session.graph)
         else:
             self.writer = None
+        # checkpoints hold the coefficients, the state of the optimizer
+        # and the number of steps taken
+        self.saver = tf.train.Saver()
         tf.global_variables_initializer().run()
 
+    def restore(self, checkpoint):
+        """ Restores the model from a checkpoint written by `fit`.
+
+        Training continues from the step at which the checkpoint was
+        written, with the optimizer in the same state, so `fit` only runs
+        the remaining steps of its epochs.
+
+        Parameters
+        ----------
+        checkpoint : str
+            Path of the checkpoint, e.g. from `tf.train.latest_checkpoint`.
+        """
+        self.saver.restore(self.session, checkpoint)
+
+    def _save(self):
+        """ Writes a checkpoint to `save_path`. """
+        self.saver.save(self.session,
+                        os.path.join(self.save_path, "model.ckpt"),
+                        global_step=self.global_step)
+
+    def _fit_intercept(self):
+        """ Fits an intercept-only model without running the optimizer.
+
+        Returns
+        -------
+        loss: np.array
+            log likelihood loss.
+        cv : np.array
+            cross validation loss
+        iter_n : np.array
+            iterations
+        """
+        fit_start = time.time()
+        B, loss, cv, iter_n = fit_intercept(
+            *self._intercept_tables, self.beta_mean, self.beta_scale)
+        self.qbeta.load(B.astype(np.float32), self.session)
+        if self.writer is not None:
+            for i, train_loss, test_cv in zip(iter_n, loss, cv):
+                self.writer.add_summary(tf.Summary(value=[
+                    tf.Summary.Value(tag='loss', simple_value=train_loss),
+                    tf.Summary.Value(tag='accuracy/cv_error',
+                                     simple_value=test_cv)
+                ]), i)
+        self.stop_reason = 'intercept-only'
+        self.stop_iteration = iter_n[-1]
+        self.num_steps = 0
+        self.summary_times = np.full(len(iter_n),
+                                     time.time() - fit_start)
+        self.B = B
+        return loss, cv, iter_n
+
+    def _fit_lbfgs(self, epochs, checkpoint_interval, silent,
+                   early_stopping, tolerance):
+        """ Fits the model on the full training set with L-BFGS.
+
+        The loss and cross validation error are recorded on every
+        iteration, since there are far fewer of them than with Adam.
+
+        Parameters
+        ----------
+        epochs : int
+           Maximum number of L-BFGS iterations.
+        checkpoint_interval : int
+           Number of seconds until a checkpoint is recorded
+        silent : bool
+           Flag denoting whether to suppress the progress bar.
+        early_stopping : str
+           If not None, L-BFGS-B stops once the relative decrease of the
+           loss falls below `tolerance`.
+        tolerance : float
+           Relative tolerance on the loss.
+
+        Returns
+        -------
+        loss: np.array
+            log likelihood loss.
+        cv : np.array
+            cross validation loss
+        iter_n : np.array
+            iterations
+        """
+        options = {'maxiter': epochs}
+        if early_stopping is not None:
+            options['ftol'] = tolerance
+        optimizer = tf.contrib.opt.ScipyOptimizerInterface(
+            self.objective, var_list=[self.qbeta], method='L-BFGS-B',
+            options=options)
+        fit_start = last_checkpoint_time = time.time()
+        start = self.session.run(self.global_step)
+        current = {}
+        loss = []
+        cv = []
+        iter_n = []
+        times = []
+        progress = None if silent else tqdm(total=epochs)
+
+        def loss_callback(train_loss, test_cv):
+            current['loss'] = train_loss
+            current['cv'] = test_cv
+
+        def step_callback(x):
+            nonlocal last_checkpoint_time
+            i = start + len(iter_n)
+            loss.append(current['loss'])
+            cv.append(current['cv'])
+            iter_n.append(i)
+            times.append(time.time() - fit_start)
+            if self.writer is not None:
+                self.writer.add_summary(tf.Summary(value=[
+                    tf.Summary.Value(tag='loss',
+                                     simple_value=current['loss']),
+                    tf.Summary.Value(tag='accuracy/cv_error',
+                                     simple_value=current['cv'])
+                ]), i)
+            if progress is not None:
+                progress.update()
+
+            now = time.time()
+            if checkpoint_interval is not None:
+                if now - last_checkpoint_time > checkpoint_interval:
+                    self.global_step.load(i + 1, self.session)
+                    self._save()
+                    last_checkpoint_time = now
+
+        optimizer.minimize(self.session,
+                           fetches=[self.loss, self.cv],
+                           loss_callback=loss_callback,
+                           step_callback=step_callback)
+        if progress is not None:
+            progress.close()
+
+        train_loss, test_cv, B = self.session.run(
+            [self.loss, self.cv, self.qbeta]
+        )
+        cv.append(test_cv)
+        loss.append(train_loss)
+        iter_n.append(start + len(iter_n))
+        times.append(time.time() - fit_start)
+        self.global_step.load(iter_n[-1], self.session)
+        if checkpoint_interval is not None:
+            self._save()
+
+        if len(iter_n) > epochs:
+            self.stop_reason = 'max-epochs'
+        else:
+            self.stop_reason = 'lbfgs-converged'
+        self.stop_iteration = iter_n[-1]
+        self.num_steps = iter_n[-1] - start
+        self.summary_times = np.array(times)
+        self.B = B
+        return np.array(loss), np.array(cv), np.array(iter_n)
+
+    def _batch_iterator(self, batch_size):
+        """ Input pipeline yielding the training samples of each minibatch.
+
+        The samples are shuffled once per epoch and split into batches
+        without replacement, so every epoch visits each sample at most
+        once. The last incomplete batch of an epoch is dropped, since the
+        graph is built for a fixed batch size. The next batch is
+        prefetched while the current step runs.
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of samples per minibatch.
+
+        Returns
+        -------
+        tf.data.Iterator
+            Iterator over the ids of the samples in each minibatch.
+        """
+        dataset = (tf.data.Dataset.range(self.N)
+                   .shuffle(self.N, reshuffle_each_iteration=True)
+                   .batch(batch_size, drop_remainder=True)
+                   .repeat()
+                   .prefetch(1))
+        return tf.compat.v1.data.make_one_shot_iterator(dataset)
+
+    def _feed_dict(self):
+        """ Feeds the next minibatch of a streamed table to a step.
+
+        Returns
+        -------
+        dict or None
+            Values of the minibatch placeholders, or None if the training
+            table is held in the graph.
+        """
+        if self.stream is None:
+            return None
+        batch = next(self._minibatches)
+        counts = batch.counts.tocoo()
+        return {self.sample_ids: batch.rows,
+                self.batch_rows: counts.row,
+                self.batch_cols: counts.col,
+                self.batch_counts: counts.data,
+                self.batch_log_norm: batch.log_norm.sum()}
+
+    def _sample_ids(self):
+        """ Draws the training samples of the next minibatch. """
+        return self._batches.get_next()
+
+    def _objective(self, sample_ids, batch_size):
+        """ Negative log posterior of a minibatch, up to a constant.
+
+        The log factorials of the multinomial coefficients do not depend
+        on the coefficients, so they are left out of the training
+        objective and only added back to the reported `loss`.
+
+        Parameters
+        ----------
+        sample_ids : tf.Tensor
+            Rows of the training table in the minibatch.
+        batch_size : int
+            Number of samples in the minibatch.
+
+        Returns
+        -------
+        tf.Tensor
+            The log likelihood of the minibatch without its
+            multinomial coefficients, scaled up to the size of the training
+            set, plus the log prior of the coefficients, negated.
+        """
+        if self.feature_chunk_size is not None:
+            loglike = self._chunked_log_likelihood(sample_ids, batch_size)
+        else:
+            loglike = self._log_likelihood(sample_ids, batch_size)
+        return -(tf.reduce_sum(self.beta.log_prob(self.qbeta)) +
+                 loglike * (self.N / batch_size))
+
+    def _log_likelihood(self, sample_ids, batch_size):
+        """ Log likelihood of a minibatch without its coefficients.
+
+        Parameters
+        ----------
+        sample_ids : tf.Tensor
+            Rows of the training table in the minibatch.
+        batch_size : int
+            Number of samples in the minibatch.
+
+        Returns
+        -------
+        tf.Tensor
+            Sum of the log likelihoods of the samples in the minibatch.
+        """
+        if self.sparse_design:
+            rows, cols, values = _gather_csr_rows(
+                self.X_indptr, self.X_indices, self.X_data,
+                tf.cast(sample_ids, tf.int64))
+            eta = tf.math.unsorted_segment_sum(
+                tf.reshape(values, [-1, 1]) * tf.gather(self.qbeta, cols),
+                rows, batch_size, name='eta')
+        else:
+            X_batch = tf.gather(self.X_ph, sample_ids, axis=0)
+            eta = tf.matmul(X_batch, self.qbeta, name='eta')
+
+        phi = tf.nn.log_softmax(
+            tf.concat(
+                [tf.zeros([batch_size, 1]), eta], axis=1), name='phi'
+        )
+
+        if self.stream is not None:
+            logp = tf.gather_nd(
+                phi, tf.stack([self.batch_rows, self.batch_cols], axis=1))
+            loglike = tf.reduce_sum(self.batch_counts * logp)
+        elif self.sparse:
+            loglike = self._sparse_log_prob(sample_ids, phi)
+        else:
+            Y_batch = tf.gather(self.Y_ph, sample_ids, axis=0)
+            loglike = tf.reduce_sum(Y_batch * phi)
+        return loglike
+
+    def _chunked_log_likelihood(self, sample_ids, batch_size):
+        """ Log likelihood of a minibatch, a chunk of features at a time.
+
+        The counts are only evaluated at their nonzero entries, and the
+        normalizer of the softmax is accumulated over chunks of
+        `feature_chunk_size` features.
+
+        Parameters
+        ----------
+        sample_ids : tf.Tensor
+            Rows of the training table in the minibatch.
+        batch_size : int
+            Number of samples in the minibatch.
+
+        Returns
+        -------
+        tf.Tensor
+            Sum of the log likelihoods of the samples in the minibatch.
+        """
+        sample_ids = tf.cast(sample_ids, tf.int64)
+        if self.sparse_design:
+            # only the coefficients of the covariates in the minibatch
+            rows, cols, values = _gather_csr_rows(
+                self.X_indptr, self.X_indices, self.X_data, sample_ids)
+            covariates, cols = tf.unique(cols, out_idx=tf.int64)
+            X_batch = tf.scatter_nd(
+                tf.stack([rows, cols], axis=1), values,
+                tf.stack([tf.constant(batch_size, tf.int64),
+                          tf.size(covariates, out_type=tf.int64)]))
+            Q = tf.gather(self.qbeta, covariates)
+        else:
+            X_batch = tf.gather(self.X_ph, sample_ids, axis=0)
+            Q = self.qbeta
+
+        if self.stream is not None:
+            rows, cols, counts = (self.batch_rows, self.batch_cols,
+                                  self.batch_counts)
+        elif self.sparse:
+            rows, cols, counts = _gather_csr_rows(
+                self.Y_indptr, self.Y_indices, self.Y_data, sample_ids)
+        else:
+            Y_batch = tf.gather(self.Y_ph, sample_ids, axis=0)
+            idx = tf.where(Y_batch > 0)
+            rows, cols = idx[:, 0], idx[:, 1]
+            counts = tf.gather_nd(Y_batch, idx)
+
+        total_count = tf.math.unsorted_segment_sum(counts, rows, batch_size)
+        lse = _chunked_log_normalizer(X_batch, Q, self.D - 1,
+                                      self.feature_chunk_size)
+        return (tf.reduce_sum(counts * _logits_at(X_batch, Q, rows, cols)) -
+                tf.reduce_sum(total_count * lse))
+
+    def _sparse_log_prob(self, sample_ids, phi):
+        """ Log likelihood of a sparse minibatch without its coefficients.
+
+        Parameters
+        ----------
+        sample_ids : tf.Tensor
+            Rows of the training table in the minibatch.
+        phi : tf.Tensor
+            Log probabilities for the minibatch.
+
+        Returns
+        -------
+        tf.Tensor
+            Sum of the log likelihoods of the samples in the minibatch.
+        """
+        rows, cols, counts = _gather_csr_rows(
+            self.Y_indptr, self.Y_indices, self.Y_data,
+            tf.cast(sample_ids, tf.int64))
+        logp = tf.gather_nd(phi, tf.stack([rows, cols], axis=1))
+        return tf.reduce_sum(counts * logp)
+
+    def _fused_train_op(self):
+        """ Builds an op that runs `n_steps` Adam steps in one call.
+
+        The minibatch loss and its gradients are rebuilt inside a
+        `tf.while_loop`, reusing the slots of the Adam optimizer, so that
+        several steps only cost a single `session.run`.
+
+        Returns
+        -------
+        tf.Tensor
+            Number of steps taken.
+        """
+        if self._fused_train is None:
+            self.n_steps = tf.placeholder(tf.int32, shape=[], name='n_steps')
+
+            def body(i):
+                with tf.control_dependencies([i]):
+                    objective = self._objective(
+                        self._sample_ids(), min(self.batch_size, self.N))
+                    gradients, _ = tf.clip_by_global_norm(
+                        tf.gradients(objective, [self.qbeta]), self.clipnorm)
+                    train = self.optimizer.apply_gradients(
+                        zip(gradients, [self.qbeta]),
+                        global_step=self.global_step)
+                with tf.control_dependencies([train]):
+                    return i + 1
+
+            self._fused_train = tf.while_loop(
+                lambda i: i < self.n_steps, body, [tf.constant(0)],
+                parallel_iterations=1, back_prop=False, name='fused_train')
+        return self._fused_train
+
+    def _holdout_cv(self, testY, holdout_size):
+        """ Mean absolute prediction error on the holdout table.
+
+        Parameters
+        ----------
+        testY : np.array or scipy.sparse.spmatrix
+            Output testing OTU table, where rows are samples and columns are
+            observations.
+        holdout_size : int
+            Number of holdout samples.
+
+        Returns
+        -------
+        tf.Tensor
+            Mean absolute error over all entries of the holdout table.
+        """
+        if isinstance(self.X_holdout, tf.SparseTensor):
+            holdout_eta = tf.sparse.sparse_dense_matmul(
+                self.X_holdout, self.qbeta)
+        else:
+            holdout_eta = tf.matmul(self.X_holdout, self.qbeta)
+        holdout_logits = tf.concat([
+            tf.zeros([holdout_size, 1]), holdout_eta], axis=1)
+        if issparse(testY):
+            return self._sparse_cv(testY, holdout_logits)
+
+        self.Y_holdout = tf.constant(testY, dtype=tf.float32,
+                                     name='Y_holdout')
+        holdout_count = tf.reduce_sum(self.Y_holdout, axis=1)
+        pred = tf.reshape(
+            holdout_count, [-1, 1]) * tf.nn.softmax(
+                holdout_logits, name='phi'
+            )
+        return tf.reduce_mean(tf.squeeze(tf.abs(pred - self.Y_holdout)))
+
+    def _chunked_cv(self, testY, holdout_size):
+        """ Mean absolute prediction error, a chunk of features at a time.
+
+        The holdout table is kept sparse, and only the predictions and the
+        counts of `feature_chunk_size` features are densified at a time.
+
+        Parameters
+        ----------
+        testY : np.array or scipy.sparse.spmatrix
+            Output testing OTU table, where rows are samples and columns are
+            observations.
+        holdout_size : int
+            Number of holdout samples.
+
+        Returns
+        -------
+        tf.Tensor
+            Mean absolute error over all entries of the holdout table.
+        """
+        testY = coo_matrix(testY)
+        holdout_count = tf.constant(
+            np.asarray(testY.sum(axis=1)).reshape(-1, 1), dtype=tf.float32)
+        Y_holdout = tf.sparse.reorder(tf.SparseTensor(
+            np.vstack((testY.row, testY.col)).T.astype(np.int64),
+            testY.data.astype(np.float32), testY.shape))
+        chunk_size = self.feature_chunk_size
+        num_chunks = -(-(self.D - 1) // chunk_size)
+
+        def eta(start, stop):
+            if isinstance(self.X_holdout, tf.SparseTensor):
+                return tf.sparse.sparse_dense_matmul(
+                    self.X_holdout, self.qbeta[:, start:stop])
+            return tf.matmul(self.X_holdout, self.qbeta[:, start:stop])
+
+        lse = tf.reshape(_chunked_logsumexp(
+            eta, holdout_size, self.D - 1, chunk_size), [-1, 1])
+
+        def error(start, stop, logits):
+            # columns of the table are shifted by the reference feature
+            counts = tf.sparse.to_dense(tf.sparse.slice(
+                Y_holdout, tf.cast(tf.stack([0, start]), tf.int64),
+                tf.cast(tf.stack([holdout_size, stop - start]), tf.int64)))
+            pred = holdout_count * tf.exp(logits - lse)
+            return tf.reduce_sum(tf.abs(pred - counts))
+
+        def body(i, total_error):
+            start = i * chunk_size
+            stop = tf.minimum(start + chunk_size, self.D - 1)
+            return i + 1, total_error + error(start + 1, stop + 1,
+                                              eta(start, stop))
+
+        _, total_error = tf.while_loop(
+            lambda i, _: i < num_chunks, body,
+            [tf.constant(0), error(0, 1, tf.zeros([holdout_size, 1]))])
+        return total_error / np.prod(testY.shape)
+
+    def _sparse_cv(self, testY, logits):
+        """ Mean absolute prediction error on a sparse holdout table.
+
+        The zero entries only contribute their predicted counts, so the
+        error is computed from the nonzero entries and the row totals.
+
+        Parameters
+        ----------
+        testY : scipy.sparse.spmatrix
+            Output testing OTU table, where rows are samples and columns are
+            observations.
+        logits : tf.Tensor
+            Unnormalized log probabilities for the holdout samples.
+
+        Returns
+        -------
+        tf.Tensor
+            Mean absolute error over all entries of the holdout table.
+        """
+        testY = testY.tocoo()
+        holdout_count = np.asarray(testY.sum(axis=1)).ravel()
+        idx = np.vstack((testY.row, testY.col)).T.astype(np.int64)
+        counts = tf.constant(testY.data, dtype=tf.float32, name='Y_holdout')
+        pred = tf.gather_nd(
+            tf.reshape(holdout_count.astype(np.float32), [-1, 1]) *
+            tf.nn.softmax(logits, name='phi'), idx)
+        total_error = (holdout_count.sum() - tf.reduce_sum(pred) +
+                       tf.reduce_sum(tf.abs(pred - counts)))
+        return total_error / np.prod(testY.shape)
+
     def fit(self, epochs=10, summary_interval=100, checkpoint_interval=3600,
-            silent=False):
+            silent=False, early_stopping=None, tolerance=1e-4, patience=10,
+            steps_per_call=1, histogram_interval=None, profile=False):
         """ Fits the model.
 
         Parameters
         ----------
         epochs : int
-           Number of epochs to train
+           Number of epochs to train. For the 'lbfgs' solver, this is
+           the maximum number of L-BFGS iterations.
         summary_interval : float
-           Number of seconds until a summary is recorded
+           Number of seconds until a summary is recorded. This records the
+           loss and cross validation error and writes them as scalar
+           summaries.
         checkpoint_interval : int
-           Number of seconds until a checkpoint is recorded
+           Number of seconds until a checkpoint is recorded. A last
+           checkpoint is written once training ends. If None, no
+           checkpoints are written.
         silent : bool
            Flag denoting whether to suppress progress bar and TensorFlow
            warnings. If True, show neither progress bar nor warnings. If False
            (default), show both.
+        early_stopping : str
+           Quantity monitored for early stopping, either 'loss', 'cv' or
+           'both'. If None (default), training runs for all epochs.
+        tolerance : float
+           Minimum relative decrease of the monitored quantity that counts
+           as an improvement.
+        patience : int
+           Number of consecutive summaries without improvement after which
+           training is stopped.
+        steps_per_call : int
+           Maximum number of Adam steps run inside the graph per call to
+           `session.run` between summaries. Larger values avoid the
+           per-step overhead of Python and the session.
+        histogram_interval : float
+           Number of seconds until a histogram of the coefficients is
+           written. If None (default), no histograms are written.
+        profile : bool
+           If True, a full trace of the step is written along with every
+           summary so it can be inspected in Tensorboard.
 
         Returns
         -------
@@ -155,62 +813,306 @@ class MultRegression(object):
             cross validation loss
         iter_n : np.array
             iterations
+
+        Notes
+        -----
+        The reason training stopped and the iteration at which it stopped
+        are stored in `stop_reason` and `stop_iteration`, the number of
+        steps taken by this call in `num_steps`, and the number of seconds
+        elapsed since training started, at each of the returned
+        iterations, in `summary_times`.
+
+        If the model was restored from a checkpoint, training resumes at
+        the step where the checkpoint was written and stops after the
+        total number of steps for `epochs`.
+
+        For the 'lbfgs' solver, early stopping on the loss is delegated
+        to the relative tolerance of L-BFGS-B, and `patience` is ignored.
+
+        When the training table is streamed, every step is fed its own
+        minibatch, so `steps_per_call` is ignored.
         """
-        num_iter = (self.N // self.batch_size) * epochs
-        cv = None
-        last_checkpoint_time = 0
+        if early_stopping not in (None, 'loss', 'cv', 'both'):
+            raise ValueError("Unknown early stopping criterion %r"
+                             % early_stopping)
+        if self.save_path is None:
+            checkpoint_interval = None
+        if self._intercept_tables is not None:
+            return self._fit_intercept()
+        if self.solver == 'lbfgs':
+            return self._fit_lbfgs(epochs, checkpoint_interval, silent,
+                                   early_stopping, tolerance)
+
+        # the minibatches are clamped to the rows of the table, e.g. the
+        # unique rows of collapsed samples
+        num_iter = (self.num_samples //
+                    min(self.batch_size, self.num_samples)) * epochs
+        fit_start = last_checkpoint_time = time.time()
         last_summary_time = 0
-        saver = tf.train.Saver()
+        last_histogram_time = 0
         loss = []
         cv = []
         iter_n = []
+        times = []
+        if self.stream is not None:
+            steps_per_call = 1
+            self._minibatches = self.stream.minibatches(
+                min(self.batch_size, self.N),
+                random_state=self.session.graph.seed)
+        if steps_per_call > 1:
+            fused_train = self._fused_train_op()
 
-        if silent:
-            iter_range = range(0, num_iter)
-        else:
-            iter_range = tqdm(range(0, num_iter))
+        self.stop_reason = 'max-epochs'
+
+        # continue from the restored step, if any
+        start = self.session.run(self.global_step)
+        progress = None if silent else tqdm(total=num_iter, initial=start)
 
-        for i in iter_range:
+        i = start
+        while i < num_iter:
             now = time.time()
+            steps = 1
 
             if now - last_summary_time > summary_interval:
-                run_options = tf.RunOptions(
-                    trace_level=tf.RunOptions.FULL_TRACE)
-                run_metadata = tf.RunMetadata()
-                _, summary, train_loss, test_cv, grads = self.session.run(
-                    [self.train, self.merged,
-                     self.loss, self.cv, self.gradients],
-                    options=run_options,
-                    run_metadata=run_metadata
-                )
+                fetches = [self.train, self.scalar_summaries,
+                           self.loss, self.cv]
+                write_histogram = (
+                    histogram_interval is not None and
+                    now - last_histogram_time > histogram_interval)
+                if write_histogram:
+                    fetches.append(self.histogram_summaries)
+                    last_histogram_time = now
+                if profile:
+                    run_options = tf.RunOptions(
+                        trace_level=tf.RunOptions.FULL_TRACE)
+                    run_metadata = tf.RunMetadata()
+                    res = self.session.run(fetches, options=run_options,
+                                           run_metadata=run_metadata,
+                                           feed_dict=self._feed_dict())
+                else:
+                    res = self.session.run(fetches,
+                                           feed_dict=self._feed_dict())
+                _, summary, train_loss, test_cv = res[:4]
                 cv.append(test_cv)
                 loss.append(train_loss)
                 iter_n.append(i)
+                times.append(time.time() - fit_start)
 
                 if self.writer is not None:
-                    self.writer.add_run_metadata(run_metadata, 'step%d' % i)
+                    if profile:
+                        self.writer.add_run_metadata(run_metadata,
+                                                     'step%d' % i)
                     self.writer.add_summary(summary, i)
+                    if write_histogram:
+                        self.writer.add_summary(res[4], i)
                 last_summary_time = now
+
+                if should_stop(loss, cv, early_stopping,
+                               tolerance, patience):
+                    self.stop_reason = '%s-converged' % early_stopping
+                    break
+            elif steps_per_call > 1:
+                steps = min(steps_per_call, num_iter - i)
+                self.session.run(fused_train,
+                                 feed_dict={self.n_steps: steps})
             else:
-                _, summary, train_loss, grads = self.session.run(
-                    [self.train, self.merged, self.loss, self.gradients],
-                )
-                if self.writer is not None:
-                    self.writer.add_summary(summary, i)
+                self.session.run(self.train, feed_dict=self._feed_dict())
 
             if checkpoint_interval is not None:
                 if now - last_checkpoint_time > checkpoint_interval:
-                    saver.save(self.session,
-                               os.path.join(self.save_path, "model.ckpt"),
-                               global_step=i)
-                last_checkpoint_time = now
+                    self._save()
+                    last_checkpoint_time = now
+
+            i += steps
+            if progress is not None:
+                progress.update(steps)
+
+        if progress is not None:
+            progress.close()
+        if checkpoint_interval is not None:
+            self._save()
+        # index of the last step that was taken
+        i = max(min(i, num_iter - 1), start - 1)
 
         train_loss, test_cv, B = self.session.run(
-            [self.loss, self.cv, self.qbeta]
+            [self.loss, self.cv, self.qbeta], feed_dict=self._feed_dict()
         )
+        if self.stream is not None:
+            self._minibatches.close()
         cv.append(test_cv)
         loss.append(train_loss)
         iter_n.append(i)
+        times.append(time.time() - fit_start)
 
+        self.stop_iteration = i
+        self.num_steps = self.session.run(self.global_step) - start
+        self.summary_times = np.array(times)
         self.B = B
         return np.array(loss), np.array(cv), np.array(iter_n)
+
+
+def session_config(threads=None):
+    """ Session configuration that limits the threads used by TensorFlow.
+
+    Parameters
+    ----------
+    threads : int
+        Maximum number of threads in each of the intra-op and inter-op
+        thread pools. If None, TensorFlow picks the number of threads
+        itself.
+
+    Returns
+    -------
+    tf.ConfigProto or None
+        Configuration passed to `tf.Session`.
+    """
+    if threads is None:
+        return None
+    return tf.ConfigProto(intra_op_parallelism_threads=threads,
+                          inter_op_parallelism_threads=threads)
+
+
+def _gather_csr_rows(indptr, indices, data, rows):
+    """ Gathers rows of a CSR matrix stored as tensors.
+
+    Parameters
+    ----------
+    indptr : tf.Tensor
+        Row pointers of the CSR matrix.
+    indices : tf.Tensor
+        Column indices of the CSR matrix.
+    data : tf.Tensor
+        Nonzero values of the CSR matrix.
+    rows : tf.Tensor
+        Ids of the rows to gather.
+
+    Returns
+    -------
+    batch_rows : tf.Tensor
+        Position in `rows` of each gathered entry.
+    cols : tf.Tensor
+        Column index of each gathered entry.
+    values : tf.Tensor
+        Value of each gathered entry.
+    """
+    positions = tf.ragged.range(tf.gather(indptr, rows),
+                                tf.gather(indptr, rows + 1))
+    flat = positions.flat_values
+    batch_rows = positions.value_rowids()
+    return batch_rows, tf.gather(indices, flat), tf.gather(data, flat)
+
+
+def _logits_at(X, Q, rows, cols):
+    """ Entries of the logits [0, X Q] at the given rows and columns.
+
+    Parameters
+    ----------
+    X : tf.Tensor
+        Design matrix.
+    Q : tf.Tensor
+        Coefficients, without the reference feature.
+    rows, cols : tf.Tensor
+        Positions of the entries, where column 0 is the reference feature.
+
+    Returns
+    -------
+    tf.Tensor
+        Logit of each entry.
+    """
+    cols = cols - 1
+    Q_cols = tf.gather(Q, tf.maximum(cols, 0), axis=1)
+    eta = tf.reduce_sum(tf.gather(X, rows) * tf.transpose(Q_cols), axis=1)
+    return tf.where(cols >= 0, eta, tf.zeros_like(eta))
+
+
+def _chunked_logsumexp(eta, num_rows, num_columns, chunk_size):
+    """ Row-wise log-sum-exp of [0, eta], a chunk of columns at a time.
+
+    Parameters
+    ----------
+    eta : callable
+        Computes the columns `start:stop` of the logits.
+    num_rows : int or tf.Tensor
+        Number of rows of the logits.
+    num_columns : int
+        Number of columns of the logits, without the reference column.
+    chunk_size : int
+        Number of columns computed at a time.
+
+    Returns
+    -------
+    tf.Tensor
+        Log-sum-exp of each row.
+    """
+    num_chunks = -(-num_columns // chunk_size)
+
+    def body(i, m, total):
+        start = i * chunk_size
+        logits = eta(start, tf.minimum(start + chunk_size, num_columns))
+        new_m = tf.maximum(m, tf.reduce_max(logits, axis=1))
+        total = (total * tf.exp(m - new_m) + tf.reduce_sum(
+            tf.exp(logits - tf.reshape(new_m, [-1, 1])), axis=1))
+        return i + 1, new_m, total
+
+    # the reference column contributes exp(0) to every row
+    _, m, total = tf.while_loop(
+        lambda i, m, total: i < num_chunks, body,
+        [tf.constant(0), tf.zeros([num_rows]), tf.ones([num_rows])],
+        back_prop=False)
+    return m + tf.log(total)
+
+
+def _chunked_log_normalizer(X, Q, num_columns, chunk_size):
+    """ Row-wise log-sum-exp of [0, X Q] with a chunked gradient.
+
+    Parameters
+    ----------
+    X : tf.Tensor
+        Design matrix.
+    Q : tf.Tensor
+        Coefficients, without the reference feature.
+    num_columns : int
+        Number of columns of Q.
+    chunk_size : int
+        Number of columns computed at a time.
+
+    Returns
+    -------
+    tf.Tensor
+        Log-sum-exp of each row.
+
+    Notes
+    -----
+    The gradient with respect to Q recomputes the softmax probabilities
+    of each chunk, so only `chunk_size` columns of the probabilities are
+    held in memory at a time.
+    """
+    num_chunks = -(-num_columns // chunk_size)
+
+    @tf.custom_gradient
+    def log_normalizer(Q):
+        def eta(start, stop):
+            return tf.matmul(X, Q[:, start:stop])
+
+        lse = _chunked_logsumexp(eta, tf.shape(X)[0], num_columns,
+                                 chunk_size)
+
+        def grad(dy):
+            def body(i, grads):
+                start = i * chunk_size
+                stop = tf.minimum(start + chunk_size, num_columns)
+                probs = tf.reshape(dy, [-1, 1]) * tf.exp(
+                    eta(start, stop) - tf.reshape(lse, [-1, 1]))
+                return i + 1, grads.write(
+                    i, tf.matmul(probs, X, transpose_a=True))
+
+            _, grads = tf.while_loop(
+                lambda i, grads: i < num_chunks, body,
+                [tf.constant(0), tf.TensorArray(
+                    tf.float32, size=num_chunks, infer_shape=False)],
+                back_prop=False)
+            return tf.transpose(grads.concat())
+
+        return lse, grad
+
+    return log_normalizer(Q)
@@ -0,0 +1,673 @@
+import os
+import time
+import datetime
+import numpy as np
+from scipy.optimize import minimize
+from scipy.sparse import issparse
+from scipy.special import gammaln
+from sklearn.utils import check_random_state
+from tqdm import tqdm
+from songbird.util import (should_stop, is_intercept_only,
+                           lstsq_differentials, check_initial_differentials)
+from songbird.stream import BiomStream, Minibatch, check_stream_options
+
+
+class NumpyMultRegression(object):
+
+    def __init__(self, beta_mean=0, beta_scale=1,
+                 batch_size=5, learning_rate=0.001, beta_1=0.9, beta_2=0.99,
+                 clipnorm=10., save_path="", solver='adam', init='random',
+                 random_state=None, feature_chunk_size=None):
+        """ Build a multinomial regression model on top of NumPy.
+
+        This mirrors `songbird.multinomial.MultRegression`, but computes
+        the gradients of the log posterior analytically, so it does not
+        require TensorFlow.
+
+        Parameters
+        ----------
+        solver : str
+            Either 'adam' for minibatch stochastic gradient descent with the
+            Adam optimizer, or 'lbfgs' for full-batch L-BFGS optimization
+            of the same objective.
+        init : str or np.array
+            How the coefficients are initialized, either 'random' to draw
+            them from a standard normal distribution, or 'lstsq' to start
+            from the least squares fit of the design matrix to the additive
+            log ratios of the counts (see
+            `songbird.util.lstsq_differentials`). An array of shape
+            p x (D - 1) is used as the initial coefficients, e.g. from
+            `songbird.util.alr_differentials`.
+        random_state : int or np.random.RandomState
+            Random state used to initialize the coefficients and draw
+            minibatches.
+        feature_chunk_size : int
+            Number of features whose probabilities are computed at a time.
+            If None, the probabilities of all of the features are computed
+            at once. Smaller chunks bound the memory used per step for
+            tables with very many features.
+
+        Notes
+        -----
+        If save_path is None, there won't be anything saved
+
+        If the design matrix only holds an intercept, `fit` computes the
+        MAP estimate directly with `fit_intercept` instead.
+        """
+        if save_path == "":
+            basename = "logdir"
+            suffix = datetime.datetime.now().strftime("%y%m%d_%H%M%S")
+            save_path = "_".join([basename, suffix])
+
+        self.learning_rate = learning_rate
+        self.beta_1 = beta_1
+        self.beta_2 = beta_2
+        self.batch_size = batch_size
+        self.clipnorm = clipnorm
+
+        self.beta_mean = beta_mean
+        self.beta_scale = beta_scale
+        self.save_path = save_path
+        if solver not in ('adam', 'lbfgs'):
+            raise ValueError("Unknown solver %r, expected 'adam' or 'lbfgs'"
+                             % solver)
+        self.solver = solver
+        if isinstance(init, str) and init not in ('random', 'lstsq'):
+            raise ValueError("Unknown init %r, expected 'random' or 'lstsq'"
+                             % init)
+        self.init = init
+        self.random_state = check_random_state(random_state)
+        if feature_chunk_size is not None and feature_chunk_size < 1:
+            raise ValueError("feature_chunk_size must be positive, got %r"
+                             % feature_chunk_size)
+        self.feature_chunk_size = feature_chunk_size
+
+    def __call__(self, session, trainX, trainY, testX, testY,
+                 num_samples=None):
+        """ Initialize the model parameters and sufficient statistics
+
+        Parameters
+        ----------
+        session : None
+            Unused, kept for compatibility with `MultRegression`.
+        trainX : np.array or scipy.sparse.spmatrix
+            Input training design matrix.
+        trainY : np.array or scipy.sparse.spmatrix or BiomStream
+            Output training OTU table, where rows are samples and columns are
+            observations.
+        testX : np.array or scipy.sparse.spmatrix
+            Input testing design matrix.
+        testY : np.array or scipy.sparse.spmatrix
+            Output testing OTU table, where rows are samples and columns are
+            observations.
+        num_samples : int
+            Number of training samples that the rows of `trainX` and
+            `trainY` were collapsed from by
+            `songbird.util.collapse_duplicates`. An epoch then takes as
+            many steps as it would on the samples before collapsing. If
+            None, every row is a sample.
+
+        Notes
+        -----
+        Sparse design matrices are kept sparse, so that covariates with
+        many levels only cost their nonzero entries in the products with
+        the coefficients.
+
+        If the training table is a `songbird.stream.BiomStream`, the
+        minibatches are read from disk while training, which requires the
+        'adam' solver. The loss is then always estimated from a minibatch.
+        """
+        self.N, self.p = trainX.shape
+        self.num_samples = self.N if num_samples is None else num_samples
+        self.D = trainY.shape[1]
+
+        self.trainX = _as_float(trainX)
+        self.testX = _as_float(testX)
+        if issparse(testY):
+            self.testY = testY.tocsr().astype(np.float64)
+        else:
+            self.testY = np.asarray(testY, dtype=np.float64)
+        self.holdout_count = _row_sums(self.testY)
+
+        if isinstance(trainY, BiomStream):
+            check_stream_options(self.solver, self.init)
+            self.stream = trainY
+            self.trainY = None
+        else:
+            self.stream = None
+            if issparse(trainY):
+                self.trainY = trainY.tocsr().astype(np.float64)
+            else:
+                self.trainY = np.asarray(trainY, dtype=np.float64)
+            self.total_count = _row_sums(self.trainY)
+            # beta-independent part of each sample's log likelihood
+            self.log_norm = gammaln(self.total_count + 1) - _row_sums(
+                _gammaln1p(self.trainY))
+            # sufficient statistic for the full-batch log likelihood
+            self.XtY = _xty(self.trainX, self.trainY)
+
+        if not isinstance(self.init, str):
+            self.B = check_initial_differentials(self.init, self.p, self.D)
+        elif self.init == 'lstsq':
+            self.B = lstsq_differentials(self.trainX, self.trainY)
+        else:
+            self.B = self.random_state.normal(size=(self.p, self.D - 1))
+
+        # state of the optimizer, which is kept in checkpoints
+        self.iteration = 0
+        self._m = np.zeros_like(self.B)
+        self._v = np.zeros_like(self.B)
+
+    def _log_prior(self, B):
+        """ Log density of the Normal prior and its gradient. """
+        z = (B - self.beta_mean) / self.beta_scale
+        logp = np.sum(-0.5 * z ** 2 - np.log(self.beta_scale) -
+                      0.5 * np.log(2 * np.pi))
+        return logp, -z / self.beta_scale
+
+    def _log_likelihood(self, B, rows=None):
+        """ Multinomial log likelihood of the training samples.
+
+        Parameters
+        ----------
+        B : np.array
+            Regression coefficients.
+        rows : np.array or Minibatch
+            Training samples to evaluate. If None, all of the training
+            samples are used together with the precomputed `XtY`.
+
+        Returns
+        -------
+        loglike : float
+            Log likelihood of the samples.
+        grad : np.array
+            Gradient of the log likelihood with respect to B.
+        """
+        if rows is None:
+            X, n, XtY = self.trainX, self.total_count, self.XtY
+            log_norm = self.log_norm.sum()
+        elif isinstance(rows, Minibatch):
+            X, n = self.trainX[rows.rows], rows.total_count
+            XtY = _xty(X, rows.counts)
+            log_norm = rows.log_norm.sum()
+        else:
+            X, n = self.trainX[rows], self.total_count[rows]
+            XtY = _xty(X, self.trainY[rows])
+            log_norm = self.log_norm[rows].sum()
+
+        if self.feature_chunk_size is None:
+            eta = X @ B
+            lse = _logsumexp(eta)
+            probs = np.exp(eta - lse.reshape(-1, 1))
+            grad = XtY[:, 1:] - X.T @ (n.reshape(-1, 1) * probs)
+        else:
+            # the probabilities are recomputed a chunk at a time once the
+            # normalizer is known
+            lse = _chunked_logsumexp(X, B, self.feature_chunk_size)
+            grad = XtY[:, 1:].copy()
+            for cols in _column_chunks(B.shape[1], self.feature_chunk_size):
+                probs = np.exp(X @ B[:, cols] - lse.reshape(-1, 1))
+                grad[:, cols] -= X.T @ (n.reshape(-1, 1) * probs)
+        loglike = np.sum(XtY[:, 1:] * B) - n @ lse + log_norm
+        return loglike, grad
+
+    def _loss(self, B, rows=None):
+        """ Negative log posterior and its gradient. """
+        logp, dlogp = self._log_prior(B)
+        loglike, dloglike = self._log_likelihood(B, rows)
+        scale = 1 if rows is None else self.N / len(rows)
+        return -(logp + loglike * scale), -(dlogp + dloglike * scale)
+
+    def _cv(self, B):
+        """ Mean absolute prediction error on the holdout samples. """
+        if self.feature_chunk_size is None:
+            eta = self.testX @ B
+            lse = _logsumexp(eta)
+            probs = np.hstack((np.exp(-lse).reshape(-1, 1),
+                               np.exp(eta - lse.reshape(-1, 1))))
+            return _cv_error(self.holdout_count, probs, self.testY)
+
+        # the reference feature, then the other features a chunk at a time
+        testY = self.testY.tocsc() if issparse(self.testY) else self.testY
+        lse = _chunked_logsumexp(self.testX, B, self.feature_chunk_size)
+        total_error = _abs_error(self.holdout_count,
+                                 np.exp(-lse).reshape(-1, 1), testY[:, :1])
+        for cols in _column_chunks(B.shape[1], self.feature_chunk_size):
+            probs = np.exp(self.testX @ B[:, cols] - lse.reshape(-1, 1))
+            total_error += _abs_error(
+                self.holdout_count, probs,
+                testY[:, cols.start + 1:cols.stop + 1])
+        return total_error / np.prod(testY.shape)
+
+    def _batches(self):
+        """ Yields the training samples of each minibatch.
+
+        The samples are shuffled once per epoch and split into batches
+        without replacement, dropping the last incomplete batch, like the
+        input pipeline of `MultRegression`. Streamed samples are read
+        from disk by `songbird.stream.BiomStream.minibatches` instead.
+        """
+        batch_size = min(self.batch_size, self.N)
+        if self.stream is not None:
+            return self.stream.minibatches(batch_size, self.random_state)
+        return self._shuffled_rows(batch_size)
+
+    def _shuffled_rows(self, batch_size):
+        """ Yields the rows of each minibatch of the training table. """
+        num_batches = self.N // batch_size
+        while True:
+            order = self.random_state.permutation(self.N)
+            for b in range(num_batches):
+                yield order[b * batch_size:(b + 1) * batch_size]
+
+    def _save(self):
+        """ Saves the coefficients and optimizer state as a checkpoint. """
+        os.makedirs(self.save_path, exist_ok=True)
+        np.savez(os.path.join(self.save_path, "model.npz"),
+                 B=self.B, m=self._m, v=self._v, iteration=self.iteration)
+
+    def restore(self, checkpoint):
+        """ Restores the model from a checkpoint written by `fit`.
+
+        Training continues from the step at which the checkpoint was
+        written, with the optimizer in the same state, so `fit` only runs
+        the remaining steps of its epochs.
+
+        Parameters
+        ----------
+        checkpoint : str
+            Path of the `model.npz` checkpoint.
+        """
+        with np.load(checkpoint) as ckpt:
+            self.B = check_initial_differentials(ckpt['B'], self.p, self.D)
+            self._m = ckpt['m']
+            self._v = ckpt['v']
+            self.iteration = int(ckpt['iteration'])
+
+    def fit(self, epochs=10, summary_interval=100, checkpoint_interval=3600,
+            silent=False, early_stopping=None, tolerance=1e-4, patience=10):
+        """ Fits the model.
+
+        Parameters
+        ----------
+        epochs : int
+           Number of epochs to train. For the 'lbfgs' solver, this is
+           the maximum number of L-BFGS iterations.
+        summary_interval : float
+           Number of seconds until a summary is recorded
+        checkpoint_interval : int
+           Number of seconds until a checkpoint is recorded. A last
+           checkpoint is written once training ends. If None, no
+           checkpoints are written.
+        silent : bool
+           Flag denoting whether to suppress the progress bar.
+        early_stopping : str
+           Quantity monitored for early stopping, either 'loss', 'cv' or
+           'both'. If None (default), training runs for all epochs.
+        tolerance : float
+           Minimum relative decrease of the monitored quantity that counts
+           as an improvement.
+        patience : int
+           Number of consecutive summaries without improvement after which
+           training is stopped.
+
+        Returns
+        -------
+        loss: np.array
+            log likelihood loss.
+        cv : np.array
+            cross validation loss
+        iter_n : np.array
+            iterations
+
+        Notes
+        -----
+        The number of seconds elapsed since training started, at each of
+        the returned iterations, is stored in `summary_times`, and the
+        number of steps taken by this call in `num_steps`.
+        """
+        if early_stopping not in (None, 'loss', 'cv', 'both'):
+            raise ValueError("Unknown early stopping criterion %r"
+                             % early_stopping)
+        if self.save_path is None:
+            checkpoint_interval = None
+        if self.stream is None and is_intercept_only(self.trainX):
+            return self._fit_intercept()
+        if self.solver == 'lbfgs':
+            return self._fit_lbfgs(epochs, checkpoint_interval, silent,
+                                   early_stopping, tolerance)
+
+        # the minibatches are clamped to the rows of the table, e.g. the
+        # unique rows of collapsed samples
+        num_iter = (self.num_samples //
+                    min(self.batch_size, self.num_samples)) * epochs
+        fit_start = last_checkpoint_time = time.time()
+        last_summary_time = 0
+        loss = []
+        cv = []
+        iter_n = []
+        times = []
+        epsilon = 1e-8
+        # continue from the restored step, if any
+        start = self.iteration
+        i = max(start - 1, 0)
+
+        self.stop_reason = 'max-epochs'
+        batches = self._batches()
+
+        if silent:
+            iter_range = range(start, num_iter)
+        else:
+            iter_range = tqdm(range(start, num_iter), initial=start,
+                              total=num_iter)
+
+        for i in iter_range:
+            now = time.time()
+
+            rows = next(batches)
+            train_loss, grad = self._loss(self.B, rows)
+
+            if now - last_summary_time > summary_interval:
+                loss.append(train_loss)
+                cv.append(self._cv(self.B))
+                iter_n.append(i)
+                times.append(time.time() - fit_start)
+                last_summary_time = now
+
+                if should_stop(loss, cv, early_stopping,
+                               tolerance, patience):
+                    self.stop_reason = '%s-converged' % early_stopping
+                    break
+
+            norm = np.sqrt(np.sum(grad ** 2))
+            if norm > self.clipnorm:
+                grad = grad * (self.clipnorm / norm)
+
+            t = i + 1
+            self._m = self.beta_1 * self._m + (1 - self.beta_1) * grad
+            self._v = self.beta_2 * self._v + (1 - self.beta_2) * grad ** 2
+            lr = (self.learning_rate * np.sqrt(1 - self.beta_2 ** t) /
+                  (1 - self.beta_1 ** t))
+            self.B = self.B - lr * self._m / (np.sqrt(self._v) + epsilon)
+            self.iteration = t
+
+            if checkpoint_interval is not None:
+                if now - last_checkpoint_time > checkpoint_interval:
+                    self._save()
+                    last_checkpoint_time = now
+
+        if checkpoint_interval is not None:
+            self._save()
+        if self.stream is None:
+            loss.append(self._loss(self.B)[0])
+        else:
+            loss.append(self._loss(self.B, next(batches))[0])
+        batches.close()
+        cv.append(self._cv(self.B))
+        iter_n.append(i)
+        times.append(time.time() - fit_start)
+
+        self.stop_iteration = i
+        self.num_steps = self.iteration - start
+        self.summary_times = np.array(times)
+        return np.array(loss), np.array(cv), np.array(iter_n)
+
+    def _fit_intercept(self):
+        """ Fits an intercept-only model with `fit_intercept`. """
+        fit_start = time.time()
+        self.B, loss, cv, iter_n = fit_intercept(
+            self.trainY, self.testY, self.beta_mean, self.beta_scale)
+        self.stop_reason = 'intercept-only'
+        self.stop_iteration = iter_n[-1]
+        self.num_steps = 0
+        self.summary_times = np.full(len(iter_n),
+                                     time.time() - fit_start)
+        return loss, cv, iter_n
+
+    def _fit_lbfgs(self, epochs, checkpoint_interval, silent,
+                   early_stopping, tolerance):
+        """ Fits the model on the full training set with L-BFGS.
+
+        The loss and cross validation error are recorded on every
+        iteration, since there are far fewer of them than with Adam.
+        """
+        shape = self.B.shape
+        fit_start = last_checkpoint_time = time.time()
+        start = self.iteration
+        current = {}
+        loss = []
+        cv = []
+        iter_n = []
+        times = []
+        progress = None if silent else tqdm(total=epochs)
+
+        def fun(x):
+            f, grad = self._loss(x.reshape(shape))
+            current['x'] = x.copy()
+            current['loss'] = f
+            return f, grad.ravel()
+
+        def callback(x):
+            nonlocal last_checkpoint_time
+            if not np.array_equal(x, current['x']):
+                fun(x)
+            i = start + len(iter_n)
+            loss.append(current['loss'])
+            cv.append(self._cv(x.reshape(shape)))
+            iter_n.append(i)
+            times.append(time.time() - fit_start)
+            if progress is not None:
+                progress.update()
+
+            now = time.time()
+            if checkpoint_interval is not None:
+                if now - last_checkpoint_time > checkpoint_interval:
+                    self.B = x.reshape(shape)
+                    self.iteration = i + 1
+                    self._save()
+                    last_checkpoint_time = now
+
+        options = {'maxiter': epochs}
+        if early_stopping is not None:
+            options['ftol'] = tolerance
+        res = minimize(fun, self.B.ravel(), jac=True, method='L-BFGS-B',
+                       callback=callback, options=options)
+        if progress is not None:
+            progress.close()
+
+        self.B = res.x.reshape(shape)
+        loss.append(res.fun)
+        cv.append(self._cv(self.B))
+        iter_n.append(start + len(iter_n))
+        times.append(time.time() - fit_start)
+        self.iteration = iter_n[-1]
+        if checkpoint_interval is not None:
+            self._save()
+
+        if len(iter_n) > epochs:
+            self.stop_reason = 'max-epochs'
+        else:
+            self.stop_reason = 'lbfgs-converged'
+        self.stop_iteration = iter_n[-1]
+        self.num_steps = self.iteration - start
+        self.summary_times = np.array(times)
+        return np.array(loss), np.array(cv), np.array(iter_n)
+
+
+def fit_intercept(trainY, testY, beta_mean=0, beta_scale=1, maxiter=100,
+                  tol=1e-8):
+    """ MAP estimate of a multinomial regression on an intercept only.
+
+    Without covariates, every sample shares the same probabilities, so
+    the log likelihood only depends on the total counts of each feature.
+    The log posterior is then maximized with Newton's method, starting
+    from the log ratios of the pooled proportions. The Hessian is a
+    diagonal matrix plus a rank one update, so each step is solved with
+    the Sherman-Morrison formula in linear time.
+
+    Parameters
+    ----------
+    trainY : np.array or scipy.sparse.spmatrix
+        Output training OTU table, where rows are samples and columns are
+        observations.
+    testY : np.array or scipy.sparse.spmatrix
+        Output testing OTU table, where rows are samples and columns are
+        observations.
+    beta_mean : float
+        Mean of the normal prior on the intercepts.
+    beta_scale : float
+        Standard deviation of the normal prior on the intercepts.
+    maxiter : int
+        Maximum number of Newton steps.
+    tol : float
+        Newton stops once no intercept changes by more than this, or
+        once the loss stops decreasing.
+
+    Returns
+    -------
+    B : np.array
+        Intercepts, of shape 1 x (D - 1), relative to the first feature.
+    loss : np.array
+        Negative log posterior after every Newton step, starting with the
+        initial estimate.
+    cv : np.array
+        Cross validation error after every Newton step.
+    iter_n : np.array
+        Newton steps.
+    """
+    trainY = trainY.tocsr() if issparse(trainY) else np.asarray(trainY)
+    testY = testY.tocsr() if issparse(testY) else np.asarray(testY)
+    counts = np.asarray(trainY.sum(axis=0), dtype=np.float64).ravel()
+    total = counts.sum()
+    log_norm = (gammaln(_row_sums(trainY) + 1).sum() -
+                _row_sums(_gammaln1p(trainY)).sum())
+    holdout_count = _row_sums(testY)
+    precision = 1 / beta_scale ** 2
+
+    def objective(b):
+        lse = _logsumexp(b.reshape(1, -1))[0]
+        z = (b - beta_mean) / beta_scale
+        logp = np.sum(-0.5 * z ** 2 - np.log(beta_scale) -
+                      0.5 * np.log(2 * np.pi))
+        return -(logp + counts[1:] @ b - total * lse + log_norm), lse
+
+    def cv_error(b, lse):
+        probs = np.exp(np.append(0, b) - lse)
+        return _cv_error(holdout_count,
+                         np.broadcast_to(probs, (len(holdout_count),
+                                                 len(probs))),
+                         testY)
+
+    # log ratios of the pooled proportions, with a pseudocount
+    b = np.log(counts[1:] + 1) - np.log(counts[0] + 1)
+    f, lse = objective(b)
+    loss, cv, iter_n = [f], [cv_error(b, lse)], [0]
+    for i in range(1, maxiter + 1):
+        probs = np.exp(b - lse)
+        grad = -(counts[1:] - total * probs) + precision * (b - beta_mean)
+        # H = diag(a) - u u^T, with a = n p + 1 / s^2 and u = sqrt(n) p
+        a = total * probs + precision
+        u = np.sqrt(total) * probs
+        Ainv_g = grad / a
+        Ainv_u = u / a
+        step = Ainv_g + Ainv_u * (u @ Ainv_g) / (1 - u @ Ainv_u)
+
+        # the objective is convex, so halving the step always terminates
+        t = 1.
+        while True:
+            b_new = b - t * step
+            f_new, lse_new = objective(b_new)
+            if f_new <= f or t < 1e-10:
+                break
+            t /= 2
+        improved = f_new < f
+        b, f, lse = b_new, f_new, lse_new
+        loss.append(f)
+        cv.append(cv_error(b, lse))
+        iter_n.append(i)
+        if not improved or np.max(np.abs(t * step)) < tol:
+            break
+    return b.reshape(1, -1), np.array(loss), np.array(cv), np.array(iter_n)
+
+
+def _cv_error(holdout_count, probs, testY):
+    """ Mean absolute error of the predicted holdout counts. """
+    pred = holdout_count.reshape(-1, 1) * probs
+    if issparse(testY):
+        testY = testY.tocoo()
+        nz = pred[testY.row, testY.col]
+        total_error = (holdout_count.sum() - nz.sum() +
+                       np.abs(nz - testY.data).sum())
+        return total_error / np.prod(testY.shape)
+    return np.mean(np.abs(pred - testY))
+
+
+def _abs_error(holdout_count, probs, Y):
+    """ Total absolute error of the predicted counts of some features. """
+    pred = holdout_count.reshape(-1, 1) * probs
+    if issparse(Y):
+        Y = Y.tocoo()
+        nz = pred[Y.row, Y.col]
+        return pred.sum() - nz.sum() + np.abs(nz - Y.data).sum()
+    return np.abs(pred - Y).sum()
+
+
+def _row_sums(Y):
+    """ Row sums of a dense or sparse matrix as a flat array. """
+    return np.asarray(Y.sum(axis=1)).ravel()
+
+
+def _gammaln1p(Y):
+    """ Elementwise log(Y!) that keeps sparse matrices sparse. """
+    if issparse(Y):
+        Y = Y.copy()
+        Y.data = gammaln(Y.data + 1)
+        return Y
+    return gammaln(Y + 1)
+
+
+def _as_float(X):
+    """ Converts a dense or sparse matrix to float64, keeping it sparse. """
+    if issparse(X):
+        return X.tocsr().astype(np.float64)
+    return np.asarray(X, dtype=np.float64)
+
+
+def _xty(X, Y):
+    """ Computes X^T Y as a dense array for dense or sparse X and Y. """
+    if issparse(Y):
+        XtY = (Y.T @ X).T
+    else:
+        XtY = X.T @ Y
+    return XtY.toarray() if issparse(XtY) else np.asarray(XtY)
+
+
+def _logsumexp(eta):
+    """ Row-wise log-sum-exp of [0, eta]. """
+    m = np.maximum(eta.max(axis=1), 0)
+    return m + np.log(np.exp(-m) + np.exp(eta - m.reshape(-1, 1)).sum(axis=1))
+
+
+def _column_chunks(num_columns, chunk_size):
+    """ Slices of consecutive columns, `chunk_size` columns at a time. """
+    if chunk_size is None:
+        chunk_size = max(num_columns, 1)
+    return [slice(start, min(start + chunk_size, num_columns))
+            for start in range(0, num_columns, chunk_size)]
+
+
+def _chunked_logsumexp(X, B, chunk_size):
+    """ Row-wise log-sum-exp of [0, X B], a chunk of columns at a time.
+
+    The maximum and the sum of exponentials are updated after every chunk,
+    so only `chunk_size` columns of X B are held in memory.
+    """
+    m = np.zeros(X.shape[0])
+    total = np.ones(X.shape[0])
+    for cols in _column_chunks(B.shape[1], chunk_size):
+        eta = np.asarray(X @ B[:, cols])
+        new_m = np.maximum(m, eta.max(axis=1))
+        total = (total * np.exp(m - new_m) +
+                 np.exp(eta - new_m.reshape(-1, 1)).sum(axis=1))
+        m = new_m
+    return m + np.log(total)
@@ -41,14 +41,175 @@ DESCS = {
         'If False, progress bar and warnings are displayed. If True, neither '
         'progress bar nor warnings are displayed.'
     ),
+    "sparse": (
+        'Flag denoting whether to keep the table of counts in a sparse '
+        'representation during training. This reduces memory usage for '
+        'tables that are mostly zeros.'
+    ),
+    "sparse-design": (
+        'Flag denoting whether to build the design matrix in a sparse '
+        'representation. This reduces memory usage and speeds up training '
+        'for categorical covariates with many levels, such as subject ids '
+        'in longitudinal studies. This requires the formulaic package.'
+    ),
+    "solver": (
+        'Optimization method used to fit the model. "adam" performs '
+        'minibatch stochastic gradient descent, "lbfgs" performs full-batch '
+        'L-BFGS, which records the loss and cross validation error on every '
+        'iteration. For "lbfgs", `epochs` is the maximum number of '
+        'iterations.'
+    ),
+    "early-stopping": (
+        'Quantity monitored to stop training before all epochs are run. '
+        '"loss" and "cv" stop once the loss or the cross validation error '
+        'has not improved for `patience` consecutive summaries, "both" '
+        'waits until neither improves and "none" always runs all epochs.'
+    ),
+    "tolerance": (
+        'Minimum relative decrease of the monitored quantity that counts '
+        'as an improvement when early stopping.'
+    ),
+    "patience": (
+        'Number of consecutive summaries without improvement after which '
+        'training is stopped when early stopping.'
+    ),
+    "backend": (
+        'Library used to fit the model. "tensorflow" builds a TensorFlow '
+        'graph, "numpy" uses analytic gradients computed with NumPy and '
+        'does not require TensorFlow to be installed.'
+    ),
+    "steps-per-call": (
+        'Number of training iterations run inside TensorFlow per call '
+        'between summaries. Larger values reduce the per-iteration overhead '
+        'of small batches. Only used by the tensorflow backend with the adam '
+        'solver.'
+    ),
+    "cache-dir": (
+        'Directory used to cache the filtered and split training data. '
+        'Runs with the same table, metadata, formula, filters and split '
+        'reuse the cached data instead of preprocessing it again. Data is '
+        'only cached if a training column or a random seed is specified.'
+    ),
+    "init": (
+        'How the differentials are initialized. "random" draws them from a '
+        'standard normal distribution, "lstsq" starts from a least squares '
+        'fit of the covariates to the log ratios of the counts, which '
+        'usually needs far fewer epochs to converge.'
+    ),
+    "feature-chunk-size": (
+        'Number of features whose probabilities are computed at a time. '
+        'If not specified, all of the features are computed at once. For '
+        'tables with very many features, such as gene families, smaller '
+        'chunks bound the memory used per step at the cost of speed.'
+    ),
+    "init-differentials": (
+        'Differentials from a previous run, e.g. with fewer epochs or on a '
+        'subset of the samples, used to initialize the model instead of '
+        '`init`. They must cover all of the features and covariates.'
+    ),
+    "collapse-duplicates": (
+        'Flag denoting whether to merge training samples with identical '
+        'covariates by summing their counts before training. This gives the '
+        'same differentials, but is much faster when the formula only has '
+        'categorical covariates. The loss then differs by a constant from '
+        'the loss on the individual samples.'
+    ),
+    "stream": (
+        'Flag denoting whether to stream the training samples from the '
+        'BIOM table in chunks instead of loading the whole table into '
+        'memory. This requires a table in the HDF5 BIOM format, and the '
+        'adam solver with random initialization. Preprocessed data is not '
+        'cached.'
+    ),
+    "chunk-size": (
+        'Number of samples read from the BIOM table at a time when '
+        'streaming the training samples. Minibatches are drawn from within '
+        'each chunk, so larger chunks give better shuffled minibatches at '
+        'the cost of memory.'
+    ),
+    "processes": (
+        'Number of worker processes fitting models in parallel during a '
+        'parameter sweep.'
+    ),
+    "threads": (
+        'Maximum number of threads used by TensorFlow and by the linear '
+        'algebra libraries, e.g. when several jobs share a machine. During '
+        'a parameter sweep, this applies to each worker process. If not '
+        'specified, all of the available cores may be used.'
+    ),
+    "differentials": (
+        'Differentials of a fitted model, with one row per feature and one '
+        'column per column of the design matrix.'
+    ),
+    "prediction-chunk-size": (
+        'Number of samples predicted at a time. Tables in the HDF5 BIOM '
+        'format are read this many samples at a time, so memory does not '
+        'grow with the number of samples.'
+    ),
     # FYI: The following parameters are exclusive to the non-Q2 Songbird script
     "checkpoint-interval": 'Number of seconds before a saving a checkpoint.',
+    "histogram-interval": (
+        'Number of seconds before writing a histogram of the differentials '
+        'to Tensorboard. If not specified, no histograms are written.'
+    ),
+    "resume": (
+        'Flag denoting whether to continue from the latest checkpoint in '
+        'the summary directory, restoring the differentials, the state of '
+        'the optimizer and the iteration. Training stops after the total '
+        'number of epochs, so increase `epochs` to extend a finished run.'
+    ),
+    "profile": (
+        'Flag denoting whether to record a full execution trace of the '
+        'training step with every summary, for profiling in Tensorboard. '
+        'This slows down training and produces large summaries.'
+    ),
     "summary-dir": (
         'Summary directory to save regression results to. '
         'This will include a table of differentials under '
-        '`differentials.tsv` that can be ranked, in addition '
-        'to summaries that can be loaded into Tensorboard and '
-        'checkpoints for recovering parameters during runtime.'
+        '`differentials.tsv` that can be ranked, the loss and cross '
+        'validation error under `convergence_stats.tsv`, the formula and '
+        'the levels of its categorical covariates under `design.json` for '
+        '`songbird predict`, in addition to summaries that can be loaded '
+        'into Tensorboard and checkpoints for recovering parameters during '
+        'runtime.'
+    ),
+    "sweep-dir": (
+        'Directory to save the results of a parameter sweep to. Every '
+        'configuration gets a subdirectory with its `differentials.tsv`, '
+        '`convergence_stats.tsv` and `design.json`, and `sweep_summary.tsv` '
+        'ranks the configurations by their cross validation error.'
+    ),
+    "predict-formula": (
+        'The statistical formula the differentials were fitted with. If not '
+        'specified, it is read from the `design.json` written next to the '
+        'differentials by `songbird multinomial` or `songbird sweep`.'
+    ),
+    "output-dir": (
+        'Directory to save the predictions to, with one row per sample: '
+        'the predicted proportions of the features under '
+        '`predicted_proportions.tsv`, the predicted counts given the total '
+        'count of each sample under `predicted_counts.tsv`, and the mean '
+        'absolute error and log likelihood of the observed counts under '
+        '`prediction_errors.tsv`.'
+    ),
+    "socket": (
+        'Path of the Unix socket the worker listens on for jobs.'
+    ),
+    "serve-backend": (
+        'Backend loaded ahead of the first job, and used by the jobs that '
+        'do not specify one.'
+    ),
+    "max-jobs": (
+        'Number of jobs to run before the worker stops. If not specified, '
+        'the worker runs until it is sent `{"shutdown": true}`.'
+    ),
+    "jobs": (
+        'File of jobs to send to the worker, one JSON object per line, '
+        'whose keys are the options of `songbird multinomial`, e.g. '
+        '`{"input-biom": "table.biom", "metadata-file": "metadata.txt", '
+        '"formula": "Depth", "summary-dir": "results"}`. Relative paths '
+        'are resolved against the current directory. The outcome of each '
+        'job is printed as a JSON object.'
     ),
     "random-seed": (
         'The number to used to receive consistent results for the random  '
@@ -68,7 +229,31 @@ DEFAULTS = {
     'min-feature-count': 10,
     "checkpoint-interval": 3600,
     "summary-interval": 10,
+    "histogram-interval": None,
+    "profile": False,
+    "resume": False,
     "summary-dir": "summarydir",
     "random-seed": 0,
     "silent": False,
+    "sparse": False,
+    "sparse-design": False,
+    "solver": "adam",
+    "early-stopping": "none",
+    "tolerance": 1e-4,
+    "patience": 10,
+    "backend": "tensorflow",
+    "steps-per-call": 1,
+    "cache-dir": None,
+    "init": "random",
+    "feature-chunk-size": None,
+    "init-differentials": None,
+    "collapse-duplicates": False,
+    "stream": False,
+    "chunk-size": 1000,
+    "processes": 1,
+    "threads": None,
+    "sweep-dir": "sweepdir",
+    "prediction-chunk-size": 1000,
+    "output-dir": "predictions",
+    "max-jobs": None,
 }
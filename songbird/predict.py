@@ -0,0 +1,274 @@
+import json
+import re
+import h5py
+import numpy as np
+import pandas as pd
+from biom import Table
+from patsy import ModelDesc, design_matrix_builders
+from scipy.sparse import csr_matrix
+from songbird.stream import BiomStream, _read_ids
+from songbird.util import build_design, _formula_variables
+
+
+def save_design(filepath, formula, levels):
+    """ Stores the formula of a model and its categorical levels. """
+    with open(filepath, 'w') as f:
+        json.dump({'formula': formula, 'levels': levels}, f, indent=2)
+
+
+def load_design(filepath):
+    """ Loads a formula and its levels written by `save_design`.
+
+    Returns
+    -------
+    formula : str
+        Statistical formula specifying the design matrix.
+    levels : dict of list
+        Levels of the categorical covariates.
+    """
+    with open(filepath) as f:
+        design = json.load(f)
+    return design['formula'], design['levels']
+
+
+def differential_levels(formula, metadata, columns):
+    """ Recovers the levels of the categorical covariates of a model.
+
+    Parameters
+    ----------
+    formula : str
+        Statistical formula the model was trained with.
+    metadata : pd.DataFrame
+        Metadata of the new samples.
+    columns : list of str
+        Columns of the design matrix the model was trained with, such as
+        `C(x)[T.level]`.
+
+    Returns
+    -------
+    dict of list
+        Levels of each metadata column that the formula treats as
+        categorical, as expected by `predict_design`.
+
+    Notes
+    -----
+    The reference level of a covariate has no column of its own, so it is
+    the first level of the new samples without a column, if there is one.
+    Otherwise, none of the new samples are at the reference level, and a
+    placeholder is used in its place.
+    """
+    desc = ModelDesc.from_formula(formula)
+    design_info, = design_matrix_builders(
+        [desc.rhs_termlist], lambda: iter([metadata]), eval_env=0)
+    levels = {}
+    for factor, info in design_info.factor_infos.items():
+        if info.type != 'categorical':
+            continue
+        variables = _formula_variables(factor.code, metadata.columns)
+        if len(variables) != 1:
+            continue
+        pattern = re.compile(re.escape(factor.name()) + r'\[T\.(.*?)\]')
+        trained = []
+        for column in columns:
+            match = pattern.search(column)
+            if match and match.group(1) not in trained:
+                trained.append(match.group(1))
+        if len(trained) == 0:
+            continue
+        # the column names only give the levels as strings
+        observed = {str(level): level for level in info.categories}
+        reference = [level for name, level in observed.items()
+                     if name not in trained]
+        levels[variables[0]] = (reference[:1] or [object()]) + [
+            observed.get(name, name) for name in trained]
+    return levels
+
+
+def predict_design(formula, metadata, columns, levels=None):
+    """ Builds the design matrix of new samples.
+
+    Parameters
+    ----------
+    formula : str
+        Statistical formula the model was trained with.
+    metadata : pd.DataFrame
+        Metadata of the new samples.
+    columns : list of str
+        Columns of the design matrix the model was trained with.
+    levels : dict of list
+        Levels of the categorical covariates the model was trained with,
+        as returned by `songbird.util.design_levels`. These keep the
+        columns of the design matrix the same when the new samples only
+        have some of the levels, including when none of them are at the
+        reference level.
+
+    Returns
+    -------
+    pd.DataFrame
+        Design matrix with `columns`, without the samples that have
+        missing values.
+
+    Raises
+    ------
+    ValueError
+        If the new samples have levels, or give columns, that the model
+        wasn't trained with, or if the design matrix lacks some of
+        `columns`.
+    """
+    metadata = metadata.copy()
+    for name, values in (levels or {}).items():
+        if name not in metadata.columns:
+            continue
+        column = pd.Categorical(metadata[name], categories=values)
+        unseen = metadata[name].notna().values & pd.isna(column)
+        if unseen.any():
+            raise ValueError(
+                "Levels %s of %r were not seen in training"
+                % (sorted(map(str, set(metadata[name][unseen]))), name))
+        metadata[name] = column
+    design = build_design(formula, metadata)
+
+    extra = [c for c in design.columns if c not in set(columns)]
+    if len(extra) > 0 and np.any(design[extra].values != 0):
+        raise ValueError("The design matrix has columns %s that the model "
+                         "was not trained with" % extra)
+    # e.g. the new samples have another reference level, so the columns
+    # that are missing can't be filled with zeros
+    missing = [c for c in columns if c not in set(design.columns)]
+    if len(missing) > 0:
+        raise ValueError("The design matrix lacks columns %s that the "
+                         "model was trained with, pass the levels of its "
+                         "categorical covariates" % missing)
+    return design[list(columns)]
+
+
+def _table_ids(table):
+    """ Sample and feature ids of a table, or of an HDF5 BIOM file. """
+    if isinstance(table, Table):
+        return table.ids(axis='sample'), table.ids(axis='observation')
+    with h5py.File(table, 'r') as f:
+        return _read_ids(f, 'sample'), _read_ids(f, 'observation')
+
+
+def _count_chunks(table, sample_ids, feature_ids, chunk_size):
+    """ Yields the counts of consecutive chunks of samples.
+
+    The counts are CSR matrices with one column per feature of
+    `feature_ids`, which are zero for the features missing from the table.
+    Features of the table that aren't in `feature_ids` are left out.
+    """
+    table_features = _table_ids(table)[1]
+    columns = pd.Index(feature_ids).get_indexer(table_features)
+    present = table_features[columns >= 0]
+    columns = columns[columns >= 0]
+
+    if isinstance(table, Table):
+        table = table.filter(sample_ids, inplace=False).filter(
+            present, axis='observation', inplace=False)
+        table = table.sort_order(sample_ids).sort_order(
+            present, axis='observation')
+        counts = table.matrix_data.T.tocsr()
+
+        def read(rows):
+            return counts[rows]
+    else:
+        read = BiomStream(table, sample_ids, present, chunk_size).read
+
+    for start in range(0, len(sample_ids), chunk_size):
+        rows = np.arange(start, min(start + chunk_size, len(sample_ids)))
+        Y = read(rows)
+        yield csr_matrix((Y.data, columns[Y.indices], Y.indptr),
+                         shape=(len(rows), len(feature_ids)))
+
+
+def _softmax(eta):
+    """ Softmax of every row. """
+    eta = np.exp(eta - eta.max(axis=1, keepdims=True))
+    return eta / eta.sum(axis=1, keepdims=True)
+
+
+def predict(table, metadata, differentials, formula, levels=None,
+            chunk_size=1000):
+    """ Predicts the composition of new samples.
+
+    Parameters
+    ----------
+    table : biom.Table or str
+        Counts of the new samples, or the path to a table in the HDF5 BIOM
+        format, which is read `chunk_size` samples at a time.
+    metadata : pd.DataFrame
+        Metadata of the new samples.
+    differentials : pd.DataFrame
+        Fitted differentials, with one row per feature and one column per
+        column of the design matrix.
+    formula : str
+        Statistical formula the model was trained with.
+    levels : dict of list
+        Levels of the categorical covariates, see `predict_design`. If
+        None, they are recovered from the columns of `differentials` with
+        `differential_levels`.
+    chunk_size : int
+        Number of samples predicted at a time.
+
+    Yields
+    ------
+    proportions : pd.DataFrame
+        Predicted proportions of the features in a chunk of samples.
+    counts : pd.DataFrame
+        Predicted counts, given the total count of the modeled features
+        in each sample.
+    errors : pd.DataFrame
+        Observed `total-count` of the modeled features in each sample,
+        the mean absolute error of the predicted counts
+        (`cross-validation`), as in the convergence statistics, and the
+        multinomial `log-likelihood` of the observed counts, without the
+        terms that don't depend on the model.
+
+    Raises
+    ------
+    ValueError
+        If none of the samples have metadata, or if they have levels that
+        the model wasn't trained with.
+
+    Notes
+    -----
+    Only the samples of the table with metadata are predicted, in the
+    order of the table. Features of the table without differentials are
+    left out, and the features without counts in the table have none.
+    """
+    if chunk_size < 1:
+        raise ValueError('`chunk_size` must be at least 1, got %d'
+                         % chunk_size)
+    if levels is None:
+        levels = differential_levels(formula, metadata,
+                                     differentials.columns)
+    design = predict_design(formula, metadata, differentials.columns, levels)
+    sample_ids = _table_ids(table)[0]
+    sample_ids = sample_ids[design.index.get_indexer(sample_ids) >= 0]
+    if len(sample_ids) == 0:
+        raise ValueError("None of the samples of the table have metadata")
+    X = design.loc[sample_ids].values
+    B = differentials.values.T
+    feature_ids = differentials.index
+
+    start = 0
+    for Y in _count_chunks(table, sample_ids, feature_ids, chunk_size):
+        ids = pd.Index(sample_ids[start:start + Y.shape[0]], name='sampleid')
+        probs = _softmax(X[start:start + Y.shape[0]] @ B)
+        total = np.asarray(Y.sum(axis=1)).ravel()
+        pred = total.reshape(-1, 1) * probs
+
+        # the errors of the zero counts are their predicted counts
+        Y = Y.tocoo()
+        nz = pred[Y.row, Y.col]
+        abs_error = total - np.bincount(Y.row, nz - np.abs(nz - Y.data),
+                                        minlength=len(ids))
+        loglike = np.bincount(Y.row, Y.data * np.log(probs[Y.row, Y.col]),
+                              minlength=len(ids))
+        errors = pd.DataFrame({'total-count': total,
+                               'cross-validation': abs_error / len(B.T),
+                               'log-likelihood': loglike}, index=ids)
+        yield (pd.DataFrame(probs, index=ids, columns=feature_ids),
+               pd.DataFrame(pred, index=ids, columns=feature_ids),
+               errors)
+        start += len(ids)
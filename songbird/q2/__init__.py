@@ -1,8 +1,12 @@
-from ._stats import (SongbirdStats, SongbirdStatsDirFmt, SongbirdStatsFormat)
-from ._method import multinomial
+from ._stats import (SongbirdStats, SongbirdStatsDirFmt, SongbirdStatsFormat,
+                     PredictionErrors, PredictionErrorsDirFmt,
+                     PredictionErrorsFormat)
+from ._method import multinomial, multinomial_sweep, predict
 from ._summary import summarize_single, summarize_paired
 
 
-__all__ = ['multinomial', 'summarize_single', 'summarize_paired',
+__all__ = ['multinomial', 'multinomial_sweep', 'predict',
+           'summarize_single', 'summarize_paired',
            'SongbirdStats', 'SongbirdStatsFormat',
-           'SongbirdStatsDirFmt']
+           'SongbirdStatsDirFmt', 'PredictionErrors',
+           'PredictionErrorsFormat', 'PredictionErrorsDirFmt']
@@ -3,14 +3,80 @@ import qiime2
 import pandas as pd
 import numpy as np
 import biom
-import tensorflow as tf
-from skbio import OrdinationResults
-from songbird.multinomial import MultRegression
-from songbird.util import match_and_filter, split_training, silence_output
+from songbird.util import (match_and_filter, split_training, silence_output,
+                           convergence_table, is_intercept_only,
+                           alr_differentials, limit_threads,
+                           collapse_duplicates as _collapse_duplicates,
+                           regression_biplot as _regression_biplot)
+from songbird.cache import (cache_path, table_digest, metadata_digest,
+                            is_cached, load_preprocessed, save_preprocessed)
 from songbird.parameter_info import DEFAULTS
+from songbird.timing import PhaseTimer
+from songbird.predict import predict as _predict
 from qiime2.plugin import Metadata
 
 
+def _load_training_data(table, metadata, formula, training_column,
+                        num_random_test_examples, min_sample_count,
+                        min_feature_count, random_seed, sparse,
+                        sparse_design, cache_dir, timer=None):
+    """ Matches, filters and splits the inputs, or loads them from cache. """
+    if timer is None:
+        timer = PhaseTimer()
+    with timer.phase('read_metadata'):
+        metadata = metadata.to_dataframe()
+
+    path = None
+    if cache_dir is not None:
+        path = cache_path(
+            cache_dir,
+            table=table_digest(table),
+            metadata=metadata_digest(metadata),
+            formula=formula,
+            training_column=training_column,
+            num_random_test_examples=num_random_test_examples,
+            min_sample_count=min_sample_count,
+            min_feature_count=min_feature_count,
+            random_seed=random_seed,
+            sparse_design=sparse_design,
+        )
+
+    if is_cached(path):
+        with timer.phase('load_cache'):
+            trainX, testX, trainY, testY, md_ids, obs_ids, _ = \
+                load_preprocessed(path, sparse)
+    else:
+        # match them
+        with timer.phase('match_and_filter'):
+            table, metadata, design = match_and_filter(
+                table, metadata,
+                formula, min_sample_count, min_feature_count, sparse_design
+            )
+
+        # convert to a samples x features representation
+        with timer.phase('densify'):
+            if sparse:
+                counts = table.matrix_data.T.tocsr()
+            else:
+                counts = table.to_dataframe().to_dense().T
+
+        # split up training and testing
+        with timer.phase('split'):
+            trainX, testX, trainY, testY = split_training(
+                counts, metadata, design,
+                training_column, num_random_test_examples,
+                seed=random_seed,
+            )
+
+        md_ids = np.array(design.columns)
+        obs_ids = table.ids(axis='observation')
+        if path is not None:
+            with timer.phase('save_cache'):
+                save_preprocessed(path, trainX, testX, trainY, testY,
+                                  md_ids, obs_ids)
+    return trainX, testX, trainY, testY, md_ids, obs_ids
+
+
 def multinomial(table: biom.Table,
                 metadata: Metadata,
                 formula: str,
@@ -28,48 +94,91 @@ def multinomial(table: biom.Table,
                 summary_interval: int = DEFAULTS["summary-interval"],
                 random_seed: int = DEFAULTS["random-seed"],
                 silent: bool = DEFAULTS["silent"],
+                sparse: bool = DEFAULTS["sparse"],
+                sparse_design: bool = DEFAULTS["sparse-design"],
+                solver: str = DEFAULTS["solver"],
+                early_stopping: str = DEFAULTS["early-stopping"],
+                tolerance: float = DEFAULTS["tolerance"],
+                patience: int = DEFAULTS["patience"],
+                backend: str = DEFAULTS["backend"],
+                init: str = DEFAULTS["init"],
+                feature_chunk_size: int = DEFAULTS["feature-chunk-size"],
+                steps_per_call: int = DEFAULTS["steps-per-call"],
+                cache_dir: str = DEFAULTS["cache-dir"],
+                collapse_duplicates: bool = DEFAULTS["collapse-duplicates"],
+                threads: int = DEFAULTS["threads"],
+                init_differentials: pd.DataFrame = None,
                 ) -> (
                     pd.DataFrame, qiime2.Metadata, skbio.OrdinationResults
                 ):
-
-    if silent:
-        silence_output()
+    limit_threads(threads)
 
     # load metadata and tables
-    metadata = metadata.to_dataframe()
-    # match them
-    table, metadata, design = match_and_filter(
-        table, metadata,
-        formula, min_sample_count, min_feature_count
-    )
+    timer = PhaseTimer()
+    trainX, testX, trainY, testY, md_ids, obs_ids = _load_training_data(
+        table, metadata, formula, training_column, num_random_test_examples,
+        min_sample_count, min_feature_count, random_seed, sparse,
+        sparse_design, cache_dir, timer=timer)
 
-    # convert to dense representation
-    dense_table = table.to_dataframe().to_dense().T
+    # epochs are counted in samples, even once they are collapsed
+    num_samples = trainX.shape[0]
+    if collapse_duplicates:
+        with timer.phase('collapse_duplicates'):
+            trainX, trainY = _collapse_duplicates(trainX, trainY)
 
-    # split up training and testing
-    trainX, testX, trainY, testY = split_training(
-        dense_table, metadata, design,
-        training_column, num_random_test_examples,
-        seed=random_seed,
-    )
+    if init_differentials is not None:
+        # warm start from a previous run
+        init = alr_differentials(init_differentials, md_ids, obs_ids)
+
+    fit_kwargs = dict(
+        epochs=epochs,
+        summary_interval=summary_interval,
+        checkpoint_interval=None,
+        silent=silent,
+        early_stopping=(None if early_stopping == 'none'
+                        else early_stopping),
+        tolerance=tolerance,
+        patience=patience)
 
-    model = MultRegression(learning_rate=learning_rate, clipnorm=clipnorm,
-                           beta_mean=differential_prior,
-                           batch_size=batch_size,
-                           save_path=None)
+    # the intercept-only baseline is fitted directly without TensorFlow
+    if backend == 'numpy' or is_intercept_only(trainX):
+        from songbird.numpy_backend import NumpyMultRegression
 
-    with tf.Graph().as_default(), tf.Session() as session:
-        tf.set_random_seed(random_seed)
-        model(session, trainX, trainY, testX, testY)
+        model = NumpyMultRegression(learning_rate=learning_rate,
+                                    clipnorm=clipnorm,
+                                    beta_mean=differential_prior,
+                                    batch_size=batch_size,
+                                    save_path=None, solver=solver,
+                                    init=init, random_state=random_seed,
+                                    feature_chunk_size=feature_chunk_size)
+        with timer.phase('build'):
+            model(None, trainX, trainY, testX, testY, num_samples)
+        with timer.phase('train'):
+            loss, cv, its = model.fit(**fit_kwargs)
+    else:
+        if silent:
+            silence_output()
+        import tensorflow as tf
+        from songbird.multinomial import MultRegression, session_config
+
+        model = MultRegression(learning_rate=learning_rate,
+                               clipnorm=clipnorm,
+                               beta_mean=differential_prior,
+                               batch_size=batch_size,
+                               save_path=None, solver=solver,
+                               init=init,
+                               feature_chunk_size=feature_chunk_size)
 
-        loss, cv, its = model.fit(
-            epochs=epochs,
-            summary_interval=summary_interval,
-            checkpoint_interval=None,
-            silent=silent)
+        config = session_config(threads)
+        with tf.Graph().as_default(), tf.Session(config=config) as session:
+            tf.set_random_seed(random_seed)
+            with timer.phase('build'):
+                model(session, trainX, trainY, testX, testY, num_samples)
 
-    md_ids = np.array(design.columns)
-    obs_ids = table.ids(axis='observation')
+            with timer.phase('train'):
+                loss, cv, its = model.fit(steps_per_call=steps_per_call,
+                                          **fit_kwargs)
+    timer.record_training(model)
 
     beta_ = np.hstack((np.zeros((model.p, 1)), model.B))
     beta_ = beta_ - beta_.mean(axis=1).reshape(-1, 1)
@@ -79,44 +188,107 @@ def multinomial(table: biom.Table,
     )
     differentials.index.name = 'featureid'
 
-    convergence_stats = pd.DataFrame(
-        {
-            'loss': loss,
-            'cross-validation': cv,
-            'iteration': its
-        }
+    with timer.phase('biplot'):
+        biplot = _regression_biplot(differentials)
+
+    convergence_stats = convergence_table(loss, cv, its, model.stop_reason,
+                                          elapsed=model.summary_times)
+    # the timings describe the whole run, so they are only stored on the
+    # last row, which records where training stopped
+    for name, value in timer.columns().items():
+        convergence_stats[name] = np.nan
+        convergence_stats.loc[convergence_stats.index[-1], name] = value
+
+    return differentials, qiime2.Metadata(convergence_stats), biplot
+
+
+def multinomial_sweep(table: biom.Table,
+                      metadata: Metadata,
+                      formula: str,
+                      differential_prior: list,
+                      learning_rate: list,
+                      batch_size: list,
+                      training_column: str = DEFAULTS["training-column"],
+                      num_random_test_examples: int = (
+                          DEFAULTS["num-random-test-examples"]
+                      ),
+                      epochs: int = DEFAULTS["epochs"],
+                      clipnorm: float = DEFAULTS["clipnorm"],
+                      min_sample_count: int = DEFAULTS["min-sample-count"],
+                      min_feature_count: int = DEFAULTS["min-feature-count"],
+                      summary_interval: int = DEFAULTS["summary-interval"],
+                      random_seed: int = DEFAULTS["random-seed"],
+                      silent: bool = DEFAULTS["silent"],
+                      sparse: bool = DEFAULTS["sparse"],
+                      sparse_design: bool = DEFAULTS["sparse-design"],
+                      solver: str = DEFAULTS["solver"],
+                      early_stopping: str = DEFAULTS["early-stopping"],
+                      tolerance: float = DEFAULTS["tolerance"],
+                      patience: int = DEFAULTS["patience"],
+                      backend: str = DEFAULTS["backend"],
+                      init: str = DEFAULTS["init"],
+                      feature_chunk_size: int = DEFAULTS["feature-chunk-size"],
+                      processes: int = DEFAULTS["processes"],
+                      threads: int = DEFAULTS["threads"],
+                      cache_dir: str = DEFAULTS["cache-dir"],
+                      ) -> (
+                          pd.DataFrame, qiime2.Metadata,
+                          skbio.OrdinationResults
+                      ):
+    from songbird.sweep import sweep, rank_configurations, config_names
+
+    if silent and backend == 'tensorflow':
+        silence_output()
+
+    trainX, testX, trainY, testY, md_ids, obs_ids = _load_training_data(
+        table, metadata, formula, training_column, num_random_test_examples,
+        min_sample_count, min_feature_count, random_seed, sparse,
+        sparse_design, cache_dir)
+
+    grid = {'differential_prior': list(differential_prior),
+            'learning_rate': list(learning_rate),
+            'batch_size': list(batch_size)}
+    configs, results = sweep(
+        trainX, testX, trainY, testY, grid,
+        processes=processes, threads=threads, silent=silent,
+        clipnorm=clipnorm, epochs=epochs,
+        summary_interval=summary_interval, solver=solver,
+        early_stopping=(None if early_stopping == 'none'
+                        else early_stopping),
+        tolerance=tolerance, patience=patience,
+        backend=backend, init=init, feature_chunk_size=feature_chunk_size,
+        random_seed=random_seed)
+
+    # only the configuration with the lowest cross validation error is kept
+    summary = rank_configurations(configs, results)
+    best = config_names(len(configs)).index(summary.index[0])
+    beta_, loss, cv, its, stop_reason = results[best]
+
+    differentials = pd.DataFrame(
+        beta_.T, columns=md_ids, index=obs_ids,
     )
+    differentials.index.name = 'featureid'
 
-    convergence_stats.index.name = 'id'
-    convergence_stats.index = convergence_stats.index.astype(np.str)
-
-    c = convergence_stats['loss'].astype(np.float)
-    convergence_stats['loss'] = c
-
-    c = convergence_stats['cross-validation'].astype(np.float)
-    convergence_stats['cross-validation'] = c
-
-    c = convergence_stats['iteration'].astype(np.int)
-    convergence_stats['iteration'] = c
-
-    # regression biplot
-    if differentials.shape[-1] > 1:
-        u, s, v = np.linalg.svd(differentials)
-        pc_ids = ['PC%d' % i for i in range(len(s))]
-        samples = pd.DataFrame(u[:, :len(s)] @ np.diag(s),
-                               columns=pc_ids, index=differentials.index)
-        features = pd.DataFrame(v.T[:, :len(s)],
-                                columns=pc_ids, index=differentials.columns)
-        short_method_name = 'regression_biplot'
-        long_method_name = 'Multinomial regression biplot'
-        eigvals = pd.Series(s, index=pc_ids)
-        proportion_explained = eigvals**2 / (eigvals**2).sum()
-        biplot = OrdinationResults(
-            short_method_name, long_method_name, eigvals,
-            samples=samples, features=features,
-            proportion_explained=proportion_explained)
-    else:
-        # this is to handle the edge case with only intercepts
-        biplot = OrdinationResults('', '', pd.Series(), pd.DataFrame())
+    convergence_stats = convergence_table(loss, cv, its, stop_reason)
+    for name, value in configs[best].items():
+        convergence_stats[name.replace('_', '-')] = value
+
+    biplot = _regression_biplot(differentials)
 
     return differentials, qiime2.Metadata(convergence_stats), biplot
+
+
+def predict(table: biom.Table,
+            metadata: Metadata,
+            differentials: pd.DataFrame,
+            formula: str,
+            chunk_size: int = DEFAULTS["prediction-chunk-size"],
+            ) -> (biom.Table, biom.Table, qiime2.Metadata):
+    chunks = list(_predict(table, metadata.to_dataframe(), differentials,
+                           formula, chunk_size=chunk_size))
+    proportions, counts, errors = [pd.concat(dfs) for dfs in zip(*chunks)]
+    sample_ids = list(proportions.index)
+    feature_ids = list(proportions.columns)
+    return (biom.Table(proportions.values.T, feature_ids, sample_ids),
+            biom.Table(counts.values.T, feature_ids, sample_ids),
+            qiime2.Metadata(errors))
@@ -14,3 +14,17 @@ class SongbirdStatsFormat(model.TextFileFormat):
 
 SongbirdStatsDirFmt = model.SingleFileDirectoryFormat(
     'SongbirdStatsDirFmt', 'stats.tsv', SongbirdStatsFormat)
+
+
+# errors of the predictions of a fitted model on each sample
+PredictionErrors = SemanticType('PredictionErrors',
+                                variant_of=SampleData.field['type'])
+
+
+class PredictionErrorsFormat(model.TextFileFormat):
+    def validate(*args):
+        pass
+
+
+PredictionErrorsDirFmt = model.SingleFileDirectoryFormat(
+    'PredictionErrorsDirFmt', 'errors.tsv', PredictionErrorsFormat)
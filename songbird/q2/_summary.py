@@ -106,6 +106,12 @@ def _summarize(output_dir: str, regression: pd.DataFrame,
             '<a href="https://github.com/biocore/songbird#adjusting-parameters">this section</a> '  # noqa
             "of the Songbird README.</p>"
         )
+        if 'stop-reason' in regression.columns:
+            index_f.write(
+                '<p><strong>Stopped:</strong> %s at iteration %d</p>\n' % (
+                    regression['stop-reason'].iloc[-1],
+                    regression['iteration'].iloc[-1])
+            )
         if q2 is not None:
             index_f.write(
                 '<p><strong>'
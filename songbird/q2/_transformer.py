@@ -1,5 +1,5 @@
 import qiime2
-from songbird.q2 import SongbirdStatsFormat
+from songbird.q2 import SongbirdStatsFormat, PredictionErrorsFormat
 from songbird.q2.plugin_setup import plugin
 
 
@@ -13,3 +13,15 @@ def _2(obj: qiime2.Metadata) -> SongbirdStatsFormat:
     ff = SongbirdStatsFormat()
     obj.save(str(ff))
     return ff
+
+
+@plugin.register_transformer
+def _3(ff: PredictionErrorsFormat) -> qiime2.Metadata:
+    return qiime2.Metadata.load(str(ff))
+
+
+@plugin.register_transformer
+def _4(obj: qiime2.Metadata) -> PredictionErrorsFormat:
+    ff = PredictionErrorsFormat()
+    obj.save(str(ff))
+    return ff
@@ -10,14 +10,17 @@ import qiime2.plugin
 import qiime2.sdk
 from songbird import __version__
 
-from qiime2.plugin import (Str, Properties, Int, Float,  Metadata, Bool)
-from q2_types.feature_table import FeatureTable, Frequency
+from qiime2.plugin import (Str, Properties, Int, Float,  Metadata, Bool,
+                           Choices, List)
+from q2_types.feature_table import FeatureTable, Frequency, RelativeFrequency
 from q2_types.ordination import PCoAResults
 from q2_types.sample_data import SampleData
 from q2_types.feature_data import (FeatureData, Differential)
 from songbird.q2 import (
     SongbirdStats, SongbirdStatsFormat, SongbirdStatsDirFmt,
-    multinomial, summarize_single, summarize_paired
+    PredictionErrors, PredictionErrorsFormat, PredictionErrorsDirFmt,
+    multinomial, multinomial_sweep, predict, summarize_single,
+    summarize_paired
 )
 from songbird.parameter_info import DESCS
 
@@ -36,7 +39,8 @@ plugin = qiime2.plugin.Plugin(
 
 plugin.methods.register_function(
     function=multinomial,
-    inputs={'table': FeatureTable[Frequency]},
+    inputs={'table': FeatureTable[Frequency],
+            'init_differentials': FeatureData[Differential]},
     parameters={
         'metadata': Metadata,
         'formula': Str,
@@ -52,6 +56,19 @@ plugin.methods.register_function(
         'summary_interval': Float,
         'random_seed': Int,
         'silent': Bool,
+        'sparse': Bool,
+        'sparse_design': Bool,
+        'solver': Str % Choices(['adam', 'lbfgs']),
+        'early_stopping': Str % Choices(['none', 'loss', 'cv', 'both']),
+        'tolerance': Float,
+        'patience': Int,
+        'backend': Str % Choices(['tensorflow', 'numpy']),
+        'init': Str % Choices(['random', 'lstsq']),
+        'feature_chunk_size': Int,
+        'steps_per_call': Int,
+        'cache_dir': Str,
+        'collapse_duplicates': Bool,
+        'threads': Int,
     },
     outputs=[
         ('differentials', FeatureData[Differential]),
@@ -60,6 +77,7 @@ plugin.methods.register_function(
     ],
     input_descriptions={
         'table': DESCS["table"],
+        'init_differentials': DESCS["init-differentials"],
     },
     output_descriptions={
         'differentials': ('Output differentials learned from the '
@@ -85,6 +103,19 @@ plugin.methods.register_function(
         "silent": (DESCS["silent"] + " (Only has an impact when using this "
                    "command with the --verbose option or through the Qiime2 "
                    "Artifact API)"),
+        "sparse": DESCS["sparse"],
+        "sparse_design": DESCS["sparse-design"],
+        "solver": DESCS["solver"],
+        "early_stopping": DESCS["early-stopping"],
+        "tolerance": DESCS["tolerance"],
+        "patience": DESCS["patience"],
+        "backend": DESCS["backend"],
+        "init": DESCS["init"],
+        "feature_chunk_size": DESCS["feature-chunk-size"],
+        "steps_per_call": DESCS["steps-per-call"],
+        "cache_dir": DESCS["cache-dir"],
+        "collapse_duplicates": DESCS["collapse-duplicates"],
+        "threads": DESCS["threads"],
     },
     name='Multinomial regression',
     description=("Performs multinomial regression and calculates "
@@ -93,6 +124,131 @@ plugin.methods.register_function(
     citations=[]
 )
 
+plugin.methods.register_function(
+    function=multinomial_sweep,
+    inputs={'table': FeatureTable[Frequency]},
+    parameters={
+        'metadata': Metadata,
+        'formula': Str,
+        'differential_prior': List[Float],
+        'learning_rate': List[Float],
+        'batch_size': List[Int],
+        'training_column': Str,
+        'num_random_test_examples': Int,
+        'epochs': Int,
+        'clipnorm': Float,
+        'min_sample_count': Int,
+        'min_feature_count': Int,
+        'summary_interval': Float,
+        'random_seed': Int,
+        'silent': Bool,
+        'sparse': Bool,
+        'sparse_design': Bool,
+        'solver': Str % Choices(['adam', 'lbfgs']),
+        'early_stopping': Str % Choices(['none', 'loss', 'cv', 'both']),
+        'tolerance': Float,
+        'patience': Int,
+        'backend': Str % Choices(['tensorflow', 'numpy']),
+        'init': Str % Choices(['random', 'lstsq']),
+        'feature_chunk_size': Int,
+        'processes': Int,
+        'threads': Int,
+        'cache_dir': Str,
+    },
+    outputs=[
+        ('differentials', FeatureData[Differential]),
+        ('regression_stats', SampleData[SongbirdStats]),
+        ('regression_biplot', PCoAResults % Properties('biplot'))
+    ],
+    input_descriptions={
+        'table': DESCS["table"],
+    },
+    output_descriptions={
+        'differentials': ('Output differentials learned by the '
+                          'configuration with the lowest cross validation '
+                          'error.'),
+        'regression_stats': ('Summary information about the loss '
+                             'and cross validation error over iterations '
+                             'of the best configuration, together with its '
+                             'parameters.'),
+        'regression_biplot': ('A biplot of the regression coefficients of '
+                              'the best configuration')
+    },
+    parameter_descriptions={
+        'metadata': DESCS["metadata"],
+        'formula': DESCS["formula"],
+        'differential_prior': (DESCS["differential-prior"] +
+                               ' Every value is tried.'),
+        'learning_rate': DESCS["learning-rate"] + ' Every value is tried.',
+        'batch_size': DESCS["batch-size"] + ' Every value is tried.',
+        "training_column": DESCS["training-column"],
+        'num_random_test_examples': DESCS["num-random-test-examples"],
+        'epochs': DESCS["epochs"],
+        "clipnorm": DESCS["clipnorm"],
+        "min_sample_count": DESCS["min-sample-count"],
+        "min_feature_count": DESCS["min-feature-count"],
+        "summary_interval": DESCS["summary-interval"],
+        "random_seed": DESCS["random-seed"],
+        "silent": DESCS["silent"],
+        "sparse": DESCS["sparse"],
+        "sparse_design": DESCS["sparse-design"],
+        "solver": DESCS["solver"],
+        "early_stopping": DESCS["early-stopping"],
+        "tolerance": DESCS["tolerance"],
+        "patience": DESCS["patience"],
+        "backend": DESCS["backend"],
+        "init": DESCS["init"],
+        "feature_chunk_size": DESCS["feature-chunk-size"],
+        "processes": DESCS["processes"],
+        "threads": DESCS["threads"],
+        "cache_dir": DESCS["cache-dir"],
+    },
+    name='Multinomial regression parameter sweep',
+    description=("Performs multinomial regression for every combination of "
+                 "the given differential priors, learning rates and batch "
+                 "sizes in parallel, and keeps the model with the lowest "
+                 "cross validation error."),
+    citations=[]
+)
+
+plugin.methods.register_function(
+    function=predict,
+    inputs={'table': FeatureTable[Frequency],
+            'differentials': FeatureData[Differential]},
+    parameters={
+        'metadata': Metadata,
+        'formula': Str,
+        'chunk_size': Int,
+    },
+    outputs=[
+        ('predicted_proportions', FeatureTable[RelativeFrequency]),
+        ('predicted_counts', FeatureTable[Frequency]),
+        ('prediction_errors', SampleData[PredictionErrors])
+    ],
+    input_descriptions={
+        'table': 'Counts of the samples to predict.',
+        'differentials': DESCS["differentials"],
+    },
+    output_descriptions={
+        'predicted_proportions': 'Predicted proportions of the features.',
+        'predicted_counts': ('Predicted counts of the features, given the '
+                             'total count of each sample.'),
+        'prediction_errors': ('Mean absolute error and log likelihood of '
+                              'the observed counts of each sample.'),
+    },
+    parameter_descriptions={
+        'metadata': 'Sample metadata with the covariates of the formula.',
+        'formula': ('The statistical formula the differentials were fitted '
+                    'with.'),
+        'chunk_size': DESCS["prediction-chunk-size"],
+    },
+    name='Predict new samples',
+    description=("Predicts the composition of new samples from the "
+                 "differentials of a multinomial regression, and scores "
+                 "the predictions against their observed counts."),
+    citations=[]
+)
+
 plugin.visualizers.register_function(
     function=summarize_single,
     inputs={
@@ -148,5 +304,9 @@ plugin.register_formats(SongbirdStatsFormat, SongbirdStatsDirFmt)
 plugin.register_semantic_types(SongbirdStats)
 plugin.register_semantic_type_to_format(
     SampleData[SongbirdStats], SongbirdStatsDirFmt)
+plugin.register_formats(PredictionErrorsFormat, PredictionErrorsDirFmt)
+plugin.register_semantic_types(PredictionErrors)
+plugin.register_semantic_type_to_format(
+    SampleData[PredictionErrors], PredictionErrorsDirFmt)
 
 importlib.import_module('songbird.q2._transformer')
@@ -4,8 +4,8 @@ import numpy as np
 import contextlib
 import io
 import tensorflow as tf
-from songbird.q2._method import multinomial
-from songbird.util import random_multinomial_model
+from songbird.q2._method import multinomial, multinomial_sweep, predict
+from songbird.util import random_multinomial_model, build_design
 
 from skbio import OrdinationResults
 from skbio.stats.composition import clr, clr_inv
@@ -68,6 +68,104 @@ class TestMultinomial(unittest.TestCase):
         npt.assert_allclose(exp_beta, res_beta.T, atol=0.6, rtol=0.6)
         self.assertGreater(len(res_stats.to_dataframe().index), 1)
 
+    def test_fit_lbfgs(self):
+        md = self.md
+
+        md.name = 'sampleid'
+        md = qiime2.Metadata(md)
+
+        exp_beta = clr(clr_inv(np.hstack((np.zeros((2, 1)), self.beta.T))))
+
+        res_beta, res_stats, res_biplot = multinomial(
+            table=self.table, metadata=md,
+            min_sample_count=0, min_feature_count=0,
+            formula="X", epochs=1000, solver='lbfgs')
+
+        npt.assert_allclose(exp_beta, res_beta.T, atol=0.6, rtol=0.6)
+        self.assertGreater(len(res_stats.to_dataframe().index), 1)
+
+    def test_fit_early_stopping(self):
+        md = self.md
+
+        md.name = 'sampleid'
+        md = qiime2.Metadata(md)
+
+        res_beta, res_stats, res_biplot = multinomial(
+            table=self.table, metadata=md,
+            min_sample_count=0, min_feature_count=0,
+            formula="X", epochs=1000, summary_interval=0,
+            learning_rate=1e-1, early_stopping='loss',
+            tolerance=1e-2, patience=50)
+
+        stats = res_stats.to_dataframe()
+        self.assertTrue((stats['stop-reason'] == 'loss-converged').all())
+        self.assertLess(stats['iteration'].iloc[-1], (195 // 5) * 1000 - 1)
+
+    def test_fit_numpy(self):
+        md = self.md
+
+        md.name = 'sampleid'
+        md = qiime2.Metadata(md)
+
+        exp_beta = clr(clr_inv(np.hstack((np.zeros((2, 1)), self.beta.T))))
+
+        res_beta, res_stats, res_biplot = multinomial(
+            table=self.table, metadata=md,
+            min_sample_count=0, min_feature_count=0,
+            formula="X", epochs=1000, backend='numpy')
+
+        npt.assert_allclose(exp_beta, res_beta.T, atol=0.6, rtol=0.6)
+        stats = res_stats.to_dataframe()
+        self.assertGreater(len(stats.index), 1)
+        self.assertTrue(np.all(np.diff(stats['elapsed-time']) >= 0))
+        # the timings of the run are only stored on the last row
+        timings = ['match-and-filter-wall-time', 'build-wall-time',
+                   'train-wall-time', 'biplot-wall-time', 'steps-per-second']
+        self.assertTrue(stats[timings].iloc[:-1].isnull().all().all())
+        self.assertTrue((stats[timings].iloc[-1] >= 0).all())
+        self.assertGreater(stats['steps-per-second'].iloc[-1], 0)
+
+    def test_fit_intercept(self):
+        md = self.md
+
+        md.name = 'sampleid'
+        md = qiime2.Metadata(md)
+
+        res_beta, res_stats, res_biplot = multinomial(
+            table=self.table, metadata=md,
+            min_sample_count=0, min_feature_count=0,
+            formula="1", epochs=1000)
+
+        stats = res_stats.to_dataframe()
+        self.assertEqual(list(res_beta.columns), ['Intercept'])
+        self.assertGreater(len(stats.index), 1)
+        self.assertTrue((stats['stop-reason'] == 'intercept-only').all())
+
+    def test_sweep(self):
+        md = self.md
+
+        md.name = 'sampleid'
+        md = qiime2.Metadata(md)
+
+        res_beta, res_stats, res_biplot = multinomial_sweep(
+            table=self.table, metadata=md,
+            min_sample_count=0, min_feature_count=0,
+            formula="X", epochs=100, backend='numpy',
+            differential_prior=[0.5, 1.], learning_rate=[1e-3, 1e-1],
+            batch_size=[5], processes=2, threads=1)
+
+        exp_beta, exp_stats, _ = multinomial(
+            table=self.table, metadata=md,
+            min_sample_count=0, min_feature_count=0,
+            formula="X", epochs=100, backend='numpy',
+            differential_prior=res_stats.get_column(
+                'differential-prior').to_series().iloc[0],
+            learning_rate=res_stats.get_column(
+                'learning-rate').to_series().iloc[0])
+
+        npt.assert_allclose(exp_beta, res_beta)
+        self.assertIsInstance(res_biplot, OrdinationResults)
+
     def test_silent(self):
         f = self._silent_helper(silent=True)
         assert f.getvalue() == ""
@@ -93,8 +191,10 @@ class TestMultinomial(unittest.TestCase):
             formula="X", epochs=1000)
 
         npt.assert_array_equal(res_beta1, res_beta2)
-        end_res_stats1 = res_stats1.to_dataframe().iloc[-1]
-        end_res_stats2 = res_stats2.to_dataframe().iloc[-1]
+        # the timings differ from one run to the next
+        columns = ['loss', 'cross-validation', 'iteration', 'stop-reason']
+        end_res_stats1 = res_stats1.to_dataframe()[columns].iloc[-1]
+        end_res_stats2 = res_stats2.to_dataframe()[columns].iloc[-1]
         npt.assert_array_equal(end_res_stats1, end_res_stats2)
         npt.assert_array_equal(res_biplot1.eigvals, res_biplot2.eigvals)
         npt.assert_array_equal(res_biplot1.samples, res_biplot2.samples)
@@ -147,6 +247,52 @@ class TestMultinomial(unittest.TestCase):
         npt.assert_allclose(exp_beta, res_beta.T, atol=0.6, rtol=0.6)
         self.assertGreater(len(res_stats.to_dataframe().index), 1)
 
+    def test_predict(self):
+        md = self.md
+
+        md.name = 'sampleid'
+        md = qiime2.Metadata(md)
+
+        res_beta, _, _ = multinomial(
+            table=self.table, metadata=md,
+            min_sample_count=0, min_feature_count=0,
+            formula="X", epochs=100, backend='numpy')
+        proportions, counts, errors = predict(
+            table=self.table, metadata=md, differentials=res_beta,
+            formula="X", chunk_size=30)
+
+        X = np.hstack((np.ones((200, 1)), self.md[['X']].values))
+        exp = clr_inv(X @ res_beta.values.T)
+        npt.assert_allclose(proportions.matrix_data.T.toarray(), exp)
+        npt.assert_allclose(counts.sum(axis='sample'),
+                            self.table.sum(axis='sample'))
+        errors = errors.to_dataframe()
+        self.assertEqual(list(errors.columns),
+                         ['total-count', 'cross-validation',
+                          'log-likelihood'])
+        self.assertEqual(len(errors.index), 200)
+
+    def test_predict_levels(self):
+        md = self.md.copy()
+        md['G'] = np.array(['a', 'b', 'c'])[np.arange(200) % 3]
+        md.name = 'sampleid'
+
+        res_beta, _, _ = multinomial(
+            table=self.table, metadata=qiime2.Metadata(md),
+            min_sample_count=0, min_feature_count=0,
+            formula="X + C(G)", epochs=100, backend='numpy')
+
+        # none of the new samples are at the reference level 'a'
+        new_md = md.loc[md['G'] != 'a']
+        proportions, _, _ = predict(
+            table=self.table, metadata=qiime2.Metadata(new_md),
+            differentials=res_beta, formula="X + C(G)")
+
+        X = build_design("X + C(G)", md).loc[new_md.index]
+        exp = clr_inv(X[res_beta.columns].values @ res_beta.values.T)
+        self.assertEqual(list(proportions.ids()), list(new_md.index))
+        npt.assert_allclose(proportions.matrix_data.T.toarray(), exp)
+
 
 if __name__ == "__main__":
     unittest.main()
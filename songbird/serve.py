@@ -0,0 +1,188 @@
+import json
+import os
+import socket
+import stat
+import time
+
+
+def warm_up(backend='tensorflow', threads=None):
+    """ Loads the libraries used to fit models ahead of the first job.
+
+    Parameters
+    ----------
+    backend : str
+        Either 'tensorflow' or 'numpy'.
+    threads : int
+        Maximum number of threads used by TensorFlow. If None, TensorFlow
+        picks the number of threads itself.
+
+    Returns
+    -------
+    float
+        Number of seconds it took.
+
+    Notes
+    -----
+    With TensorFlow, this also runs a session once, so that the devices
+    and thread pools are set up before the first job.
+    """
+    start = time.perf_counter()
+    if backend == 'numpy':
+        import songbird.numpy_backend  # noqa: F401
+    else:
+        import tensorflow as tf
+        from tensorboard.plugins.hparams import api  # noqa: F401
+        from songbird.multinomial import session_config
+
+        with tf.Graph().as_default(), \
+                tf.Session(config=session_config(threads)) as session:
+            session.run(tf.constant(0))
+    return time.perf_counter() - start
+
+
+def _remove_stale_socket(socket_path):
+    """ Removes a socket left behind by a worker that is no longer running.
+    """
+    if not os.path.exists(socket_path):
+        return
+    if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        raise ValueError("%s exists and is not a socket" % socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except ConnectionRefusedError:
+            os.remove(socket_path)
+            return
+    raise ValueError("Another worker is listening on %s" % socket_path)
+
+
+def _run(job, run_job):
+    """ Runs a job in the working directory it was submitted from. """
+    cwd = os.getcwd()
+    os.chdir(job.pop('cwd', cwd))
+    try:
+        return run_job(job)
+    finally:
+        os.chdir(cwd)
+
+
+def _handle(stream, line, run_job):
+    """ Runs the job read from a connection and replies with its outcome.
+
+    Returns
+    -------
+    bool
+        Whether the worker was asked to shut down.
+    """
+    start = time.perf_counter()
+    shutdown = False
+    try:
+        job = json.loads(line.decode('utf-8'))
+        if not isinstance(job, dict):
+            raise ValueError("A job must be a JSON object, got %r" % job)
+        shutdown = bool(job.pop('shutdown', False))
+        response = {'status': 'ok'}
+        if not shutdown:
+            response['result'] = _run(job, run_job)
+    except Exception as e:
+        # a failed job doesn't take down the worker
+        response = {'status': 'error',
+                    'error': '%s: %s' % (type(e).__name__, e)}
+    response['wall_time'] = time.perf_counter() - start
+    try:
+        stream.write(json.dumps(response).encode('utf-8') + b'\n')
+        stream.flush()
+    except OSError:
+        # the client went away without waiting for the reply
+        pass
+    return shutdown
+
+
+def serve(socket_path, run_job, max_jobs=None):
+    """ Runs the jobs sent to a Unix socket, one at a time.
+
+    Parameters
+    ----------
+    socket_path : str
+        Path of the Unix socket to listen on. A socket left behind by a
+        worker that is no longer running is replaced.
+    run_job : callable
+        Runs a job, given as a dictionary of parameters, and returns its
+        result as a json serializable object.
+    max_jobs : int
+        Number of jobs to run before returning. If None, jobs are run
+        until a client asks the worker to shut down.
+
+    Raises
+    ------
+    ValueError
+        If `socket_path` is taken by another file, or by a running worker.
+
+    Notes
+    -----
+    A client sends a job as a JSON object on a single line, and gets
+    back a JSON object on a single line with the `status` of the job,
+    either 'ok' or 'error', its `result` or its `error`, and the
+    `wall_time` it took in seconds. Relative paths are resolved against
+    the `cwd` of the job, if it has one. A job of `{"shutdown": true}`
+    stops the worker. The socket is removed once the worker stops.
+
+    Jobs sent while another one runs wait for it to finish, so several
+    workers are needed to fit models in parallel.
+    """
+    _remove_stale_socket(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(socket_path)
+        server.listen()
+        jobs = 0
+        while max_jobs is None or jobs < max_jobs:
+            connection, _ = server.accept()
+            with connection:
+                stream = connection.makefile('rwb')
+                line = stream.readline()
+                if not line:
+                    # e.g. another worker checking whether this one runs
+                    continue
+                if _handle(stream, line, run_job):
+                    break
+            jobs += 1
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def submit(socket_path, job):
+    """ Sends a job to a worker and waits for it to finish.
+
+    Parameters
+    ----------
+    socket_path : str
+        Path of the Unix socket the worker listens on.
+    job : dict
+        Parameters of the job. Relative paths are resolved against the
+        current working directory, unless the job gives a `cwd`.
+
+    Returns
+    -------
+    dict
+        Outcome of the job, see `serve`.
+
+    Raises
+    ------
+    ConnectionError
+        If the worker closes the connection without replying.
+    """
+    job = dict(job)
+    job.setdefault('cwd', os.getcwd())
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        stream = client.makefile('rwb')
+        stream.write(json.dumps(job).encode('utf-8') + b'\n')
+        stream.flush()
+        line = stream.readline()
+    if not line:
+        raise ConnectionError("The worker at %s closed the connection "
+                              "without replying" % socket_path)
+    return json.loads(line.decode('utf-8'))
@@ -0,0 +1,306 @@
+from datetime import datetime
+import h5py
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, vstack
+from biom import Table
+from songbird.stream import _read_samples
+
+
+# number of table entries drawn at once, when the chunk size isn't given
+CHUNK_ENTRIES = 10 ** 7
+
+
+def _check_options(num_samples, num_features, num_covariates, sparsity,
+                   chunk_size):
+    if num_samples < 1 or num_features < 2:
+        raise ValueError('Need at least one sample and two features, got '
+                         '%d samples and %d features'
+                         % (num_samples, num_features))
+    if num_covariates < 0:
+        raise ValueError('`num_covariates` must be non-negative, got %d'
+                         % num_covariates)
+    if not 0 <= sparsity < 1:
+        raise ValueError('`sparsity` must be in [0, 1), got %r' % sparsity)
+    if chunk_size is not None and chunk_size < 1:
+        raise ValueError('`chunk_size` must be at least 1, got %d'
+                         % chunk_size)
+
+
+def _simulate(num_samples, num_features, num_covariates, low, high,
+              beta_mean, beta_scale, depth, depth_sigma, sparsity,
+              chunk_size, seed):
+    """ Draws the model, and a generator over the counts of its samples.
+
+    The counts are yielded as CSR matrices of `chunk_size` samples.
+    """
+    _check_options(num_samples, num_features, num_covariates, sparsity,
+                   chunk_size)
+    if chunk_size is None:
+        chunk_size = max(1, CHUNK_ENTRIES // num_features)
+    rng = np.random.default_rng(seed)
+
+    names = ['X%d' % i for i in range(1, num_covariates + 1)]
+    p = num_covariates + 1
+    beta = rng.normal(beta_mean, beta_scale, size=(p, num_features - 1))
+    X = np.hstack((np.ones((num_samples, 1)),
+                   rng.uniform(low, high, size=(num_samples, num_covariates))))
+    n = depth * rng.lognormal(0, depth_sigma, size=num_samples)
+
+    samp_ids = pd.Index(['S%d' % i for i in range(num_samples)],
+                        name='sampleid')
+    feat_ids = ['F%d' % i for i in range(num_features)]
+    metadata = pd.DataFrame(X[:, 1:], columns=names, index=samp_ids)
+    beta = pd.DataFrame(beta.T, columns=['Intercept'] + names,
+                        index=feat_ids[1:])
+    # the first feature is the reference, whose log-odds are zero
+    B = np.hstack((np.zeros((p, 1)), beta.values.T))
+
+    def chunks():
+        for start in range(0, num_samples, chunk_size):
+            stop = min(start + chunk_size, num_samples)
+            yield _draw_counts(rng, X[start:stop], B, n[start:stop],
+                               sparsity)
+
+    return metadata, beta, samp_ids, feat_ids, chunks()
+
+
+def _present_entries(rng, size, p):
+    """ Draws the entries of a flattened table that are present.
+
+    Every entry is present with probability `p`. The gaps between present
+    entries are geometric, so they are drawn directly, without going over
+    the absent entries.
+
+    Returns
+    -------
+    np.array
+        Sorted positions of the present entries.
+    """
+    idx = []
+    last = -1
+    while last < size - 1:
+        # enough gaps to reach the end of the table most of the time
+        expected = (size - 1 - last) * p
+        num_gaps = int(expected + 4 * np.sqrt(expected)) + 1
+        gaps = rng.geometric(p, size=num_gaps)
+        pos = last + np.cumsum(gaps)
+        idx.append(pos[pos < size])
+        last = pos[-1]
+    return np.concatenate(idx)
+
+
+def _draw_counts(rng, X, B, n, sparsity):
+    """ Draws the counts of a chunk of samples, only at its nonzeros. """
+    rows, D = X.shape[0], B.shape[1]
+    idx = _present_entries(rng, rows * D, 1 - sparsity)
+    r, c = np.divmod(idx, D)
+    if len(idx) == 0:
+        return csr_matrix((rows, D))
+
+    # softmax of the log-odds over the features present in each sample
+    eta = np.einsum('ij,ji->i', X[r], B[:, c])
+    starts = np.searchsorted(r, np.arange(rows))
+    present = np.unique(r)
+    starts = starts[present]
+    eta_max = np.zeros(rows)
+    eta_max[present] = np.maximum.reduceat(eta, starts)
+    mu = np.exp(eta - eta_max[r])
+    total = np.ones(rows)
+    total[present] = np.add.reduceat(mu, starts)
+
+    counts = rng.poisson(n[r] * mu / total[r])
+    keep = counts > 0
+    return csr_matrix((counts[keep].astype(np.float64), (r[keep], c[keep])),
+                      shape=(rows, D))
+
+
+def random_sparse_model(num_samples, num_features, num_covariates=1,
+                        low=-1, high=1, beta_mean=0, beta_scale=1,
+                        depth=10000, depth_sigma=0.5, sparsity=0.9,
+                        chunk_size=None, seed=0):
+    """ Simulates a sparse table from a multinomial regression model.
+
+    Unlike `songbird.util.random_multinomial_model`, this supports several
+    covariates, draws sequencing depths from a lognormal distribution and
+    removes a fraction of the features from each sample. Only the nonzero
+    counts are ever drawn, so the time and memory taken scale with the
+    number of nonzeros rather than the size of the table.
+
+    Parameters
+    ----------
+    num_samples : int
+        Number of samples.
+    num_features : int
+        Number of features.
+    num_covariates : int
+        Number of covariates, drawn uniformly from [`low`, `high`].
+    low : float
+        Smallest covariate value.
+    high : float
+        Largest covariate value.
+    beta_mean : float
+        Mean of the regression coefficients.
+    beta_scale : float
+        Scale of the regression coefficients.
+    depth : float
+        Median sequencing depth.
+    depth_sigma : float
+        Standard deviation of the log sequencing depth.
+    sparsity : float
+        Probability that a feature is absent from a sample. Absent
+        features have no counts, and the probabilities of the features
+        present in a sample are renormalized. Sampling adds more zeros.
+    chunk_size : int
+        Number of samples simulated at once. By default, chunks hold
+        about `CHUNK_ENTRIES` entries of the table.
+    seed : int
+        Random seed. The counts also depend on `chunk_size`.
+
+    Returns
+    -------
+    table : biom.Table
+        Sparse table of counts.
+    metadata : pd.DataFrame
+        Covariates `X1`, ..., of each sample.
+    beta : pd.DataFrame
+        Regression coefficients of every feature but the first, which is
+        the reference.
+
+    Notes
+    -----
+    Given the sequencing depth, the counts of the features present in a
+    sample are drawn from independent Poisson distributions. This is the
+    multinomial model, with a total count that is Poisson distributed
+    around the sequencing depth.
+    """
+    metadata, beta, samp_ids, feat_ids, chunks = _simulate(
+        num_samples, num_features, num_covariates, low, high, beta_mean,
+        beta_scale, depth, depth_sigma, sparsity, chunk_size, seed)
+    counts = vstack(list(chunks), format='csr')
+    table = Table(counts.T.tocsr(), feat_ids, samp_ids)
+    return table, metadata, beta
+
+
+def write_random_sparse_model(filepath, num_samples, num_features,
+                              num_covariates=1, low=-1, high=1, beta_mean=0,
+                              beta_scale=1, depth=10000, depth_sigma=0.5,
+                              sparsity=0.9, chunk_size=None,
+                              buffer_size=10 ** 7, seed=0):
+    """ Simulates a sparse table, writing it to an HDF5 BIOM file.
+
+    The table is written as it is simulated, so only one chunk of samples
+    is held in memory. See `random_sparse_model` for the model.
+
+    Parameters
+    ----------
+    filepath : str
+        Path of the BIOM file, which is overwritten.
+    num_samples, num_features, num_covariates, low, high, beta_mean,
+    beta_scale, depth, depth_sigma, sparsity, chunk_size, seed
+        See `random_sparse_model`.
+    buffer_size : int
+        Maximum number of nonzeros held in memory while writing the
+        counts by feature.
+
+    Returns
+    -------
+    metadata : pd.DataFrame
+        Covariates `X1`, ..., of each sample.
+    beta : pd.DataFrame
+        Regression coefficients of every feature but the first, which is
+        the reference.
+    """
+    if buffer_size < 1:
+        raise ValueError('`buffer_size` must be at least 1, got %d'
+                         % buffer_size)
+    metadata, beta, samp_ids, feat_ids, chunks = _simulate(
+        num_samples, num_features, num_covariates, low, high, beta_mean,
+        beta_scale, depth, depth_sigma, sparsity, chunk_size, seed)
+
+    with h5py.File(filepath, 'w') as f:
+        groups = {}
+        for axis, ids in [('observation', feat_ids), ('sample', samp_ids)]:
+            grp = groups[axis] = f.create_group(axis)
+            grp.create_group('metadata')
+            grp.create_group('group-metadata')
+            grp.create_group('matrix')
+            grp.create_dataset('ids', shape=(len(ids),),
+                               dtype=h5py.special_dtype(vlen=str),
+                               data=[i.encode('utf8') for i in ids])
+
+        # counts by sample, as they are simulated
+        matrix = groups['sample']['matrix']
+        data = matrix.create_dataset('data', shape=(0,), maxshape=(None,),
+                                     dtype=np.float64, chunks=True)
+        indices = matrix.create_dataset('indices', shape=(0,),
+                                        maxshape=(None,), dtype=np.int32,
+                                        chunks=True)
+        indptr = np.zeros(num_samples + 1, dtype=np.int64)
+        feature_nnz = np.zeros(num_features, dtype=np.int64)
+        start = 0
+        for counts in chunks:
+            nnz, stop = len(data), start + counts.shape[0]
+            data.resize((nnz + counts.nnz,))
+            indices.resize((nnz + counts.nnz,))
+            data[nnz:] = counts.data
+            indices[nnz:] = counts.indices
+            indptr[start + 1:stop + 1] = nnz + counts.indptr[1:]
+            feature_nnz += np.bincount(counts.indices,
+                                       minlength=num_features)
+            start = stop
+        nnz = len(data)
+        index_dtype = np.int32 if nnz < 2 ** 31 else np.int64
+        matrix.create_dataset('indptr', data=indptr.astype(index_dtype))
+
+        _write_features(groups['observation']['matrix'],
+                        (data, indices, matrix['indptr']), feature_nnz,
+                        num_samples, buffer_size, index_dtype)
+
+        f.attrs['id'] = 'No Table ID'
+        f.attrs['type'] = ''
+        f.attrs['format-url'] = 'http://biom-format.org'
+        f.attrs['format-version'] = (2, 1)
+        f.attrs['generated-by'] = 'songbird'
+        f.attrs['creation-date'] = datetime.now().isoformat()
+        f.attrs['shape'] = (num_features, num_samples)
+        f.attrs['nnz'] = nnz
+    return metadata, beta
+
+
+def _write_features(matrix, samples, feature_nnz, num_samples, buffer_size,
+                    index_dtype):
+    """ Writes the counts by feature, from the counts by sample.
+
+    The features are split into blocks of at most `buffer_size` nonzeros
+    (or a single feature), and the counts by sample are scanned once per
+    block, so that only one block is held in memory.
+    """
+    num_features = len(feature_nnz)
+    indptr = np.concatenate(([0], np.cumsum(feature_nnz)))
+    nnz = indptr[-1]
+    data = matrix.create_dataset('data', shape=(nnz,), dtype=np.float64)
+    indices = matrix.create_dataset('indices', shape=(nnz,), dtype=np.int32)
+    matrix.create_dataset('indptr', data=indptr.astype(index_dtype))
+
+    # rows of the sample matrix to read at once
+    rows = max(1, buffer_size * num_samples // max(nnz, 1))
+    begin = 0
+    while begin < num_features:
+        end = max(begin + 1, np.searchsorted(
+            indptr, indptr[begin] + buffer_size, side='right') - 1)
+        end = min(end, num_features)
+        block_data, block_cols, block_rows = [], [], []
+        for start in range(0, num_samples, rows):
+            stop = min(start + rows, num_samples)
+            chunk = _read_samples(samples, start, stop, num_features)
+            chunk = chunk[:, begin:end].tocoo()
+            block_data.append(chunk.data)
+            block_cols.append(chunk.col)
+            block_rows.append(chunk.row + start)
+        block_cols = np.concatenate(block_cols)
+        # samples are scanned in order, so a stable sort keeps them sorted
+        order = np.argsort(block_cols, kind='stable')
+        data[indptr[begin]:indptr[end]] = np.concatenate(block_data)[order]
+        indices[indptr[begin]:indptr[end]] = np.concatenate(block_rows)[order]
+        begin = end
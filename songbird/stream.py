@@ -0,0 +1,393 @@
+import queue
+import threading
+import h5py
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, vstack
+from scipy.special import gammaln
+from sklearn.utils import check_random_state
+from songbird.util import (build_design, training_mask, _design_matrix,
+                           design_levels)
+
+
+class Minibatch(object):
+
+    def __init__(self, rows, counts, total_count, log_norm):
+        """ Counts of a minibatch of training samples read from disk.
+
+        Parameters
+        ----------
+        rows : np.array
+            Rows of the training design matrix in the minibatch.
+        counts : scipy.sparse.csr_matrix
+            Counts of the samples in the minibatch, where rows are samples
+            and columns are features.
+        total_count : np.array
+            Total count of each sample.
+        log_norm : np.array
+            Log factorial terms of the multinomial likelihood of each
+            sample, which do not depend on the coefficients.
+        """
+        self.rows = rows
+        self.counts = counts
+        self.total_count = total_count
+        self.log_norm = log_norm
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class BiomStream(object):
+
+    def __init__(self, filepath, sample_ids, feature_ids, chunk_size=1000):
+        """ Samples of an HDF5 BIOM table that are read as they are needed.
+
+        Parameters
+        ----------
+        filepath : str
+            Path to the table, in the HDF5 BIOM format.
+        sample_ids : array_like of str
+            Samples in the stream, in the order of the rows of the training
+            design matrix.
+        feature_ids : array_like of str
+            Features in the stream, in the order of the columns of the
+            counts.
+        chunk_size : int
+            Number of consecutive samples of the file read at a time.
+
+        Notes
+        -----
+        Only the counts of `chunk_size` samples are held in memory per
+        chunk, so memory does not grow with the number of samples.
+        """
+        with h5py.File(filepath, 'r') as f:
+            file_samples = pd.Index(_read_ids(f, 'sample'))
+            file_features = pd.Index(_read_ids(f, 'observation'))
+        self.filepath = filepath
+        self.chunk_size = chunk_size
+        self.shape = (len(sample_ids), len(feature_ids))
+
+        # position of each row in the file
+        self.positions = file_samples.get_indexer(sample_ids)
+        # column of each feature of the file, or -1 if it is left out
+        columns = file_features.get_indexer(feature_ids)
+        if np.any(self.positions < 0) or np.any(columns < 0):
+            raise ValueError("Some of the samples or features are not in %s"
+                             % filepath)
+        self._columns = np.full(len(file_features), -1, dtype=np.int64)
+        self._columns[columns] = np.arange(len(columns))
+        self._num_file_features = len(file_features)
+
+        # chunks of rows that are stored close to each other
+        order = np.argsort(self.positions, kind='mergesort')
+        self._chunks = [order[i:i + chunk_size]
+                        for i in range(0, len(order), chunk_size)]
+
+    def _read_rows(self, matrix, rows):
+        """ Reads rows, sorted by their position in the file, as CSR. """
+        positions = self.positions[rows]
+        if len(positions) == 0:
+            return csr_matrix((0, self.shape[1]))
+        parts = []
+        # reads windows of at most `chunk_size` samples, skipping the
+        # windows without any of the rows
+        windows = positions // self.chunk_size
+        for w in np.unique(windows):
+            p = positions[windows == w]
+            start, stop = p[0], p[-1] + 1
+            parts.append(_read_samples(matrix, start, stop,
+                                       self._num_file_features)[p - start])
+        Y = vstack(parts).tocoo()
+        cols = self._columns[Y.col]
+        keep = cols >= 0
+        return csr_matrix((Y.data[keep], (Y.row[keep], cols[keep])),
+                          shape=(len(rows), self.shape[1]))
+
+    def read(self, rows=None):
+        """ Reads samples into memory.
+
+        Parameters
+        ----------
+        rows : np.array
+            Rows to read. If None, all of the rows are read.
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+            Counts of the samples, where rows are samples and columns are
+            features.
+        """
+        if rows is None:
+            rows = np.arange(self.shape[0])
+        order = np.argsort(self.positions[rows], kind='mergesort')
+        with h5py.File(self.filepath, 'r') as f:
+            Y = self._read_rows(_sample_matrix(f), rows[order])
+        return Y[np.argsort(order)]
+
+    def minibatches(self, batch_size, random_state=None, buffer_size=2):
+        """ Yields minibatches of samples that are read in the background.
+
+        Every epoch visits the chunks in a random order. The samples of a
+        chunk are shuffled and split into minibatches, and the samples
+        left over are carried over to the next chunk. The last incomplete
+        minibatch of an epoch is dropped, like in the input pipeline of
+        `songbird.multinomial.MultRegression`.
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of samples per minibatch.
+        random_state : int or np.random.RandomState
+            Random state used to shuffle the samples.
+        buffer_size : int
+            Maximum number of chunks that are read ahead of training.
+
+        Returns
+        -------
+        generator of Minibatch
+            Endless minibatches of samples. Closing the generator stops
+            the thread reading the table.
+        """
+        random_state = check_random_state(random_state)
+        chunks = queue.Queue(maxsize=buffer_size)
+        done = threading.Event()
+        reader = threading.Thread(
+            target=self._read_chunks,
+            args=(chunks, done, batch_size, random_state), daemon=True)
+        reader.start()
+        try:
+            while True:
+                item = chunks.get()
+                if isinstance(item, Exception):
+                    raise item
+                for batch in item:
+                    yield batch
+        finally:
+            done.set()
+
+    def _read_chunks(self, chunks, done, batch_size, random_state):
+        """ Puts the minibatches of each chunk in a bounded queue. """
+        try:
+            with h5py.File(self.filepath, 'r') as f:
+                matrix = _sample_matrix(f)
+                while not done.is_set():
+                    rows = np.array([], dtype=np.int64)
+                    Y = csr_matrix((0, self.shape[1]))
+                    for k in random_state.permutation(len(self._chunks)):
+                        rows = np.concatenate((rows, self._chunks[k]))
+                        chunk = self._read_rows(matrix, self._chunks[k])
+                        Y = vstack((Y, chunk), format='csr')
+                        order = random_state.permutation(len(rows))
+                        rows, Y = rows[order], Y[order]
+                        n = len(rows) - len(rows) % batch_size
+                        batches = _split_minibatches(rows[:n], Y[:n],
+                                                     batch_size)
+                        rows, Y = rows[n:], Y[n:]
+                        if not _put(chunks, batches, done):
+                            return
+        except Exception as e:
+            _put(chunks, e, done)
+
+
+def _split_minibatches(rows, Y, batch_size):
+    """ Splits consecutive samples into minibatches of the same size.
+
+    The statistics of the samples are computed for all of them at once,
+    and the minibatches are sliced from the arrays of the CSR matrix,
+    which is much faster than slicing the matrix itself.
+    """
+    total_count = np.asarray(Y.sum(axis=1)).ravel()
+    logfact = np.add.reduceat(np.append(gammaln(Y.data + 1), 0),
+                              np.minimum(Y.indptr[:-1], len(Y.data)))
+    # reduceat returns the value at the start of empty rows
+    logfact[np.diff(Y.indptr) == 0] = 0
+    log_norm = gammaln(total_count + 1) - logfact
+
+    batches = []
+    for i in range(0, len(rows), batch_size):
+        j = i + batch_size
+        begin, end = Y.indptr[i], Y.indptr[j]
+        counts = csr_matrix((Y.data[begin:end], Y.indices[begin:end],
+                             Y.indptr[i:j + 1] - begin),
+                            shape=(batch_size, Y.shape[1]))
+        batches.append(Minibatch(rows[i:j], counts, total_count[i:j],
+                                 log_norm[i:j]))
+    return batches
+
+
+def check_stream_options(solver, init):
+    """ Checks that a model can be trained on a `BiomStream`.
+
+    Parameters
+    ----------
+    solver : str
+        Optimization method of the model.
+    init : str or np.array
+        Initialization of the coefficients of the model.
+
+    Raises
+    ------
+    ValueError
+        If the options need all of the training samples in memory.
+    """
+    if solver != 'adam':
+        raise ValueError("Only the 'adam' solver can be used when "
+                         "streaming, since %r takes full-batch steps"
+                         % solver)
+    if isinstance(init, str) and init == 'lstsq':
+        raise ValueError("The 'lstsq' initialization cannot be used when "
+                         "streaming, since it needs all of the samples")
+
+
+def _put(chunks, item, done):
+    """ Puts an item in the queue, unless the consumer has stopped. """
+    while not done.is_set():
+        try:
+            chunks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _read_ids(f, axis):
+    """ Reads the sample or observation ids of an HDF5 BIOM table. """
+    return np.array([i.decode('utf-8') if isinstance(i, bytes) else i
+                     for i in f[axis + '/ids'][:]], dtype=object)
+
+
+def _sample_matrix(f):
+    """ Datasets holding the counts of an HDF5 BIOM table by sample. """
+    return (f['sample/matrix/data'], f['sample/matrix/indices'],
+            f['sample/matrix/indptr'])
+
+
+def _read_samples(matrix, start, stop, num_features):
+    """ Reads consecutive samples of an HDF5 BIOM table as CSR. """
+    data, indices, indptr = matrix
+    indptr = indptr[start:stop + 1]
+    begin, end = indptr[0], indptr[-1]
+    return csr_matrix((data[begin:end], indices[begin:end], indptr - begin),
+                      shape=(stop - start, num_features))
+
+
+def match_and_filter_stream(filepath, metadata, formula, min_sample_count,
+                            min_feature_count, sparse_design=False,
+                            chunk_size=1000):
+    """ Matches and filters an HDF5 BIOM table without loading it.
+
+    This applies the same filters as `songbird.util.match_and_filter`,
+    reading the table once in chunks of samples.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the table, in the HDF5 BIOM format.
+    metadata : pd.DataFrame
+        Sample metadata
+    formula : str
+        Statistical formula specifying the design matrix.
+    min_sample_count : int
+        Samples with this many counts or fewer are removed.
+    min_feature_count : int
+        Features observed in this many samples or fewer are removed.
+    sparse_design : bool
+        Whether to build a sparse design matrix.
+    chunk_size : int
+        Number of samples read at a time.
+
+    Returns
+    -------
+    feature_ids : np.array
+        Features that pass the filter.
+    metadata : pd.DataFrame
+        Metadata of the samples that pass the filter.
+    design : pd.DataFrame
+        Design matrix, whose index holds the samples of the table.
+    """
+    if not h5py.is_hdf5(filepath):
+        raise ValueError("%s is not an HDF5 BIOM table, which is required "
+                         "for streaming" % filepath)
+    metadata = metadata.loc[~metadata.index.duplicated(keep='first')]
+
+    with h5py.File(filepath, 'r') as f:
+        sample_ids = _read_ids(f, 'sample')
+        feature_ids = _read_ids(f, 'observation')
+        matrix = _sample_matrix(f)
+        matched = metadata.index.get_indexer(sample_ids) >= 0
+        keep = np.zeros(len(sample_ids), dtype=bool)
+        prevalence = np.zeros(len(feature_ids), dtype=np.int64)
+        for start in range(0, len(sample_ids), chunk_size):
+            stop = min(start + chunk_size, len(sample_ids))
+            Y = _read_samples(matrix, start, stop, len(feature_ids))
+            sums = np.asarray(Y.sum(axis=1)).ravel()
+            keep[start:stop] = matched[start:stop] & (
+                sums > min_sample_count)
+            Y = Y[keep[start:stop]]
+            prevalence += np.bincount(Y.indices[Y.data > 0],
+                                      minlength=len(feature_ids))
+
+    metadata = metadata.loc[sample_ids[keep]]
+    design = build_design(formula, metadata, sparse_design)
+    return feature_ids[prevalence > min_feature_count], metadata, design
+
+
+def load_stream(filepath, metadata, formula, training_column=None,
+                num_random_test_examples=10, min_sample_count=1000,
+                min_feature_count=10, seed=None, sparse_design=False,
+                chunk_size=1000):
+    """ Prepares a table on disk for training without loading it.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the table, in the HDF5 BIOM format.
+    metadata : pd.DataFrame
+        Sample metadata
+    formula : str
+        Statistical formula specifying the design matrix.
+    training_column : str
+        Column in `metadata` labeling samples as "Train" or "Test".
+        If None, samples are held out at random.
+    num_random_test_examples : int
+        Number of samples to hold out if `training_column` is None.
+    min_sample_count : int
+        Samples with this many counts or fewer are removed.
+    min_feature_count : int
+        Features observed in this many samples or fewer are removed.
+    seed : int
+        Random seed for choosing the held out samples.
+    sparse_design : bool
+        Whether to build a sparse design matrix.
+    chunk_size : int
+        Number of samples read at a time.
+
+    Returns
+    -------
+    trainX, testX : np.array or scipy.sparse.csr_matrix
+        Training and testing design matrices.
+    trainY : BiomStream
+        Training samples, which are read while training.
+    testY : scipy.sparse.csr_matrix
+        Testing count table, which is read into memory.
+    md_ids : np.array
+        Names of the columns of the design matrix.
+    obs_ids : np.array
+        Names of the features.
+    levels : dict of list
+        Levels of the categorical covariates of the formula, see
+        `songbird.util.design_levels`.
+    """
+    feature_ids, metadata, design = match_and_filter_stream(
+        filepath, metadata, formula, min_sample_count, min_feature_count,
+        sparse_design, chunk_size)
+    train_idx = training_mask(metadata, design, training_column,
+                              num_random_test_examples, seed)
+    X = _design_matrix(design)
+    trainY = BiomStream(filepath, design.index[train_idx], feature_ids,
+                        chunk_size)
+    testY = BiomStream(filepath, design.index[~train_idx], feature_ids,
+                       chunk_size).read()
+    return (X[train_idx], X[~train_idx], trainY, testY,
+            np.array(design.columns), feature_ids,
+            design_levels(formula, metadata.loc[design.index]))
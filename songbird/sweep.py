@@ -0,0 +1,213 @@
+import multiprocessing
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import ParameterGrid
+from tqdm import tqdm
+from songbird.util import limit_threads
+
+
+# hyperparameters that can be swept, in the order they are reported
+SWEEP_PARAMETERS = ('differential_prior', 'learning_rate', 'batch_size')
+
+# training data shared by all of the fits running in a worker process
+_worker_data = {}
+
+
+def fit_differentials(trainX, testX, trainY, testY,
+                      differential_prior, learning_rate, batch_size,
+                      clipnorm=10., epochs=10, summary_interval=1,
+                      solver='adam', init='random', early_stopping=None,
+                      tolerance=1e-4, patience=10, backend='tensorflow',
+                      random_seed=None, threads=None,
+                      feature_chunk_size=None):
+    """ Fits a single multinomial regression without writing any summaries.
+
+    Parameters
+    ----------
+    trainX, testX : np.array
+        Training and testing design matrices.
+    trainY, testY : np.array or scipy.sparse.spmatrix
+        Training and testing count tables.
+    differential_prior : float
+        Width of the normal prior on the coefficients.
+    learning_rate : float
+        Learning rate of the Adam optimizer.
+    batch_size : int
+        Number of samples per minibatch.
+    backend : str
+        Either 'tensorflow' or 'numpy'.
+    threads : int
+        Maximum number of threads used by TensorFlow. If None, TensorFlow
+        picks the number of threads itself.
+    feature_chunk_size : int
+        Number of features whose probabilities are computed at a time.
+        If None, all of the features are computed at once.
+
+    Returns
+    -------
+    beta : np.array
+        Differentials, centered across all of the features, with one row
+        per covariate.
+    loss : np.array
+        log likelihood loss.
+    cv : np.array
+        cross validation loss
+    iter_n : np.array
+        iterations
+    stop_reason : str
+        Why training stopped.
+
+    Notes
+    -----
+    The remaining parameters are passed on to the model's constructor
+    and `fit` method.
+    """
+    model_kwargs = dict(learning_rate=learning_rate, clipnorm=clipnorm,
+                        beta_mean=differential_prior, batch_size=batch_size,
+                        save_path=None, solver=solver, init=init,
+                        feature_chunk_size=feature_chunk_size)
+    fit_kwargs = dict(epochs=epochs, summary_interval=summary_interval,
+                      checkpoint_interval=None, silent=True,
+                      early_stopping=early_stopping, tolerance=tolerance,
+                      patience=patience)
+
+    if backend == 'numpy':
+        from songbird.numpy_backend import NumpyMultRegression
+
+        model = NumpyMultRegression(random_state=random_seed, **model_kwargs)
+        model(None, trainX, trainY, testX, testY)
+        loss, cv, its = model.fit(**fit_kwargs)
+    else:
+        import tensorflow as tf
+        from songbird.multinomial import MultRegression, session_config
+
+        model = MultRegression(**model_kwargs)
+        config = session_config(threads)
+        with tf.Graph().as_default(), tf.Session(config=config) as session:
+            if random_seed is not None:
+                tf.set_random_seed(random_seed)
+            model(session, trainX, trainY, testX, testY)
+            loss, cv, its = model.fit(**fit_kwargs)
+
+    beta = np.hstack((np.zeros((model.p, 1)), model.B))
+    beta = beta - beta.mean(axis=1).reshape(-1, 1)
+    return beta, loss, cv, its, model.stop_reason
+
+
+def _init_worker(trainX, testX, trainY, testY, threads):
+    """ Receives the training data once per worker process. """
+    limit_threads(threads)
+    _worker_data.update(trainX=trainX, testX=testX,
+                        trainY=trainY, testY=testY, threads=threads)
+
+
+def _fit_config(kwargs):
+    """ Fits one configuration on the data shared with the worker. """
+    return fit_differentials(**_worker_data, **kwargs)
+
+
+def sweep(trainX, testX, trainY, testY, grid, processes=1, threads=None,
+          silent=False, **kwargs):
+    """ Fits a multinomial regression for every combination of parameters.
+
+    Parameters
+    ----------
+    trainX, testX : np.array
+        Training and testing design matrices.
+    trainY, testY : np.array or scipy.sparse.spmatrix
+        Training and testing count tables.
+    grid : dict of str to list
+        Values to try for each of the parameters in `SWEEP_PARAMETERS`.
+    processes : int
+        Number of worker processes fitting configurations in parallel.
+        If 1, all of the configurations are fitted in this process.
+    threads : int
+        Maximum number of threads used by each worker, both by TensorFlow
+        and by the linear algebra libraries.
+    silent : bool
+        Flag denoting whether to suppress the progress bar.
+    kwargs : dict
+        Fixed parameters passed to `fit_differentials`.
+
+    Returns
+    -------
+    configs : list of dict
+        The parameters of each configuration.
+    results : list of tuple
+        The output of `fit_differentials` for each configuration.
+    """
+    unknown = set(grid) - set(SWEEP_PARAMETERS)
+    if unknown:
+        raise ValueError("Cannot sweep over %s, expected a subset of %s"
+                         % (sorted(unknown), list(SWEEP_PARAMETERS)))
+    missing = set(SWEEP_PARAMETERS) - set(grid)
+    if missing:
+        raise ValueError("No values given for %s" % sorted(missing))
+    for name, values in grid.items():
+        if len(values) == 0:
+            raise ValueError("No values given for %s" % name)
+
+    # ParameterGrid sorts by name, so spell out the order here
+    configs = [{name: params[name] for name in SWEEP_PARAMETERS}
+               for params in ParameterGrid(grid)]
+    tasks = [dict(kwargs, **config) for config in configs]
+
+    if processes == 1:
+        limit_threads(threads)
+        results = [fit_differentials(trainX, testX, trainY, testY,
+                                     threads=threads, **task)
+                   for task in tqdm(tasks, disable=silent)]
+    else:
+        # forked children would inherit TensorFlow's threads in an
+        # undefined state, so the workers are started from scratch
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(processes, _init_worker,
+                      (trainX, testX, trainY, testY, threads)) as pool:
+            results = list(tqdm(pool.imap(_fit_config, tasks),
+                                total=len(tasks), disable=silent))
+    return configs, results
+
+
+def rank_configurations(configs, results, end=10):
+    """ Tabulates a sweep, ranked by the held-out cross validation error.
+
+    Parameters
+    ----------
+    configs : list of dict
+        The parameters of each configuration, as returned by `sweep`.
+    results : list of tuple
+        The fits of each configuration, as returned by `sweep`.
+    end : int
+        Number of final summaries that the cross validation error and
+        the loss are averaged over.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per configuration, indexed by the configuration's name,
+        with the swept parameters, the averaged 'cross-validation' error
+        and 'loss', the final 'iteration', the 'stop-reason' and the
+        'rank' of the configuration, best first.
+    """
+    rows = []
+    for config, (_, loss, cv, its, stop_reason) in zip(configs, results):
+        row = dict(config)
+        row['cross-validation'] = np.mean(cv[-end:])
+        row['loss'] = np.mean(loss[-end:])
+        row['iteration'] = its[-1]
+        row['stop-reason'] = stop_reason
+        rows.append(row)
+    columns = list(SWEEP_PARAMETERS) + [
+        'cross-validation', 'loss', 'iteration', 'stop-reason']
+    summary = pd.DataFrame(rows, columns=columns,
+                           index=config_names(len(configs)))
+    summary = summary.sort_values('cross-validation', kind='mergesort')
+    summary['rank'] = np.arange(1, len(summary) + 1)
+    summary.index.name = 'config'
+    return summary
+
+
+def config_names(n):
+    """ Names of the configurations of a sweep, used as directory names. """
+    width = len(str(max(n - 1, 0)))
+    return ['config%0*d' % (width, i) for i in range(n)]
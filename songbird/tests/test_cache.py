@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+from biom import Table
+from scipy.sparse import csr_matrix, issparse
+from songbird.cache import (file_digest, table_digest, metadata_digest,
+                            cache_path, save_preprocessed, load_preprocessed,
+                            is_cached)
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.trainX = np.array([[1., 0.], [1., 1.], [1., 2.]])
+        self.testX = np.array([[1., 3.]])
+        self.trainY = np.array([[0., 2., 3.], [1., 0., 0.], [4., 0., 1.]])
+        self.testY = np.array([[0., 0., 5.]])
+        self.md_ids = np.array(['Intercept', 'x'])
+        self.obs_ids = np.array(['o1', 'o2', 'o3'])
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_round_trip(self):
+        path = cache_path(self.cache_dir, formula='x')
+        self.assertFalse(is_cached(path))
+        save_preprocessed(path, self.trainX, self.testX,
+                          csr_matrix(self.trainY), self.testY,
+                          self.md_ids, self.obs_ids, {'g': ['a', 'b']})
+        self.assertTrue(is_cached(path))
+
+        res = load_preprocessed(path)
+        trainX, testX, trainY, testY, md_ids, obs_ids, levels = res
+        npt.assert_allclose(trainX, self.trainX)
+        npt.assert_allclose(testX, self.testX)
+        npt.assert_allclose(trainY, self.trainY)
+        npt.assert_allclose(testY, self.testY)
+        npt.assert_array_equal(md_ids, self.md_ids)
+        npt.assert_array_equal(obs_ids, self.obs_ids)
+        self.assertEqual(levels, {'g': ['a', 'b']})
+
+        trainY, testY = load_preprocessed(path, sparse=True)[2:4]
+        self.assertTrue(issparse(trainY))
+        npt.assert_allclose(trainY.toarray(), self.trainY)
+        npt.assert_allclose(testY.toarray(), self.testY)
+
+    def test_round_trip_sparse_design(self):
+        path = cache_path(self.cache_dir, formula='x', sparse_design=True)
+        save_preprocessed(path, csr_matrix(self.trainX),
+                          csr_matrix(self.testX), self.trainY, self.testY,
+                          self.md_ids, self.obs_ids)
+        res = load_preprocessed(path)
+        trainX, testX = res[:2]
+        self.assertIsNone(res[-1])
+        self.assertTrue(issparse(trainX))
+        self.assertTrue(issparse(testX))
+        npt.assert_allclose(trainX.toarray(), self.trainX)
+        npt.assert_allclose(testX.toarray(), self.testX)
+
+    def test_cache_path(self):
+        path1 = cache_path(self.cache_dir, formula='x', random_seed=0)
+        path2 = cache_path(self.cache_dir, random_seed=0, formula='x')
+        path3 = cache_path(self.cache_dir, formula='x', random_seed=1)
+        self.assertEqual(path1, path2)
+        self.assertNotEqual(path1, path3)
+        self.assertEqual(os.path.dirname(path1), self.cache_dir)
+
+    def test_is_cached_none(self):
+        self.assertFalse(is_cached(None))
+
+    def test_digests(self):
+        fp = os.path.join(self.cache_dir, 'f.txt')
+        with open(fp, 'w') as f:
+            f.write('abc')
+        self.assertEqual(
+            file_digest(fp),
+            'ba7816bf8f01cfea414140de5dae2223'
+            'b00361a396177a9cb410ff61f20015ad')
+
+        table = Table(self.trainY.T, self.obs_ids, ['s1', 's2', 's3'])
+        other = Table(self.trainY.T, self.obs_ids, ['s1', 's2', 's4'])
+        self.assertEqual(table_digest(table), table_digest(table.copy()))
+        self.assertNotEqual(table_digest(table), table_digest(other))
+
+        md = pd.DataFrame({'x': [0., 1., 2.]}, index=['s1', 's2', 's3'])
+        self.assertEqual(metadata_digest(md), metadata_digest(md.copy()))
+        md2 = md.copy()
+        md2.loc['s3', 'x'] = 3.
+        self.assertNotEqual(metadata_digest(md), metadata_digest(md2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,17 @@
+import os
+import shutil
+import tempfile
 import tensorflow as tf
 import unittest
 import numpy as np
 import numpy.testing as npt
-from songbird.multinomial import MultRegression
-from songbird.util import random_multinomial_model
+from scipy.sparse import csr_matrix
+from songbird.multinomial import MultRegression, session_config
+from songbird.numpy_backend import NumpyMultRegression
+from songbird.stream import load_stream
+from skbio.stats.composition import clr_inv as softmax
+from songbird.util import (random_multinomial_model, lstsq_differentials,
+                           collapse_duplicates)
 
 
 class TestMultRegression(unittest.TestCase):
@@ -24,7 +32,7 @@ class TestMultRegression(unittest.TestCase):
     def test_fit(self):
         tf.set_random_seed(0)
         model = MultRegression(
-            batch_size=10, learning_rate=1e-3, beta_scale=1)
+            batch_size=10, learning_rate=1e-3, beta_scale=1, save_path=None)
         Y = np.array(self.table.matrix_data.todense()).T
         X = self.md.values
         trainX = X[:-5]
@@ -36,8 +44,331 @@ class TestMultRegression(unittest.TestCase):
             loss, cv, _ = model.fit(epochs=int(50000))
         self.assertGreater(len(loss), 1)
         self.assertGreater(len(cv), 1)
+        self.assertEqual(len(model.summary_times), len(loss))
         npt.assert_allclose(self.beta, model.B.T, atol=0.1, rtol=0.1)
 
+    def test_fit_collapse_duplicates(self):
+        # two groups collapse into fewer rows than the batch size
+        state = np.random.RandomState(0)
+        X = np.vstack((np.ones(100), np.arange(100) % 2)).T
+        B = state.normal(size=(2, 4))
+        probs = softmax(np.hstack((np.zeros((100, 1)), X @ B)))
+        Y = np.vstack([state.multinomial(1000, p) for p in probs])
+        trainX, trainY = collapse_duplicates(X[:-10], Y[:-10])
+        model = MultRegression(batch_size=5, save_path=None)
+        with tf.Graph().as_default(), tf.Session() as session:
+            tf.set_random_seed(0)
+            model(session, trainX, trainY, X[-10:], Y[-10:], num_samples=90)
+            loss, cv, its = model.fit(epochs=300, summary_interval=0,
+                                      silent=True)
+        self.assertEqual(its[-1], 90 // 5 * 300 - 1)
+        npt.assert_allclose(model.B, B, atol=0.1)
+
+    def test_batches(self):
+        model = MultRegression(batch_size=10, save_path=None)
+        Y = np.array(self.table.matrix_data.todense()).T
+        X = self.md.values
+        with tf.Graph().as_default(), tf.Session() as session:
+            model(session, X[:-5], Y[:-5], X[-5:], Y[-5:])
+            sample_ids = model._sample_ids()
+            for _ in range(3):
+                epoch = np.concatenate(
+                    [session.run(sample_ids) for _ in range(4)])
+                self.assertEqual(len(epoch), 40)
+                self.assertEqual(len(np.unique(epoch)), 40)
+
+    def test_loss(self):
+        Y = np.array(self.table.matrix_data.todense()).T
+        X = self.md.values
+        B = np.random.RandomState(0).normal(size=(2, 4))
+        exp = NumpyMultRegression(init=B)
+        exp(None, X[:-5], Y[:-5], X[-5:], Y[-5:])
+        exp_loss, _ = exp._loss(B)
+        for trainY in (Y[:-5], csr_matrix(Y[:-5])):
+            model = MultRegression(solver='lbfgs', init=B, save_path=None)
+            with tf.Graph().as_default(), tf.Session() as session:
+                model(session, X[:-5], trainY, X[-5:], Y[-5:])
+                loss, objective = session.run([model.loss, model.objective])
+            npt.assert_allclose(loss, exp_loss, rtol=1e-4)
+            # the objective only leaves out the multinomial coefficients
+            npt.assert_allclose(loss - objective, -exp.log_norm.sum(),
+                                rtol=1e-4)
+
+    def test_feature_chunks(self):
+        Y = np.array(self.table.matrix_data.todense()).T
+        X = self.md.values
+        B = np.random.RandomState(0).normal(size=(2, 4))
+        exp = NumpyMultRegression(init=B)
+        exp(None, X[:-5], Y[:-5], X[-5:], Y[-5:])
+        exp_loss, exp_grad = exp._loss(B)
+        exp_cv = exp._cv(B)
+        for design, counts in ((X, Y), (csr_matrix(X), csr_matrix(Y))):
+            for chunk_size in (1, 3, 100):
+                model = MultRegression(solver='lbfgs', init=B,
+                                       save_path=None,
+                                       feature_chunk_size=chunk_size)
+                with tf.Graph().as_default(), tf.Session() as session:
+                    model(session, design[:-5], counts[:-5],
+                          design[-5:], counts[-5:])
+                    grad = tf.convert_to_tensor(
+                        tf.gradients(model.objective, model.qbeta)[0])
+                    loss, cv, grad = session.run(
+                        [model.loss, model.cv, grad])
+                npt.assert_allclose(loss, exp_loss, rtol=1e-4)
+                npt.assert_allclose(cv, exp_cv, rtol=1e-4)
+                npt.assert_allclose(grad, exp_grad, rtol=1e-3, atol=1e-2)
+
+    def test_adam_steps(self):
+        # full batches, so that both backends take the same steps
+        Y = np.array(self.table.matrix_data.todense()).T
+        X = self.md.values
+        B = np.random.RandomState(0).normal(size=(2, 4))
+        kwargs = dict(init=B, batch_size=45, learning_rate=0.1, clipnorm=1.,
+                      save_path=None)
+        exp = NumpyMultRegression(**kwargs)
+        exp(None, X[:-5], Y[:-5], X[-5:], Y[-5:])
+        exp.fit(epochs=10, summary_interval=0, silent=True)
+        for steps_per_call in (1, 4):
+            model = MultRegression(**kwargs)
+            with tf.Graph().as_default(), tf.Session() as session:
+                model(session, X[:-5], Y[:-5], X[-5:], Y[-5:])
+                model.fit(epochs=10, summary_interval=0, silent=True,
+                          steps_per_call=steps_per_call)
+            npt.assert_allclose(model.B, exp.B, rtol=1e-4, atol=1e-4)
+
+    def test_fit_lbfgs(self):
+        tf.set_random_seed(0)
+        model = MultRegression(beta_scale=1, solver='lbfgs', save_path=None)
+        Y = np.array(self.table.matrix_data.todense()).T
+        X = self.md.values
+        with tf.Graph().as_default(), tf.Session() as session:
+            model(session, X[:-5], Y[:-5], X[-5:], Y[-5:])
+            loss, cv, its = model.fit(epochs=1000, silent=True)
+        self.assertGreater(len(loss), 1)
+        self.assertEqual(len(loss), len(cv))
+        self.assertEqual(len(loss), len(its))
+        self.assertLess(loss[-1], loss[0])
+        npt.assert_allclose(self.beta, model.B.T, atol=0.1, rtol=0.1)
+
+    def test_fit_early_stopping(self):
+        model = MultRegression(
+            batch_size=10, learning_rate=1e-1, beta_scale=1, save_path=None)
+        Y = np.array(self.table.matrix_data.todense()).T
+        X = self.md.values
+        with tf.Graph().as_default(), tf.Session() as session:
+            tf.set_random_seed(0)
+            model(session, X[:-5], Y[:-5], X[-5:], Y[-5:])
+            loss, cv, its = model.fit(
+                epochs=50000, summary_interval=0, silent=True,
+                early_stopping='cv', tolerance=1e-2, patience=100)
+        self.assertEqual(model.stop_reason, 'cv-converged')
+        self.assertLess(model.stop_iteration, (45 // 10) * 50000 - 1)
+        self.assertEqual(its[-1], model.stop_iteration)
+
+    def test_fit_steps_per_call(self):
+        tf.set_random_seed(0)
+        model = MultRegression(
+            batch_size=10, learning_rate=1e-3, beta_scale=1, save_path=None)
+        Y = np.array(self.table.matrix_data.todense()).T
+        X = self.md.values
+        with tf.Graph().as_default(), tf.Session() as session:
+            model(session, X[:-5], Y[:-5], X[-5:], Y[-5:])
+            loss, cv, its = model.fit(epochs=int(50000), steps_per_call=100,
+                                      summary_interval=1, silent=True)
+        self.assertGreater(len(loss), 1)
+        self.assertEqual(its[0], 0)
+        self.assertEqual(its[-1], (45 // 10) * 50000 - 1)
+        npt.assert_allclose(self.beta, model.B.T, atol=0.1, rtol=0.1)
+
+    def test_fit_summaries(self):
+        save_path = tempfile.mkdtemp()
+        model = MultRegression(
+            batch_size=10, learning_rate=1e-3, beta_scale=1,
+            save_path=save_path)
+        Y = np.array(self.table.matrix_data.todense()).T
+        X = self.md.values
+        with tf.Graph().as_default(), tf.Session() as session:
+            model(session, X[:-5], Y[:-5], X[-5:], Y[-5:])
+            model.fit(epochs=10, summary_interval=0, histogram_interval=0,
+                      profile=True, silent=True)
+            model.writer.flush()
+        tags = set()
+        for event_file in os.listdir(save_path):
+            if not event_file.startswith('events'):
+                continue
+            for event in tf.train.summary_iterator(
+                    os.path.join(save_path, event_file)):
+                if event.HasField('tagged_run_metadata'):
+                    tags.add('run_metadata')
+                for value in event.summary.value:
+                    tags.add(value.tag)
+        shutil.rmtree(save_path)
+        self.assertIn('loss', tags)
+        self.assertIn('accuracy/cv_error', tags)
+        self.assertIn('qbeta', tags)
+        self.assertIn('run_metadata', tags)
+
+    def test_fit_resume(self):
+        save_path = tempfile.mkdtemp()
+        Y = np.array(self.table.matrix_data.todense()).T
+        X = self.md.values
+        model = MultRegression(
+            batch_size=10, learning_rate=1e-3, beta_scale=1,
+            save_path=save_path)
+        with tf.Graph().as_default(), tf.Session() as session:
+            model(session, X[:-5], Y[:-5], X[-5:], Y[-5:])
+            model.fit(epochs=10, summary_interval=0, silent=True)
+        checkpoint = tf.train.latest_checkpoint(save_path)
+        self.assertIsNotNone(checkpoint)
+
+        resumed = MultRegression(
+            batch_size=10, learning_rate=1e-3, beta_scale=1,
+            save_path=save_path)
+        with tf.Graph().as_default(), tf.Session() as session:
+            resumed(session, X[:-5], Y[:-5], X[-5:], Y[-5:])
+            resumed.restore(checkpoint)
+            self.assertEqual(session.run(resumed.global_step), 40)
+            npt.assert_allclose(session.run(resumed.qbeta), model.B)
+            loss, cv, its = resumed.fit(epochs=20, summary_interval=0,
+                                        silent=True)
+            self.assertEqual(session.run(resumed.global_step), 80)
+        shutil.rmtree(save_path)
+        self.assertEqual(its[0], 40)
+        self.assertEqual(its[-1], 79)
+
+    def test_fit_init_array(self):
+        B = np.ones((2, 4))
+        model = MultRegression(save_path=None, init=B)
+        Y = np.array(self.table.matrix_data.todense()).T
+        X = self.md.values
+        with tf.Graph().as_default(), tf.Session() as session:
+            model(session, X[:-5], Y[:-5], X[-5:], Y[-5:])
+            npt.assert_allclose(session.run(model.qbeta), B)
+
+    def test_fit_intercept(self):
+        model = MultRegression(beta_scale=1, save_path=None)
+        Y = np.array(self.table.matrix_data.todense()).T
+        X = np.ones((50, 1))
+        with tf.Graph().as_default(), tf.Session() as session:
+            model(session, X[:-5], Y[:-5], X[-5:], Y[-5:])
+            loss, cv, its = model.fit(epochs=1000, silent=True)
+            qbeta = session.run(model.qbeta)
+        self.assertEqual(model.stop_reason, 'intercept-only')
+        self.assertGreater(len(loss), 1)
+        self.assertLess(loss[-1], loss[0])
+        npt.assert_allclose(qbeta, model.B, rtol=1e-5)
+
+    def test_fit_lstsq_init(self):
+        tf.set_random_seed(0)
+        model = MultRegression(
+            batch_size=10, learning_rate=1e-3, beta_scale=1, init='lstsq',
+            save_path=None)
+        Y = np.array(self.table.matrix_data.todense()).T
+        X = self.md.values
+        with tf.Graph().as_default(), tf.Session() as session:
+            model(session, X[:-5], Y[:-5], X[-5:], Y[-5:])
+            npt.assert_allclose(session.run(model.qbeta),
+                                lstsq_differentials(X[:-5], Y[:-5]),
+                                rtol=1e-4)
+            loss, cv, _ = model.fit(epochs=100, silent=True)
+        npt.assert_allclose(self.beta, model.B.T, atol=0.1, rtol=0.1)
+
+    def test_bad_solver(self):
+        with self.assertRaises(ValueError):
+            MultRegression(solver='sgd')
+
+    def test_bad_init(self):
+        with self.assertRaises(ValueError):
+            MultRegression(init='zeros')
+
+    def test_fit_sparse(self):
+        Y = np.array(self.table.matrix_data.todense()).T
+        X = self.md.values
+        res = []
+        for table in (Y, csr_matrix(Y)):
+            model = MultRegression(
+                batch_size=10, learning_rate=1e-3, beta_scale=1,
+                save_path=None)
+            with tf.Graph().as_default(), tf.Session() as session:
+                tf.set_random_seed(0)
+                model(session, X[:-5], table[:-5], X[-5:], table[-5:])
+                loss, cv, _ = model.fit(epochs=100, summary_interval=0)
+            res.append((loss, cv, model.B))
+        (dense_loss, dense_cv, dense_B), (loss, cv, B) = res
+        npt.assert_allclose(dense_loss, loss, rtol=1e-4)
+        npt.assert_allclose(dense_cv, cv, rtol=1e-4)
+        npt.assert_allclose(dense_B, B, rtol=1e-3, atol=1e-4)
+
+    def test_fit_sparse_design(self):
+        Y = np.array(self.table.matrix_data.todense()).T
+        X = self.md.values
+        res = []
+        for design in (X, csr_matrix(X)):
+            for solver in ('adam', 'lbfgs'):
+                model = MultRegression(
+                    batch_size=10, learning_rate=1e-3, beta_scale=1,
+                    solver=solver, save_path=None)
+                with tf.Graph().as_default(), tf.Session() as session:
+                    tf.set_random_seed(0)
+                    model(session, design[:-5], Y[:-5], design[-5:], Y[-5:])
+                    loss, cv, _ = model.fit(epochs=100, summary_interval=0,
+                                            silent=True)
+                res.append((loss, cv, model.B))
+        (dense_loss, dense_cv, dense_B), (loss, cv, B) = res[0], res[2]
+        npt.assert_allclose(dense_loss, loss, rtol=1e-4)
+        npt.assert_allclose(dense_cv, cv, rtol=1e-4)
+        npt.assert_allclose(dense_B, B, rtol=1e-3, atol=1e-4)
+        # L-BFGS may stop after a different number of float32 iterations
+        (dense_loss, dense_cv, dense_B), (loss, cv, B) = res[1], res[3]
+        npt.assert_allclose(dense_loss[-1], loss[-1], rtol=1e-4)
+        npt.assert_allclose(dense_cv[-1], cv[-1], rtol=1e-2)
+        npt.assert_allclose(dense_B, B, atol=0.05)
+
+    def test_fit_stream(self):
+        import h5py
+        save_path = tempfile.mkdtemp()
+        path = os.path.join(save_path, 'table.biom')
+        with h5py.File(path, 'w') as f:
+            self.table.to_hdf5(f, 'test')
+        md = self.md.copy()
+        md.columns = ['Intercept', 'x']
+        trainX, testX, trainY, testY, _, _, _ = load_stream(
+            path, md, 'x', min_sample_count=0, min_feature_count=0, seed=0,
+            chunk_size=7)
+
+        model = MultRegression(batch_size=10, learning_rate=1e-3,
+                               beta_scale=1, save_path=None)
+        with tf.Graph().as_default(), tf.Session() as session:
+            tf.set_random_seed(0)
+            model(session, trainX, trainY, testX, testY)
+            B = session.run(model.qbeta)
+            # the loss of a single minibatch fed from the stream
+            model._minibatches = trainY.minibatches(10, random_state=0)
+            feed = model._feed_dict()
+            res = session.run(model.loss, feed_dict=feed)
+            model._minibatches.close()
+            loss, cv, _ = model.fit(epochs=100, summary_interval=0,
+                                    silent=True)
+
+        exp = NumpyMultRegression(beta_scale=1, save_path=None)
+        exp(None, trainX, trainY.read(), testX, testY)
+        shutil.rmtree(save_path)
+        npt.assert_allclose(res, exp._loss(B, feed[model.sample_ids])[0],
+                            rtol=1e-4)
+        self.assertTrue(np.all(np.isfinite(loss)))
+        self.assertLess(cv[-1], cv[0])
+
+
+class TestSessionConfig(unittest.TestCase):
+
+    def test_session_config(self):
+        self.assertIsNone(session_config(None))
+        config = session_config(2)
+        self.assertEqual(config.intra_op_parallelism_threads, 2)
+        self.assertEqual(config.inter_op_parallelism_threads, 2)
+        with tf.Graph().as_default(), tf.Session(config=config) as session:
+            self.assertEqual(session.run(tf.constant(1) + 1), 2)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,236 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+from scipy.sparse import csr_matrix
+from scipy.stats import multinomial, norm
+from skbio.stats.composition import clr_inv as softmax
+from songbird.numpy_backend import NumpyMultRegression, fit_intercept
+from songbird.util import random_multinomial_model, collapse_duplicates
+
+
+class TestNumpyMultRegression(unittest.TestCase):
+
+    def setUp(self):
+        res = random_multinomial_model(
+            num_samples=50, num_features=5,
+            reps=1,
+            low=-1, high=1,
+            beta_mean=0,
+            beta_scale=1,
+            mu=1000,  # sequencing depth
+            sigma=0.5,
+            seed=0)
+
+        self.table, self.md, self.beta = res
+        self.Y = np.array(self.table.matrix_data.todense()).T
+        self.X = self.md.values
+
+    def _model(self, Y, **kwargs):
+        model = NumpyMultRegression(beta_scale=1, save_path=None,
+                                    random_state=0, **kwargs)
+        model(None, self.X[:-5], Y[:-5], self.X[-5:], Y[-5:])
+        return model
+
+    def test_loss(self):
+        model = self._model(self.Y)
+        B = model.B
+        probs = softmax(np.hstack((np.zeros((45, 1)), self.X[:-5] @ B)))
+        exp = -(norm.logpdf(B, 0, 1).sum() + sum(
+            multinomial.logpmf(y, y.sum(), p)
+            for y, p in zip(self.Y[:-5], probs)))
+        res, _ = model._loss(B)
+        npt.assert_allclose(res, exp)
+
+    def test_gradient(self):
+        model = self._model(self.Y)
+        B = model.B
+        _, grad = model._loss(B)
+        eps = 1e-6
+        exp = np.zeros_like(B)
+        for i in range(B.shape[0]):
+            for j in range(B.shape[1]):
+                E = np.zeros_like(B)
+                E[i, j] = eps
+                exp[i, j] = (model._loss(B + E)[0] -
+                             model._loss(B - E)[0]) / (2 * eps)
+        npt.assert_allclose(grad, exp, rtol=1e-4, atol=1e-4)
+
+    def test_sparse(self):
+        dense = self._model(self.Y)
+        sparse = self._model(csr_matrix(self.Y))
+        B = dense.B
+        npt.assert_allclose(dense._loss(B)[0], sparse._loss(B)[0])
+        npt.assert_allclose(dense._loss(B)[1], sparse._loss(B)[1])
+        rows = np.array([0, 3, 3, 7])
+        npt.assert_allclose(dense._loss(B, rows)[0],
+                            sparse._loss(B, rows)[0])
+        npt.assert_allclose(dense._cv(B), sparse._cv(B))
+
+    def test_sparse_design(self):
+        dense = self._model(self.Y)
+        X = csr_matrix(self.X)
+        for Y in (self.Y, csr_matrix(self.Y)):
+            sparse = NumpyMultRegression(beta_scale=1, save_path=None,
+                                         random_state=0)
+            sparse(None, X[:-5], Y[:-5], X[-5:], Y[-5:])
+            B = dense.B
+            npt.assert_allclose(dense._loss(B)[0], sparse._loss(B)[0])
+            npt.assert_allclose(dense._loss(B)[1], sparse._loss(B)[1])
+            rows = np.array([0, 3, 3, 7])
+            npt.assert_allclose(dense._loss(B, rows)[1],
+                                sparse._loss(B, rows)[1])
+            npt.assert_allclose(dense._cv(B), sparse._cv(B))
+
+    def test_feature_chunks(self):
+        exp = self._model(self.Y)
+        B = exp.B
+        rows = np.array([0, 3, 3, 7])
+        for Y in (self.Y, csr_matrix(self.Y)):
+            for chunk_size in (1, 3, 100):
+                model = self._model(Y, feature_chunk_size=chunk_size)
+                for res, exp_res in zip(model._loss(B), exp._loss(B)):
+                    npt.assert_allclose(res, exp_res)
+                for res, exp_res in zip(model._loss(B, rows),
+                                        exp._loss(B, rows)):
+                    npt.assert_allclose(res, exp_res)
+                npt.assert_allclose(model._cv(B), exp._cv(B))
+        with self.assertRaises(ValueError):
+            NumpyMultRegression(feature_chunk_size=0)
+
+    def test_batches(self):
+        model = self._model(self.Y, batch_size=10)
+        batches = model._batches()
+        for _ in range(3):
+            epoch = np.concatenate([next(batches) for _ in range(4)])
+            self.assertEqual(len(epoch), 40)
+            self.assertEqual(len(np.unique(epoch)), 40)
+            self.assertTrue(np.all((epoch >= 0) & (epoch < 45)))
+
+    def test_fit(self):
+        model = self._model(self.Y, batch_size=10, learning_rate=1e-3)
+        loss, cv, its = model.fit(epochs=5000, summary_interval=0,
+                                  silent=True)
+        self.assertGreater(len(loss), 1)
+        self.assertEqual(len(loss), len(cv))
+        self.assertEqual(model.stop_reason, 'max-epochs')
+        self.assertEqual(len(model.summary_times), len(its))
+        self.assertTrue(np.all(np.diff(model.summary_times) >= 0))
+        npt.assert_allclose(self.beta, model.B.T, atol=0.1, rtol=0.1)
+
+    def test_fit_collapse_duplicates(self):
+        # two groups collapse into fewer rows than the batch size
+        state = np.random.RandomState(0)
+        X = np.vstack((np.ones(100), np.arange(100) % 2)).T
+        B = state.normal(size=(2, 4))
+        probs = softmax(np.hstack((np.zeros((100, 1)), X @ B)))
+        Y = np.vstack([state.multinomial(1000, p) for p in probs])
+        trainX, trainY = collapse_duplicates(X[:-10], Y[:-10])
+        model = NumpyMultRegression(batch_size=5, save_path=None,
+                                    random_state=0)
+        model(None, trainX, trainY, X[-10:], Y[-10:], num_samples=90)
+        loss, cv, its = model.fit(epochs=100, summary_interval=0,
+                                  silent=True)
+        self.assertEqual(its[-1], 90 // 5 * 100 - 1)
+        npt.assert_allclose(model.B, B, atol=0.1)
+
+    def test_fit_lbfgs(self):
+        model = self._model(self.Y, solver='lbfgs')
+        loss, cv, its = model.fit(epochs=1000, silent=True)
+        self.assertGreater(len(loss), 1)
+        self.assertLess(loss[-1], loss[0])
+        self.assertEqual(model.stop_reason, 'lbfgs-converged')
+        self.assertEqual(len(model.summary_times), len(its))
+        npt.assert_allclose(self.beta, model.B.T, atol=0.1, rtol=0.1)
+
+    def test_fit_early_stopping(self):
+        model = self._model(self.Y, batch_size=10, learning_rate=1e-1)
+        loss, cv, its = model.fit(epochs=50000, summary_interval=0,
+                                  silent=True, early_stopping='cv',
+                                  tolerance=1e-2, patience=100)
+        self.assertEqual(model.stop_reason, 'cv-converged')
+        self.assertEqual(its[-1], model.stop_iteration)
+        self.assertLess(model.stop_iteration, (45 // 10) * 50000 - 1)
+
+    def test_bad_solver(self):
+        with self.assertRaises(ValueError):
+            NumpyMultRegression(solver='sgd')
+
+    def test_fit_lstsq_init(self):
+        random = self._model(self.Y, batch_size=10, learning_rate=1e-3)
+        lstsq = self._model(self.Y, batch_size=10, learning_rate=1e-3,
+                            init='lstsq')
+        self.assertLess(lstsq._loss(lstsq.B)[0], random._loss(random.B)[0])
+        loss, cv, its = lstsq.fit(epochs=100, summary_interval=0,
+                                  silent=True)
+        npt.assert_allclose(self.beta, lstsq.B.T, atol=0.1, rtol=0.1)
+
+    def test_fit_resume(self):
+        path = tempfile.mkdtemp()
+        try:
+            model = NumpyMultRegression(beta_scale=1, save_path=path,
+                                        batch_size=10, random_state=0)
+            model(None, self.X[:-5], self.Y[:-5], self.X[-5:], self.Y[-5:])
+            model.fit(epochs=10, summary_interval=0, silent=True)
+            checkpoint = os.path.join(path, 'model.npz')
+            self.assertTrue(os.path.exists(checkpoint))
+
+            resumed = NumpyMultRegression(beta_scale=1, save_path=path,
+                                          batch_size=10, random_state=1)
+            resumed(None, self.X[:-5], self.Y[:-5],
+                    self.X[-5:], self.Y[-5:])
+            resumed.restore(checkpoint)
+            self.assertEqual(resumed.iteration, 40)
+            npt.assert_allclose(resumed.B, model.B)
+            npt.assert_allclose(resumed._v, model._v)
+
+            loss, cv, its = resumed.fit(epochs=20, summary_interval=0,
+                                        silent=True)
+            self.assertEqual(its[0], 40)
+            self.assertEqual(its[-1], 79)
+            self.assertEqual(resumed.iteration, 80)
+        finally:
+            shutil.rmtree(path)
+
+    def test_init_array(self):
+        B = np.ones((2, 4))
+        model = self._model(self.Y, init=B)
+        npt.assert_allclose(model.B, B)
+        with self.assertRaises(ValueError):
+            self._model(self.Y, init=np.ones((2, 5)))
+
+    def test_bad_init(self):
+        with self.assertRaises(ValueError):
+            NumpyMultRegression(init='zeros')
+
+    def test_fit_intercept(self):
+        ones = np.ones((50, 1))
+        lbfgs = NumpyMultRegression(beta_scale=1, save_path=None,
+                                    solver='lbfgs', random_state=0)
+        lbfgs(None, ones[:-5], self.Y[:-5], ones[-5:], self.Y[-5:])
+        # fit would take the same shortcut, so call L-BFGS directly
+        lbfgs._fit_lbfgs(1000, None, True, None, 1e-4)
+        B = lbfgs.B
+
+        model = NumpyMultRegression(beta_scale=1, save_path=None)
+        model(None, ones[:-5], self.Y[:-5], ones[-5:], self.Y[-5:])
+        loss, cv, its = model.fit(silent=True)
+        self.assertEqual(model.stop_reason, 'intercept-only')
+        self.assertGreater(len(loss), 1)
+        self.assertLessEqual(loss[-1], lbfgs._loss(B)[0])
+        npt.assert_allclose(model.B, B, atol=1e-3)
+        npt.assert_allclose(loss[-1], model._loss(model.B)[0])
+        npt.assert_allclose(cv[-1], model._cv(model.B))
+
+    def test_fit_intercept_sparse(self):
+        dense = fit_intercept(self.Y[:-5], self.Y[-5:], 0, 2)
+        sparse = fit_intercept(csr_matrix(self.Y[:-5]),
+                               csr_matrix(self.Y[-5:]), 0, 2)
+        for exp, res in zip(dense, sparse):
+            npt.assert_allclose(exp, res)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+from songbird.predict import (predict_design, predict, save_design,
+                              load_design, differential_levels)
+from songbird.simulate import random_sparse_model, write_random_sparse_model
+from songbird.util import build_design, design_levels
+
+
+class TestPredict(unittest.TestCase):
+
+    def setUp(self):
+        self.table, self.md, beta = random_sparse_model(
+            100, 20, num_covariates=2, sparsity=0.3, chunk_size=30, seed=0)
+        self.md['G'] = np.array(['a', 'b', 'c', 'd'])[np.arange(100) % 4]
+        self.formula = 'X1 + C(G) + Q("X2")'
+        design = build_design(self.formula, self.md)
+        state = np.random.RandomState(0)
+        self.differentials = pd.DataFrame(
+            state.normal(size=(20, design.shape[1])),
+            index=self.table.ids(axis='observation'),
+            columns=design.columns)
+        self.design = design
+        self.X = design.values
+        self.Y = self.table.matrix_data.T.toarray()
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'table.biom')
+        write_random_sparse_model(self.path, 100, 20, num_covariates=2,
+                                  sparsity=0.3, chunk_size=30, seed=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _expected(self, X, Y, B):
+        eta = X @ B.T
+        probs = np.exp(eta) / np.exp(eta).sum(axis=1, keepdims=True)
+        pred = Y.sum(axis=1, keepdims=True) * probs
+        return (probs, pred, np.abs(pred - Y).mean(axis=1),
+                (Y * np.log(probs)).sum(axis=1))
+
+    def _predict(self, table, **kwargs):
+        chunks = list(predict(table, self.md, self.differentials,
+                              self.formula, **kwargs))
+        return [pd.concat(dfs) for dfs in zip(*chunks)]
+
+    def test_design_levels(self):
+        levels = design_levels(self.formula, self.md)
+        self.assertEqual(levels, {'G': ['a', 'b', 'c', 'd']})
+        path = os.path.join(self.tmpdir, 'design.json')
+        save_design(path, self.formula, levels)
+        self.assertEqual(load_design(path), (self.formula, levels))
+
+    def test_predict_design(self):
+        levels = design_levels(self.formula, self.md)
+        # without the reference level, the columns stay the same
+        md = self.md.loc[self.md['G'] != 'a']
+        res = predict_design(self.formula, md, self.differentials.columns,
+                             levels)
+        npt.assert_allclose(res.values, self.X[self.md['G'] != 'a'])
+
+        md = self.md.copy()
+        md.loc['S0', 'G'] = 'e'
+        with self.assertRaises(ValueError):
+            predict_design(self.formula, md, self.differentials.columns,
+                           levels)
+        with self.assertRaises(ValueError):
+            predict_design(self.formula, md, self.differentials.columns)
+
+        # without the levels, 'b' would be taken as the reference
+        md = self.md.loc[self.md['G'] != 'a']
+        with self.assertRaises(ValueError):
+            predict_design(self.formula, md, self.differentials.columns)
+
+    def test_differential_levels(self):
+        columns = self.differentials.columns
+        levels = differential_levels(self.formula, self.md, columns)
+        self.assertEqual(levels, {'G': ['a', 'b', 'c', 'd']})
+
+        # none of the samples are at the reference level
+        keep = (self.md['G'] != 'a').values
+        levels = differential_levels(self.formula, self.md[keep], columns)
+        self.assertEqual(levels['G'][1:], ['b', 'c', 'd'])
+        res = predict_design(self.formula, self.md[keep], columns, levels)
+        npt.assert_allclose(res.values, self.X[keep])
+
+        # nor at some of the other levels
+        keep = self.md['G'].isin(['b', 'd']).values
+        levels = differential_levels(self.formula, self.md[keep], columns)
+        res = predict_design(self.formula, self.md[keep], columns, levels)
+        npt.assert_allclose(res.values, self.X[keep])
+
+    def test_predict(self):
+        probs, pred, error, loglike = self._expected(
+            self.X, self.Y, self.differentials.values)
+        for table in [self.table, self.path]:
+            res = self._predict(table, chunk_size=30)
+            self.assertEqual(list(res[0].index),
+                             list(self.table.ids(axis='sample')))
+            npt.assert_allclose(res[0].values, probs)
+            npt.assert_allclose(res[1].values, pred)
+            npt.assert_allclose(res[2]['total-count'], self.Y.sum(axis=1))
+            npt.assert_allclose(res[2]['cross-validation'], error)
+            npt.assert_allclose(res[2]['log-likelihood'], loglike)
+
+    def test_predict_subset(self):
+        # samples without metadata, and features without differentials or
+        # without counts
+        md = self.md.iloc[10:]
+        self.md = md.loc[md['G'] != 'b']
+        self.differentials = self.differentials.iloc[:-2]
+        self.differentials.index = (list(self.differentials.index[:-1]) +
+                                    ['F100'])
+        rows = np.array([int(i[1:]) for i in self.md.index])
+        Y = self.Y[rows][:, :18]
+        Y[:, -1] = 0
+        X = self.design.loc[self.md.index].values
+        probs, pred, error, loglike = self._expected(
+            X, Y, self.differentials.values)
+
+        res = self._predict(self.path, chunk_size=7)
+        self.assertEqual(list(res[0].index), list(self.md.index))
+        self.assertEqual(list(res[0].columns),
+                         list(self.differentials.index))
+        npt.assert_allclose(res[0].values, probs)
+        npt.assert_allclose(res[2]['cross-validation'], error)
+        npt.assert_allclose(res[2]['log-likelihood'], loglike)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            self._predict(self.table, chunk_size=0)
+        self.md.index = ['T%d' % i for i in range(100)]
+        with self.assertRaises(ValueError):
+            self._predict(self.table)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from songbird.serve import serve, submit
+
+
+def _run_job(job):
+    if 'fail' in job:
+        raise ValueError(job['fail'])
+    return {'x': job['x'] * 2, 'cwd': os.getcwd()}
+
+
+class TestServe(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'worker.sock')
+        self.cwd = os.getcwd()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def _start(self, **kwargs):
+        worker = threading.Thread(target=serve,
+                                  args=(self.path, _run_job), kwargs=kwargs)
+        worker.start()
+        # wait until the worker is listening
+        while True:
+            try:
+                return worker, submit(self.path, {'x': 0})
+            except (FileNotFoundError, ConnectionRefusedError):
+                time.sleep(0.01)
+
+    def test_serve(self):
+        worker, _ = self._start()
+        res = submit(self.path, {'x': 2})
+        self.assertEqual(res['status'], 'ok')
+        self.assertEqual(res['result'], {'x': 4, 'cwd': self.cwd})
+        self.assertGreaterEqual(res['wall_time'], 0)
+
+        # a failed job doesn't stop the worker
+        res = submit(self.path, {'fail': 'bad job'})
+        self.assertEqual(res['status'], 'error')
+        self.assertEqual(res['error'], 'ValueError: bad job')
+
+        # jobs are run from the directory they were submitted from
+        res = submit(self.path, {'x': 1, 'cwd': self.tmpdir})
+        self.assertEqual(res['result']['cwd'], self.tmpdir)
+        self.assertEqual(os.getcwd(), self.cwd)
+
+        self.assertEqual(submit(self.path, {'shutdown': True})['status'],
+                         'ok')
+        worker.join()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_max_jobs(self):
+        worker, _ = self._start(max_jobs=3)
+        for x in range(1, 3):
+            self.assertEqual(submit(self.path, {'x': x})['result']['x'],
+                             2 * x)
+        worker.join()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_socket_path(self):
+        # a socket left behind by a worker that stopped is replaced
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        worker, res = self._start(max_jobs=2)
+        self.assertEqual(res['status'], 'ok')
+
+        # the socket of a running worker isn't
+        with self.assertRaises(ValueError):
+            serve(self.path, _run_job)
+        self.assertEqual(submit(self.path, {'x': 1})['result']['x'], 2)
+        worker.join()
+
+        with open(self.path, 'w') as f:
+            f.write('not a socket')
+        with self.assertRaises(ValueError):
+            serve(self.path, _run_job)
+
+
+if __name__ == '__main__':
+    unittest.main()
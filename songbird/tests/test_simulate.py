@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+import h5py
+import numpy as np
+import numpy.testing as npt
+from biom import load_table
+from scipy.sparse import csr_matrix
+from songbird.simulate import random_sparse_model, write_random_sparse_model
+from songbird.util import lstsq_differentials
+
+
+class TestSimulate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'table.biom')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_random_sparse_model(self):
+        table, md, beta = random_sparse_model(
+            200, 50, num_covariates=3, sparsity=0.8, chunk_size=30, seed=0)
+        self.assertEqual(table.shape, (50, 200))
+        self.assertEqual(list(table.ids(axis='sample')[:2]), ['S0', 'S1'])
+        self.assertEqual(list(table.ids(axis='observation')[:2]),
+                         ['F0', 'F1'])
+        self.assertEqual(list(md.columns), ['X1', 'X2', 'X3'])
+        self.assertEqual(list(md.index), list(table.ids(axis='sample')))
+        self.assertEqual(list(beta.columns), ['Intercept', 'X1', 'X2', 'X3'])
+        self.assertEqual(list(beta.index),
+                         list(table.ids(axis='observation')[1:]))
+        self.assertLessEqual(table.nnz, 0.25 * 50 * 200)
+        self.assertGreater(table.nnz, 0.15 * 50 * 200)
+        self.assertTrue(np.all(md.values >= -1) and np.all(md.values <= 1))
+
+    def test_large_sparse_model(self):
+        # only the nonzeros are drawn, so the memory taken doesn't grow
+        # with the 9e8 entries of the table, even in a single chunk
+        tracemalloc.start()
+        try:
+            table, _, _ = random_sparse_model(
+                30000, 30000, sparsity=1 - 1e-5, chunk_size=30000, seed=0)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(table.shape, (30000, 30000))
+        self.assertGreater(table.nnz, 0)
+        self.assertLess(table.nnz, 2 * 10 ** 4)
+        self.assertLess(peak, 10 ** 8)
+
+    def test_coefficients(self):
+        table, md, beta = random_sparse_model(
+            2000, 6, num_covariates=2, sparsity=0, depth=1e5, seed=0)
+        X = np.hstack((np.ones((2000, 1)), md.values))
+        B = lstsq_differentials(X, table.matrix_data.T.toarray())
+        npt.assert_allclose(B, beta.values.T, atol=0.05)
+
+    def test_write_random_sparse_model(self):
+        table, md, beta = random_sparse_model(
+            200, 50, num_covariates=2, sparsity=0.5, chunk_size=30, seed=1)
+        # a small buffer writes the features over several blocks
+        res_md, res_beta = write_random_sparse_model(
+            self.path, 200, 50, num_covariates=2, sparsity=0.5,
+            chunk_size=30, buffer_size=100, seed=1)
+        npt.assert_allclose(res_md.values, md.values)
+        npt.assert_allclose(res_beta.values, beta.values)
+
+        res = load_table(self.path)
+        self.assertEqual(res.shape, table.shape)
+        npt.assert_array_equal(res.ids(), table.ids())
+        npt.assert_array_equal(res.ids(axis='observation'),
+                               table.ids(axis='observation'))
+        npt.assert_allclose(res.matrix_data.toarray(),
+                            table.matrix_data.toarray())
+
+        with h5py.File(self.path, 'r') as f:
+            self.assertEqual(f.attrs['nnz'], table.nnz)
+            obs = csr_matrix((f['observation/matrix/data'][:],
+                              f['observation/matrix/indices'][:],
+                              f['observation/matrix/indptr'][:]),
+                             shape=table.shape)
+        self.assertTrue(obs.has_sorted_indices)
+        npt.assert_allclose(obs.toarray(), table.matrix_data.toarray())
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            random_sparse_model(10, 1)
+        with self.assertRaises(ValueError):
+            random_sparse_model(10, 5, num_covariates=-1)
+        with self.assertRaises(ValueError):
+            random_sparse_model(10, 5, sparsity=1)
+        with self.assertRaises(ValueError):
+            random_sparse_model(10, 5, chunk_size=0)
+        with self.assertRaises(ValueError):
+            write_random_sparse_model(self.path, 10, 5, buffer_size=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
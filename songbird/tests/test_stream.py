@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import unittest
+import h5py
+import numpy as np
+import numpy.testing as npt
+from songbird.numpy_backend import NumpyMultRegression
+from songbird.stream import (BiomStream, load_stream, check_stream_options,
+                             match_and_filter_stream)
+from songbird.util import (random_multinomial_model, match_and_filter,
+                           split_training)
+
+
+class TestStream(unittest.TestCase):
+
+    def setUp(self):
+        res = random_multinomial_model(
+            num_samples=50, num_features=8,
+            reps=1,
+            low=-1, high=1,
+            beta_mean=0,
+            beta_scale=1,
+            mu=1000,  # sequencing depth
+            sigma=0.5,
+            seed=0)
+        self.table, self.md, _ = res
+        # a rare feature and a shallow sample that are filtered out
+        data = self.table.matrix_data.toarray()
+        data[0] = 0
+        data[0, 3] = 1
+        data[:, 7] = 5
+        self.table = self.table.__class__(
+            data, self.table.ids(axis='observation'),
+            self.table.ids(axis='sample'))
+        self.md.columns = ['Intercept', 'x']
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'table.biom')
+        with h5py.File(self.path, 'w') as f:
+            self.table.to_hdf5(f, 'test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_match_and_filter_stream(self):
+        table, md, design = match_and_filter(
+            self.table, self.md, 'x', 100, 1)
+        feature_ids, res_md, res_design = match_and_filter_stream(
+            self.path, self.md, 'x', 100, 1, chunk_size=7)
+        npt.assert_array_equal(feature_ids, table.ids(axis='observation'))
+        self.assertEqual(list(res_design.index), list(design.index))
+        npt.assert_allclose(res_design.values, design.values)
+        self.assertEqual(list(res_md.index), list(md.index))
+
+    def test_load_stream(self):
+        table, md, design = match_and_filter(
+            self.table, self.md, 'x', 100, 1)
+        counts = table.matrix_data.T.tocsr()
+        exp = split_training(counts, md, design, None, 10, seed=0)
+        (trainX, testX, trainY, testY,
+         md_ids, obs_ids, levels) = load_stream(
+            self.path, self.md, 'x', num_random_test_examples=10,
+            min_sample_count=100, min_feature_count=1, seed=0,
+            chunk_size=7)
+        npt.assert_allclose(trainX, exp[0])
+        npt.assert_allclose(testX, exp[1])
+        self.assertIsInstance(trainY, BiomStream)
+        self.assertEqual(trainY.shape, exp[2].shape)
+        npt.assert_allclose(trainY.read().toarray(), exp[2].toarray())
+        npt.assert_allclose(testY.toarray(), exp[3].toarray())
+        npt.assert_array_equal(md_ids, design.columns)
+        npt.assert_array_equal(obs_ids, table.ids(axis='observation'))
+        self.assertEqual(levels, {})
+
+    def test_read(self):
+        ids = self.table.ids(axis='sample')
+        stream = BiomStream(self.path, ids[::-1], ['F2', 'F0'],
+                            chunk_size=4)
+        rows = np.array([5, 0, 30, 2])
+        exp = self.table.filter(ids[::-1][rows], inplace=False)
+        exp = exp.sort_order(ids[::-1][rows]).sort_order(
+            ['F2', 'F0'], axis='observation')
+        npt.assert_allclose(stream.read(rows).toarray(),
+                            exp.matrix_data.T.toarray())
+
+    def test_minibatches(self):
+        ids = self.table.ids(axis='sample')
+        stream = BiomStream(self.path, ids, self.table.ids('observation'),
+                            chunk_size=7)
+        Y = self.table.matrix_data.T.toarray()
+        batches = stream.minibatches(4, random_state=0)
+        for _ in range(3):
+            epoch = [next(batches) for _ in range(12)]
+            rows = np.concatenate([batch.rows for batch in epoch])
+            self.assertEqual(len(np.unique(rows)), 48)
+            for batch in epoch:
+                self.assertEqual(len(batch), 4)
+                npt.assert_allclose(batch.counts.toarray(), Y[batch.rows])
+                npt.assert_allclose(batch.total_count,
+                                    Y[batch.rows].sum(axis=1))
+        batches.close()
+
+    def test_fit(self):
+        trainX, testX, trainY, testY, _, _, _ = load_stream(
+            self.path, self.md, 'x', min_sample_count=100,
+            min_feature_count=1, seed=0, chunk_size=7)
+        streamed = NumpyMultRegression(batch_size=5, save_path=None,
+                                       random_state=0)
+        streamed(None, trainX, trainY, testX, testY)
+        model = NumpyMultRegression(batch_size=5, save_path=None,
+                                    random_state=0)
+        model(None, trainX, trainY.read(), testX, testY)
+        batches = trainY.minibatches(5, random_state=0)
+        batch = next(batches)
+        batches.close()
+        for exp, res in zip(model._loss(model.B, batch.rows),
+                            streamed._loss(model.B, batch)):
+            npt.assert_allclose(exp, res)
+        npt.assert_allclose(streamed._cv(model.B), model._cv(model.B))
+
+        loss, cv, its = streamed.fit(epochs=20, summary_interval=0,
+                                     silent=True)
+        self.assertEqual(len(loss), len(cv))
+        self.assertTrue(np.all(np.isfinite(streamed.B)))
+        self.assertLess(cv[-1], cv[0])
+
+    def test_check_stream_options(self):
+        check_stream_options('adam', 'random')
+        with self.assertRaises(ValueError):
+            check_stream_options('lbfgs', 'random')
+        with self.assertRaises(ValueError):
+            check_stream_options('adam', 'lstsq')
+
+    def test_not_hdf5(self):
+        path = os.path.join(self.tmpdir, 'table.tsv')
+        with open(path, 'w') as f:
+            f.write(str(self.table))
+        with self.assertRaises(ValueError):
+            load_stream(path, self.md, 'x')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import numpy as np
+import numpy.testing as npt
+from songbird.sweep import sweep, rank_configurations, config_names
+from songbird.util import random_multinomial_model
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        res = random_multinomial_model(
+            num_samples=50, num_features=5,
+            reps=1,
+            low=-1, high=1,
+            beta_mean=0,
+            beta_scale=1,
+            mu=1000,  # sequencing depth
+            sigma=0.5,
+            seed=0)
+
+        table, md, _ = res
+        Y = np.array(table.matrix_data.todense()).T
+        X = md.values
+        self.data = (X[:-5], X[-5:], Y[:-5], Y[-5:])
+        self.grid = {'differential_prior': [0.1, 1.],
+                     'learning_rate': [1e-3, 1e-1],
+                     'batch_size': [5]}
+        self.kwargs = dict(epochs=50, summary_interval=0,
+                           backend='numpy', random_seed=0)
+
+    def test_sweep(self):
+        configs, results = sweep(*self.data, self.grid, silent=True,
+                                 **self.kwargs)
+        self.assertEqual(len(configs), 4)
+        self.assertEqual(configs[0], {'differential_prior': 0.1,
+                                      'learning_rate': 1e-3,
+                                      'batch_size': 5})
+        for beta, loss, cv, its, stop_reason in results:
+            self.assertEqual(beta.shape, (2, 5))
+            npt.assert_allclose(beta.sum(axis=1), 0, atol=1e-10)
+            self.assertEqual(len(loss), len(cv))
+            self.assertEqual(stop_reason, 'max-epochs')
+
+    def test_sweep_processes(self):
+        configs, results = sweep(*self.data, self.grid, silent=True,
+                                 **self.kwargs)
+        _, pooled = sweep(*self.data, self.grid, processes=2, threads=1,
+                          silent=True, **self.kwargs)
+        for exp, res in zip(results, pooled):
+            npt.assert_allclose(exp[0], res[0])
+            npt.assert_allclose(exp[2], res[2])
+
+    def test_sweep_bad_grid(self):
+        with self.assertRaises(ValueError):
+            sweep(*self.data, dict(self.grid, clipnorm=[1.]), **self.kwargs)
+        with self.assertRaises(ValueError):
+            sweep(*self.data, dict(self.grid, batch_size=[]), **self.kwargs)
+
+    def test_rank_configurations(self):
+        configs, results = sweep(*self.data, self.grid, silent=True,
+                                 **self.kwargs)
+        summary = rank_configurations(configs, results)
+        self.assertEqual(sorted(summary.index), config_names(4))
+        self.assertEqual(list(summary['rank']), [1, 2, 3, 4])
+        self.assertTrue(
+            np.all(np.diff(summary['cross-validation'].values) >= 0))
+        best = int(summary.index[0][len('config'):])
+        npt.assert_allclose(summary['cross-validation'].iloc[0],
+                            np.mean(results[best][2][-10:]))
+
+    def test_config_names(self):
+        self.assertEqual(config_names(3), ['config0', 'config1', 'config2'])
+        self.assertEqual(config_names(11)[:2], ['config00', 'config01'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from songbird.numpy_backend import NumpyMultRegression
+from songbird.timing import PhaseTimer, peak_rss
+from songbird.util import random_multinomial_model
+
+
+class TestPhaseTimer(unittest.TestCase):
+
+    def setUp(self):
+        table, md, _ = random_multinomial_model(
+            num_samples=50, num_features=5, low=-1, high=1, beta_scale=1,
+            mu=1000, seed=0)
+        self.X = md.values
+        self.Y = table.matrix_data.T.toarray()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_phase(self):
+        timer = PhaseTimer()
+        with timer.phase('allocate'):
+            x = np.ones(10 ** 6)
+        with timer.phase('sum'):
+            x.sum()
+        self.assertEqual([p['phase'] for p in timer.phases],
+                         ['allocate', 'sum'])
+        for p in timer.phases:
+            self.assertGreaterEqual(p['wall_time'], 0)
+            self.assertGreaterEqual(p['cpu_time'], 0)
+            self.assertGreaterEqual(p['peak_rss'], x.nbytes)
+        self.assertGreaterEqual(peak_rss(), timer.phases[0]['peak_rss'])
+
+    def test_phase_error(self):
+        timer = PhaseTimer()
+        with self.assertRaises(ValueError):
+            with timer.phase('fail'):
+                raise ValueError()
+        self.assertEqual(timer.phases[0]['phase'], 'fail')
+
+    def _fit(self, timer, **kwargs):
+        model = NumpyMultRegression(batch_size=9, save_path=None,
+                                    random_state=0, **kwargs)
+        with timer.phase('build'):
+            model(None, self.X[:-5], self.Y[:-5], self.X[-5:], self.Y[-5:])
+        with timer.phase('train'):
+            _, _, its = model.fit(epochs=10, summary_interval=0,
+                                  silent=True)
+        timer.record_training(model)
+
+    def test_record_training(self):
+        timer = PhaseTimer()
+        self._fit(timer)
+        training = timer.training
+        self.assertEqual(training['steps'], (45 // 9) * 10)
+        self.assertEqual(training['samples'], 45 * 10)
+        self.assertGreater(training['steps_per_second'], 0)
+        self.assertAlmostEqual(training['samples_per_second'],
+                               9 * training['steps_per_second'])
+
+        timer = PhaseTimer()
+        self._fit(timer, solver='lbfgs')
+        self.assertEqual(timer.training['samples'],
+                         45 * timer.training['steps'])
+
+    def test_record_training_resumed(self):
+        path = os.path.join(self.tmpdir, 'model')
+        model = NumpyMultRegression(batch_size=9, save_path=path,
+                                    random_state=0)
+        model(None, self.X[:-5], self.Y[:-5], self.X[-5:], self.Y[-5:])
+        model.fit(epochs=10, summary_interval=0, silent=True)
+
+        # only the steps left after the checkpoint are counted
+        for epochs, steps in [(10, 0), (20, 50)]:
+            timer = PhaseTimer()
+            resumed = NumpyMultRegression(batch_size=9, save_path=None,
+                                          random_state=0)
+            resumed(None, self.X[:-5], self.Y[:-5],
+                    self.X[-5:], self.Y[-5:])
+            resumed.restore(os.path.join(path, 'model.npz'))
+            with timer.phase('train'):
+                resumed.fit(epochs=epochs, summary_interval=0, silent=True)
+            timer.record_training(resumed)
+            self.assertEqual(timer.training['steps'], steps)
+            self.assertEqual(timer.training['samples'], 9 * steps)
+
+    def test_save(self):
+        timer = PhaseTimer()
+        self._fit(timer)
+        path = os.path.join(self.tmpdir, 'timing.json')
+        timer.save(path)
+        with open(path) as f:
+            res = json.load(f)
+        self.assertEqual([p['phase'] for p in res['phases']],
+                         ['build', 'train'])
+        self.assertEqual(res['training']['steps'], 50)
+        self.assertGreaterEqual(res['total_wall_time'],
+                                timer.wall_time('train'))
+
+        columns = timer.columns()
+        self.assertIn('build-wall-time', columns)
+        self.assertIn('train-cpu-time', columns)
+        self.assertIn('train-peak-rss', columns)
+        self.assertIn('steps-per-second', columns)
+
+
+if __name__ == '__main__':
+    unittest.main()
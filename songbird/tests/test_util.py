@@ -1,11 +1,17 @@
 from io import StringIO
 import numpy as np
 import unittest
-from songbird.util import read_metadata, match_and_filter, split_training
+from songbird.util import (read_metadata, match_and_filter, split_training,
+                           convergence_table, is_intercept_only,
+                           lstsq_differentials, random_multinomial_model,
+                           alr_differentials, check_initial_differentials,
+                           collapse_duplicates,
+                           _stalled)
 from biom import Table
 import pandas as pd
 import pandas.util.testing as pdt
 import numpy.testing as npt
+from scipy.sparse import csr_matrix
 
 
 class TestUtil(unittest.TestCase):
@@ -198,6 +204,50 @@ class TestFilters(unittest.TestCase):
 
         pdt.assert_frame_equal(res_design, exp_design)
 
+    def test_match_and_filter_sparse_design(self):
+        formula = 'C(categorical) + continuous'
+        exp_table, exp_metadata, exp_design = match_and_filter(
+            self.table, self.metadata, formula,
+            min_sample_count=0, min_feature_count=0)
+        res = match_and_filter(self.table, self.metadata, formula,
+                               min_sample_count=0, min_feature_count=0,
+                               sparse_design=True)
+        res_table, res_metadata, res_design = res
+
+        pdt.assert_frame_equal(res_table.to_dataframe(),
+                               exp_table.to_dataframe())
+        pdt.assert_frame_equal(res_metadata, exp_metadata)
+        self.assertTrue(all(isinstance(dtype, pd.SparseDtype)
+                            for dtype in res_design.dtypes))
+        pdt.assert_frame_equal(res_design.sparse.to_dense(), exp_design)
+
+    def test_match_and_filter_sparse_design_missing(self):
+        metadata = self.metadata.copy()
+        metadata.loc['s2', 'continuous'] = np.nan
+        formula = 'C(categorical) + continuous'
+        res = match_and_filter(self.table, metadata, formula,
+                               min_sample_count=0, min_feature_count=0,
+                               sparse_design=True)
+        res_table, _, res_design = res
+        exp_ids = ['s1', 's3', 's4', 's5', 's6']
+        self.assertEqual(list(res_table.ids(axis='sample')), exp_ids)
+        self.assertEqual(list(res_design.index), exp_ids)
+
+    def test_match_and_filter_thresholds(self):
+        formula = 'C(categorical) + continuous'
+        res = match_and_filter(self.table, self.metadata_dup, formula,
+                               min_sample_count=5, min_feature_count=2)
+        res_table, res_metadata, res_design = res
+
+        self.assertEqual(list(res_table.ids(axis='sample')),
+                         ['s1', 's3', 's5', 's6'])
+        self.assertEqual(list(res_table.ids(axis='observation')),
+                         ['o1', 'o2', 'o3'])
+        self.assertEqual(list(res_metadata.index), ['s1', 's3', 's5', 's6'])
+        self.assertEqual(list(res_design.index), ['s1', 's3', 's5', 's6'])
+        npt.assert_allclose(res_table.matrix_data.toarray(),
+                            [[10, 4, 4, 0], [0, 2, 2, 8], [0, 2, 2, 4]])
+
     def test_match_and_filter_big_table(self):
         formula = 'C(categorical) + continuous'
         res = match_and_filter(self.big_table, self.metadata, formula,
@@ -267,6 +317,230 @@ class TestFilters(unittest.TestCase):
         npt.assert_allclose(exp_testX, res_testX)
         npt.assert_allclose(exp_testY, res_testY)
 
+    def test_split_training_sparse(self):
+        design = pd.DataFrame(
+            np.vstack(
+                (
+                    np.ones(6),
+                    np.array([0, 0, 1, 1, 0, 0]),
+                    np.arange(6)
+                )
+            ).T,
+            columns=['Intercept', 'C(categorical)[T.b]', 'continuous'],
+            index=['s1', 's2', 's3', 's4', 's5', 's6']
+        )
+        t = self.table.to_dataframe().T
+        res = split_training(csr_matrix(t.values),
+                             self.metadata, design,
+                             training_column='train',
+                             num_random_test_examples=2)
+
+        res_trainX, res_testX, res_trainY, res_testY = res
+
+        npt.assert_allclose(design.iloc[2:].values, res_trainX)
+        npt.assert_allclose(design.iloc[:2].values, res_testX)
+        npt.assert_allclose(t.iloc[2:].values, res_trainY.toarray())
+        npt.assert_allclose(t.iloc[:2].values, res_testY.toarray())
+
+    def test_split_training_sparse_design(self):
+        design = pd.DataFrame(
+            np.vstack(
+                (
+                    np.ones(6),
+                    np.array([0, 0, 1, 1, 0, 0]),
+                    np.arange(6)
+                )
+            ).T,
+            columns=['Intercept', 'C(categorical)[T.b]', 'continuous'],
+            index=['s1', 's2', 's3', 's4', 's5', 's6']
+        )
+        t = self.table.to_dataframe().T
+        res = split_training(t, self.metadata,
+                             design.astype(pd.SparseDtype(float, 0)),
+                             training_column='train',
+                             num_random_test_examples=2)
+
+        res_trainX, res_testX, res_trainY, res_testY = res
+
+        self.assertTrue(isinstance(res_trainX, csr_matrix))
+        self.assertTrue(isinstance(res_testX, csr_matrix))
+        npt.assert_allclose(design.iloc[2:].values, res_trainX.toarray())
+        npt.assert_allclose(design.iloc[:2].values, res_testX.toarray())
+        npt.assert_allclose(t.iloc[2:].values, res_trainY)
+        npt.assert_allclose(t.iloc[:2].values, res_testY)
+
+
+class TestConvergenceTable(unittest.TestCase):
+
+    def test_convergence_table(self):
+        res = convergence_table(np.array([3., 2., 1.]),
+                                np.array([.3, .2, .1]),
+                                np.array([0, 10, 20]),
+                                stop_reason='cv-converged')
+        self.assertEqual(list(res.index), ['0', '1', '2'])
+        self.assertEqual(res.index.name, 'id')
+        npt.assert_allclose(res['loss'], [3., 2., 1.])
+        npt.assert_allclose(res['cross-validation'], [.3, .2, .1])
+        npt.assert_array_equal(res['iteration'], [0, 10, 20])
+        self.assertTrue((res['stop-reason'] == 'cv-converged').all())
+
+    def test_convergence_table_elapsed(self):
+        res = convergence_table([2., 1.], [.2, .1], [0, 10],
+                                elapsed=[0.5, 1.5])
+        self.assertEqual(list(res.columns),
+                         ['loss', 'cross-validation', 'iteration',
+                          'elapsed-time'])
+        npt.assert_allclose(res['elapsed-time'], [0.5, 1.5])
+
+    def test_convergence_table_no_reason(self):
+        res = convergence_table([1.], [.1], [0])
+        self.assertEqual(list(res.columns),
+                         ['loss', 'cross-validation', 'iteration'])
+
+
+class TestIsInterceptOnly(unittest.TestCase):
+
+    def test_intercept(self):
+        self.assertTrue(is_intercept_only(np.ones((5, 1))))
+        self.assertTrue(is_intercept_only(
+            pd.DataFrame({'Intercept': [1., 1., 1.]})))
+        self.assertTrue(is_intercept_only(csr_matrix(np.ones((5, 1)))))
+
+    def test_covariates(self):
+        self.assertFalse(is_intercept_only(np.ones((5, 2))))
+        self.assertFalse(is_intercept_only(np.array([[1.], [0.], [1.]])))
+        self.assertFalse(is_intercept_only(
+            csr_matrix(np.array([[1.], [0.], [1.]]))))
+
+
+class TestLstsqDifferentials(unittest.TestCase):
+
+    def setUp(self):
+        table, md, self.beta = random_multinomial_model(
+            num_samples=50, num_features=5, reps=1, low=-1, high=1,
+            beta_mean=0, beta_scale=1, mu=1000, sigma=0.5, seed=0)
+        self.Y = np.array(table.matrix_data.todense()).T
+        self.X = md.values
+
+    def test_lstsq_differentials(self):
+        alr = np.log(self.Y[:, 1:] + 1) - np.log(self.Y[:, :1] + 1)
+        exp = np.linalg.lstsq(self.X, alr, rcond=None)[0]
+        res = lstsq_differentials(self.X, self.Y)
+        npt.assert_allclose(res, exp)
+        npt.assert_allclose(res, self.beta.T, atol=0.1, rtol=0.1)
+
+    def test_lstsq_differentials_sparse(self):
+        npt.assert_allclose(lstsq_differentials(self.X, csr_matrix(self.Y)),
+                            lstsq_differentials(self.X, self.Y))
+
+    def test_lstsq_differentials_sparse_design(self):
+        exp = lstsq_differentials(self.X, self.Y)
+        npt.assert_allclose(
+            lstsq_differentials(csr_matrix(self.X), self.Y), exp)
+        npt.assert_allclose(
+            lstsq_differentials(csr_matrix(self.X), csr_matrix(self.Y)), exp)
+
+
+class TestAlrDifferentials(unittest.TestCase):
+
+    def setUp(self):
+        self.B = np.array([[1., 2., 3.],
+                           [-1., 0., 1.]])
+        beta = np.hstack((np.zeros((2, 1)), self.B))
+        beta = beta - beta.mean(axis=1).reshape(-1, 1)
+        self.differentials = pd.DataFrame(
+            beta.T, index=['a', 'b', 'c', 'd'], columns=['Intercept', 'x'])
+
+    def test_alr_differentials(self):
+        res = alr_differentials(self.differentials, ['Intercept', 'x'],
+                                ['a', 'b', 'c', 'd'])
+        npt.assert_allclose(res, self.B)
+
+    def test_alr_differentials_reordered(self):
+        res = alr_differentials(self.differentials.iloc[::-1],
+                                ['x', 'Intercept'], ['b', 'a', 'c', 'd'])
+        # log ratios against 'b', with the covariates swapped
+        exp = np.array([[1., 1., 2.],
+                        [-1., 1., 2.]])
+        npt.assert_allclose(res, exp)
+
+    def test_alr_differentials_missing(self):
+        with self.assertRaises(ValueError):
+            alr_differentials(self.differentials, ['Intercept', 'y'],
+                              ['a', 'b', 'c', 'd'])
+        with self.assertRaises(ValueError):
+            alr_differentials(self.differentials, ['Intercept', 'x'],
+                              ['a', 'b', 'c', 'e'])
+
+    def test_check_initial_differentials(self):
+        npt.assert_allclose(check_initial_differentials(self.B, 2, 4),
+                            self.B)
+        with self.assertRaises(ValueError):
+            check_initial_differentials(self.B, 2, 3)
+
+
+class TestCollapseDuplicates(unittest.TestCase):
+
+    def setUp(self):
+        self.X = np.array([[1., 0.],
+                           [1., 1.],
+                           [1., 0.],
+                           [1., 1.],
+                           [1., 2.]])
+        self.Y = np.array([[1, 2, 3],
+                           [4, 5, 6],
+                           [7, 8, 9],
+                           [0, 1, 0],
+                           [2, 0, 2]])
+
+    def test_collapse_duplicates(self):
+        X, Y = collapse_duplicates(self.X, self.Y)
+        npt.assert_allclose(X, np.array([[1., 0.],
+                                         [1., 1.],
+                                         [1., 2.]]))
+        npt.assert_allclose(Y, np.array([[8, 10, 12],
+                                         [4, 6, 6],
+                                         [2, 0, 2]]))
+
+    def test_collapse_duplicates_sparse(self):
+        expX, expY = collapse_duplicates(self.X, self.Y)
+        X, Y = collapse_duplicates(self.X, csr_matrix(self.Y))
+        npt.assert_allclose(X, expX)
+        self.assertTrue(isinstance(Y, csr_matrix))
+        npt.assert_allclose(Y.toarray(), expY)
+
+    def test_collapse_duplicates_sparse_design(self):
+        X, Y = collapse_duplicates(csr_matrix(self.X), self.Y)
+        self.assertTrue(isinstance(X, csr_matrix))
+        # rows are kept in order of their first appearance
+        npt.assert_allclose(X.toarray(), np.array([[1., 0.],
+                                                   [1., 1.],
+                                                   [1., 2.]]))
+        npt.assert_allclose(Y, np.array([[8, 10, 12],
+                                         [4, 6, 6],
+                                         [2, 0, 2]]))
+
+    def test_collapse_duplicates_unique(self):
+        X, Y = collapse_duplicates(self.X[2:], self.Y[2:])
+        self.assertEqual(X.shape, (3, 2))
+        npt.assert_allclose(Y.sum(axis=0), self.Y[2:].sum(axis=0))
+
+
+class TestStalled(unittest.TestCase):
+
+    def test_improving(self):
+        self.assertFalse(_stalled([5., 4., 3., 2., 1.], 1e-3, 2))
+
+    def test_flat(self):
+        self.assertTrue(_stalled([5., 1., 1., 1., 1.], 1e-3, 2))
+
+    def test_too_short(self):
+        self.assertFalse(_stalled([1., 1.], 1e-3, 2))
+
+    def test_within_tolerance(self):
+        self.assertTrue(_stalled([100., 99.99, 99.98], 1e-3, 2))
+        self.assertFalse(_stalled([100., 99.99, 99.], 1e-3, 2))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,122 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+
+def peak_rss():
+    """ Peak resident set size of the process.
+
+    Returns
+    -------
+    int
+        Largest amount of memory held by the process so far in bytes, or
+        None where it can't be measured.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in kilobytes on linux, and in bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class PhaseTimer(object):
+
+    def __init__(self):
+        """ Records the time and memory taken by the phases of a run.
+
+        Each phase records its wall time and CPU time in seconds, and the
+        peak resident set size of the process once it ends, in bytes. The
+        CPU time adds up all of the threads of the process.
+        """
+        self.phases = []
+        self.training = None
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        """ Times the body of a `with` statement as the phase `name`. """
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.phases.append({
+                'phase': name,
+                'wall_time': time.perf_counter() - wall,
+                'cpu_time': time.process_time() - cpu,
+                'peak_rss': peak_rss(),
+            })
+
+    def wall_time(self, name):
+        """ Total wall time of the phases called `name`. """
+        return sum(p['wall_time'] for p in self.phases if p['phase'] == name)
+
+    def record_training(self, model, phase='train'):
+        """ Records the training throughput of a fitted model.
+
+        Parameters
+        ----------
+        model : MultRegression or NumpyMultRegression
+            Model that was fitted during `phase`.
+        phase : str
+            Name of the phase the model was fitted in.
+
+        Notes
+        -----
+        Only the steps taken by the last call to `model.fit` are counted,
+        so a run resumed from a checkpoint doesn't count the steps taken
+        before it. An L-BFGS iteration uses every training sample, and an
+        Adam step uses a minibatch. Intercept-only models are fitted
+        directly, so they take no steps.
+        """
+        steps = model.num_steps
+        if model.solver == 'lbfgs':
+            batch_size = model.N
+        else:
+            batch_size = min(model.batch_size, model.N)
+        seconds = self.wall_time(phase)
+        rate = steps / seconds if seconds > 0 else float('nan')
+        self.training = {
+            'steps': int(steps),
+            'samples': int(steps * batch_size),
+            'steps_per_second': rate,
+            'samples_per_second': rate * batch_size,
+        }
+
+    def to_dict(self):
+        """ Summarizes the run as a json serializable dictionary. """
+        return {
+            'total_wall_time': time.perf_counter() - self._start,
+            'peak_rss': peak_rss(),
+            'phases': self.phases,
+            'training': self.training,
+        }
+
+    def columns(self):
+        """ Summarizes the run as columns of the convergence statistics.
+
+        Returns
+        -------
+        dict
+            Wall time, CPU time and peak RSS of every phase, named as
+            '<phase>-wall-time' and so on, and the training throughput.
+        """
+        res = {}
+        for p in self.phases:
+            name = p['phase'].replace('_', '-')
+            for key in ['wall_time', 'cpu_time', 'peak_rss']:
+                res['%s-%s' % (name, key.replace('_', '-'))] = p[key]
+        if self.training is not None:
+            for key in ['steps_per_second', 'samples_per_second']:
+                res[key.replace('_', '-')] = self.training[key]
+        return res
+
+    def save(self, path):
+        """ Writes the summary of the run to a json file. """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
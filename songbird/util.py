@@ -1,11 +1,13 @@
 import os
-import tensorflow as tf
+import ast
 import numpy as np
 import pandas as pd
+from scipy.sparse import issparse, csr_matrix
 from sklearn.utils import check_random_state
+from skbio import OrdinationResults
 from skbio.stats.composition import clr_inv as softmax
 from biom import Table
-from patsy import dmatrix
+from patsy import dmatrix, ModelDesc, design_matrix_builders
 
 
 def random_multinomial_model(num_samples, num_features,
@@ -130,7 +132,8 @@ def read_metadata(filepath):
 
 
 def match_and_filter(table, metadata, formula,
-                     min_sample_count, min_feature_count):
+                     min_sample_count, min_feature_count,
+                     sparse_design=False):
     """ Matches and aligns biom and metadata tables.
 
     This will also return the patsy representation.
@@ -141,6 +144,15 @@ def match_and_filter(table, metadata, formula,
         Table of abundances
     metadata : pd.DataFrame
         Sample metadata
+    formula : str
+        Statistical formula specifying the design matrix.
+    min_sample_count : int
+        Samples with this many counts or fewer are removed.
+    min_feature_count : int
+        Features observed in this many samples or fewer are removed.
+    sparse_design : bool
+        Whether to build a sparse design matrix with `formulaic` instead
+        of a dense one with `patsy`.
 
     Returns
     -------
@@ -148,38 +160,181 @@ def match_and_filter(table, metadata, formula,
         Filtered biom table
     metadata : pd.DataFrame
         Sample metadata
+    design : pd.DataFrame
+        Design matrix, with rows in the same order as the table samples.
+        If `sparse_design` is set, all of its columns are sparse.
+
+    Notes
+    -----
+    The filters are computed on the sparse matrix of the table in a
+    vectorized fashion, so this scales to tables with many samples.
+
+    A sparse design keeps categorical covariates with many levels, such
+    as subject ids in longitudinal studies, from being densified into
+    one column per level.
     """
     # match them
+    metadata = metadata.loc[~metadata.index.duplicated(keep='first')]
 
-    def sample_filter(val, id_, md):
-        return id_ in metadata.index and np.sum(val) > min_sample_count
-
-    def read_filter(val, id_, md):
-        return np.sum(val > 0) > min_feature_count
+    sample_ids = table.ids(axis='sample')
+    sample_sums = np.asarray(table.matrix_data.sum(axis=0)).ravel()
+    keep = (metadata.index.get_indexer(sample_ids) >= 0) & (
+        sample_sums > min_sample_count)
+    table = table.filter(sample_ids[keep], axis='sample', inplace=False)
 
-    table = table.filter(sample_filter, axis='sample', inplace=False)
-    table = table.filter(read_filter, axis='observation', inplace=False)
+    prevalence = np.asarray((table.matrix_data > 0).sum(axis=1)).ravel()
+    feature_ids = table.ids(axis='observation')
+    table = table.filter(feature_ids[prevalence > min_feature_count],
+                         axis='observation', inplace=False)
 
     metadata = metadata.loc[table.ids(axis='sample')]
-    metadata = metadata.loc[~metadata.index.duplicated(keep='first')]
+    design = build_design(formula, metadata, sparse_design)
+
+    table = table.filter(design.index, axis='sample')
+    return table, metadata, design
 
-    def sort_f(xs):
-        return [xs[metadata.index.get_loc(x)] for x in xs]
 
-    table = table.sort(sort_f=sort_f, axis='sample')
+def build_design(formula, metadata, sparse_design=False):
+    """ Builds the design matrix of the samples.
+
+    Parameters
+    ----------
+    formula : str
+        Statistical formula specifying the design matrix.
+    metadata : pd.DataFrame
+        Sample metadata
+    sparse_design : bool
+        Whether to build a sparse design matrix with `formulaic` instead
+        of a dense one with `patsy`.
+
+    Returns
+    -------
+    pd.DataFrame
+        Design matrix, without the samples that have missing values.
+    """
+    if sparse_design:
+        return _sparse_dmatrix(formula, metadata)
     design = dmatrix(formula, metadata, return_type='dataframe')
-    design = design.dropna()
+    return design.dropna()
 
-    def design_filter(val, id_, md):
-        return id_ in design.index
 
-    table = table.filter(design_filter, axis='sample')
-    return table, metadata, design
+def _formula_variables(code, columns):
+    """ Metadata columns referenced by a term of a formula. """
+    names = set()
+    for node in ast.walk(ast.parse(code.strip(), mode='eval')):
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+        # columns with spaces and such are quoted as Q("name")
+        elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+              and node.func.id == 'Q' and node.args and
+              isinstance(node.args[0], ast.Constant)):
+            names.add(node.args[0].value)
+    return [c for c in columns if c in names]
 
 
-def split_training(dense_table, metadata, design, training_column=None,
-                   num_random_test_examples=10, seed=None):
+def design_levels(formula, metadata):
+    """ Levels of the categorical covariates of a formula.
+
+    Parameters
+    ----------
+    formula : str
+        Statistical formula specifying the design matrix.
+    metadata : pd.DataFrame
+        Sample metadata the model was trained on.
+
+    Returns
+    -------
+    dict of list
+        Levels of each metadata column that the formula treats as
+        categorical, in the order of their columns in the design matrix.
+
+    Notes
+    -----
+    Only the levels are computed, so this doesn't build the design matrix.
+    Terms that combine several columns into one categorical factor are
+    left out.
+    """
+    desc = ModelDesc.from_formula(formula)
+    design_info, = design_matrix_builders(
+        [desc.rhs_termlist], lambda: iter([metadata]), eval_env=0)
+    levels = {}
+    for factor, info in design_info.factor_infos.items():
+        if info.type != 'categorical':
+            continue
+        variables = _formula_variables(factor.code, metadata.columns)
+        if len(variables) == 1:
+            levels[variables[0]] = pd.Series(info.categories,
+                                             dtype=object).tolist()
+    return levels
+
+
+def _sparse_dmatrix(formula, metadata):
+    """ Builds a sparse design matrix with `formulaic`.
+
+    Parameters
+    ----------
+    formula : str
+        Statistical formula specifying the design matrix.
+    metadata : pd.DataFrame
+        Sample metadata
+
+    Returns
+    -------
+    pd.DataFrame
+        Design matrix with sparse columns, without the samples that have
+        missing values in any of the variables of the formula.
+    """
+    try:
+        from formulaic import Formula, model_matrix
+    except ImportError:
+        raise ImportError("Sparse design matrices require formulaic, "
+                          "which can be installed with "
+                          "`pip install formulaic`")
+    # the rows dropped by formulaic cannot be recovered from its sparse
+    # output, so samples with missing values are removed beforehand
+    variables = Formula(formula).required_variables
+    metadata = metadata.dropna(
+        subset=[c for c in metadata.columns if c in variables])
+    design = model_matrix(formula, metadata, output='sparse')
+    if design.shape[0] != metadata.shape[0]:
+        raise ValueError("The formula %r gives missing values for some "
+                         "samples" % formula)
+    return pd.DataFrame.sparse.from_spmatrix(
+        design, index=metadata.index,
+        columns=list(design.model_spec.column_names))
+
+
+def _design_matrix(design):
+    """ Values of a design DataFrame, as CSR if its columns are sparse. """
+    if len(design.columns) > 0 and all(
+            isinstance(dtype, pd.SparseDtype) for dtype in design.dtypes):
+        return design.sparse.to_coo().tocsr()
+    return design.values
+
+
+def training_mask(metadata, design, training_column=None,
+                  num_random_test_examples=10, seed=None):
+    """ Labels the samples of the design matrix used for training.
+
+    Parameters
+    ----------
+    metadata : pd.DataFrame
+        Sample metadata
+    design : pd.DataFrame
+        Design matrix
+    training_column : str
+        Column in `metadata` labeling samples as "Train" or "Test".
+        If None, samples are held out at random.
+    num_random_test_examples : int
+        Number of samples to hold out if `training_column` is None.
+    seed : int
+        Random seed for choosing the held out samples.
 
+    Returns
+    -------
+    np.array of bool
+        True for the training samples, in the order of the design matrix.
+    """
     if training_column is None:
         np.random.seed(seed)
         idx = np.random.random(design.shape[0])
@@ -189,16 +344,228 @@ def split_training(dense_table, metadata, design, training_column=None,
         train_idx = ~(idx < threshold)
     else:
         train_idx = metadata.loc[design.index, training_column] == "Train"
+    return np.asarray(train_idx, dtype=bool)
+
+
+def split_training(table, metadata, design, training_column=None,
+                   num_random_test_examples=10, seed=None):
+    """ Splits the samples into training and testing sets.
 
-    trainX = design.loc[train_idx].values
-    testX = design.loc[~train_idx].values
+    Parameters
+    ----------
+    table : pd.DataFrame or scipy.sparse.spmatrix
+        Table of counts, where rows are samples aligned with the rows
+        of `design` and columns are features.
+    metadata : pd.DataFrame
+        Sample metadata
+    design : pd.DataFrame
+        Design matrix. If all of its columns are sparse, the design
+        matrices are returned as sparse matrices.
+    training_column : str
+        Column in `metadata` labeling samples as "Train" or "Test".
+        If None, samples are held out at random.
+    num_random_test_examples : int
+        Number of samples to hold out if `training_column` is None.
+    seed : int
+        Random seed for choosing the held out samples.
 
-    trainY = dense_table.loc[train_idx].values
-    testY = dense_table.loc[~train_idx].values
+    Returns
+    -------
+    trainX, testX : np.array or scipy.sparse.csr_matrix
+        Training and testing design matrices.
+    trainY, testY : np.array or scipy.sparse.csr_matrix
+        Training and testing count tables. These are sparse if `table`
+        is sparse.
+    """
+    train_idx = training_mask(metadata, design, training_column,
+                              num_random_test_examples, seed)
+    X = _design_matrix(design)
+    trainX = X[train_idx]
+    testX = X[~train_idx]
+
+    if issparse(table):
+        table = table.tocsr()
+        trainY = table[train_idx]
+        testY = table[~train_idx]
+    else:
+        trainY = table.loc[train_idx].values
+        testY = table.loc[~train_idx].values
 
     return trainX, testX, trainY, testY
 
 
+def collapse_duplicates(X, Y):
+    """ Groups samples with identical covariates.
+
+    Samples that share a row of the design matrix share the same
+    multinomial probabilities, and the log likelihood of the group only
+    depends on their summed counts, up to a constant. Fitting the model
+    on the collapsed data therefore gives the same coefficients while
+    evaluating each unique row only once, which is much faster for
+    designs with only categorical covariates.
+
+    Parameters
+    ----------
+    X : np.array or scipy.sparse.spmatrix
+        Training design matrix.
+    Y : np.array or scipy.sparse.spmatrix
+        Training table of counts, where rows are samples and columns are
+        features.
+
+    Returns
+    -------
+    X : np.array or scipy.sparse.csr_matrix
+        The unique rows of the design matrix.
+    Y : np.array or scipy.sparse.csr_matrix
+        Summed counts of the samples with each of the unique rows.
+
+    Notes
+    -----
+    The reported loss of a model fitted on collapsed data differs from
+    the loss on the original samples by a constant, since the
+    multinomial coefficients of the groups differ from those of the
+    individual samples. The cross validation error is unaffected, as the
+    holdout samples are never collapsed.
+    """
+    if issparse(X):
+        unique, groups = _unique_sparse_rows(X)
+    else:
+        X = np.asarray(X)
+        unique, groups = np.unique(X, axis=0, return_inverse=True)
+        groups = groups.ravel()
+    n = len(groups)
+    # sums the rows of each group with a sparse indicator matrix
+    indicator = csr_matrix((np.ones(n), (groups, np.arange(n))),
+                           shape=(unique.shape[0], n))
+    if issparse(Y):
+        return unique, (indicator @ Y).tocsr()
+    return unique, indicator @ np.asarray(Y)
+
+
+def _unique_sparse_rows(X):
+    """ Unique rows of a sparse matrix, in order of first appearance. """
+    X = csr_matrix(X, copy=True)
+    X.eliminate_zeros()
+    X.sum_duplicates()
+    # each row is identified by the bytes of its nonzero entries
+    keys = [X.indices[a:b].tobytes() + X.data[a:b].tobytes()
+            for a, b in zip(X.indptr[:-1], X.indptr[1:])]
+    groups, _ = pd.factorize(pd.Series(keys))
+    _, first = np.unique(groups, return_index=True)
+    return X[first], groups
+
+
+def convergence_table(loss, cv, iter_n, stop_reason=None, elapsed=None):
+    """ Tabulates the loss and cross validation error over iterations.
+
+    Parameters
+    ----------
+    loss : np.array
+        Loss recorded at each summary.
+    cv : np.array
+        Cross validation error recorded at each summary.
+    iter_n : np.array
+        Iteration at which each summary was recorded.
+    stop_reason : str
+        Reason training stopped. If specified, this is stored in the
+        `stop-reason` column, and the last row records the iteration
+        training stopped at.
+    elapsed : np.array
+        Seconds elapsed since training started at each summary. If
+        specified, this is stored in the `elapsed-time` column.
+
+    Returns
+    -------
+    pd.DataFrame
+        Convergence statistics indexed by `id`.
+    """
+    convergence_stats = pd.DataFrame(
+        {
+            'loss': loss,
+            'cross-validation': cv,
+            'iteration': iter_n
+        }
+    )
+
+    convergence_stats.index.name = 'id'
+    convergence_stats.index = convergence_stats.index.astype(np.str)
+
+    c = convergence_stats['loss'].astype(np.float)
+    convergence_stats['loss'] = c
+
+    c = convergence_stats['cross-validation'].astype(np.float)
+    convergence_stats['cross-validation'] = c
+
+    c = convergence_stats['iteration'].astype(np.int)
+    convergence_stats['iteration'] = c
+
+    if elapsed is not None:
+        convergence_stats['elapsed-time'] = np.asarray(elapsed, dtype=float)
+    if stop_reason is not None:
+        convergence_stats['stop-reason'] = stop_reason
+    return convergence_stats
+
+
+def _stalled(values, tolerance, patience):
+    """ Checks whether a series of summaries stopped decreasing.
+
+    Parameters
+    ----------
+    values : list of float
+        Recorded values, oldest first.
+    tolerance : float
+        Minimum relative decrease that counts as an improvement.
+    patience : int
+        Number of most recent values that must fail to improve on the
+        best earlier value.
+
+    Returns
+    -------
+    bool
+        True if none of the last `patience` values improved on the best
+        earlier value by more than `tolerance`.
+    """
+    if len(values) <= patience:
+        return False
+    best = np.min(values[:-patience])
+    recent = np.min(values[-patience:])
+    return best - recent <= tolerance * abs(best)
+
+
+def should_stop(loss, cv, early_stopping, tolerance, patience):
+    """ Applies the early stopping rule to the recorded summaries.
+
+    Parameters
+    ----------
+    loss : list of float
+        Loss recorded at each summary.
+    cv : list of float
+        Cross validation error recorded at each summary.
+    early_stopping : str
+        Quantity monitored, either 'loss', 'cv' or 'both'. If None,
+        training is never stopped early.
+    tolerance : float
+        Minimum relative decrease that counts as an improvement.
+    patience : int
+        Number of consecutive summaries without improvement after which
+        training is stopped.
+
+    Returns
+    -------
+    bool
+        True if training should be stopped.
+    """
+    if early_stopping is None:
+        return False
+    loss_stalled = _stalled(loss, tolerance, patience)
+    cv_stalled = _stalled(cv, tolerance, patience)
+    if early_stopping == 'loss':
+        return loss_stalled
+    elif early_stopping == 'cv':
+        return cv_stalled
+    return loss_stalled and cv_stalled
+
+
 def silence_output():
     # suppress profiling messages & compilation warnings
     # taken from:
@@ -208,4 +575,197 @@ def silence_output():
 
     # suppress deprecation warnings
     # taken from https://github.com/tensorflow/tensorflow/issues/27023
+    import tensorflow as tf
     tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+
+def limit_threads(threads):
+    """ Limits the number of threads used by the linear algebra libraries.
+
+    Parameters
+    ----------
+    threads : int
+        Maximum number of threads. If None, nothing is changed.
+
+    Notes
+    -----
+    Libraries that are already loaded can only be limited if
+    `threadpoolctl` is installed. Otherwise, the limit only applies to
+    libraries loaded after this call.
+    """
+    if threads is None:
+        return
+    for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[var] = str(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=threads)
+
+
+def is_intercept_only(design):
+    """ Checks whether a design matrix only holds an intercept.
+
+    Parameters
+    ----------
+    design : np.array or pd.DataFrame or scipy.sparse.spmatrix
+        Design matrix, with one row per sample.
+
+    Returns
+    -------
+    bool
+        True if the design has a single column of ones.
+    """
+    if issparse(design):
+        return (design.shape[1] == 1 and design.nnz == design.shape[0] and
+                np.all(design.data == 1))
+    design = np.asarray(design)
+    return design.ndim == 2 and design.shape[1] == 1 and np.all(design == 1)
+
+
+def lstsq_differentials(X, Y):
+    """ Least squares estimate of the coefficients on log ratios.
+
+    The counts, with a pseudocount of one, are transformed with the
+    additive log ratio against the first feature and regressed on the
+    design matrix. This is a cheap approximation of the multinomial
+    regression coefficients that can be used to initialize them.
+
+    Parameters
+    ----------
+    X : np.array or scipy.sparse.spmatrix
+        Design matrix, with one row per sample.
+    Y : np.array or scipy.sparse.spmatrix
+        Table of counts, where rows are samples and columns are features.
+        Sparse tables are never densified.
+
+    Returns
+    -------
+    np.array
+        Coefficients of shape p x (D - 1), relative to the first feature.
+    """
+    if issparse(X):
+        X = X.tocsr().astype(np.float64)
+    else:
+        X = np.asarray(X, dtype=np.float64)
+    if issparse(Y):
+        # log(y + 1) keeps the zeros, so X^T log(Y + 1) stays cheap
+        logY = Y.tocsr().astype(np.float64)
+        logY.data = np.log1p(logY.data)
+        XtZ = _dense(logY.T @ X).T
+    else:
+        XtZ = _dense(X.T @ np.log1p(np.asarray(Y, dtype=np.float64)))
+    # log ratios against the first feature
+    XtZ = XtZ[:, 1:] - XtZ[:, :1]
+    return np.linalg.lstsq(_dense(X.T @ X), XtZ, rcond=None)[0]
+
+
+def _dense(A):
+    """ Converts the result of a possibly sparse product to an array. """
+    return A.toarray() if issparse(A) else np.asarray(A)
+
+
+def alr_differentials(differentials, md_ids, obs_ids):
+    """ Converts differentials to the coefficients of the model.
+
+    Parameters
+    ----------
+    differentials : pd.DataFrame
+        Differentials, as written by songbird, with one row per feature
+        and one column per covariate. These are centered log ratios, so
+        any constant shift of a column is ignored.
+    md_ids : array_like of str
+        Covariates of the model, i.e. the columns of its design matrix.
+    obs_ids : array_like of str
+        Features of the model, in the order of the columns of its table.
+
+    Returns
+    -------
+    np.array
+        Coefficients of shape p x (D - 1), i.e. the log ratios of the
+        differentials against the first feature in `obs_ids`.
+
+    Raises
+    ------
+    ValueError
+        If any of the covariates or features is missing from the
+        differentials.
+    """
+    missing = set(md_ids) - set(differentials.columns)
+    if missing:
+        raise ValueError("The differentials have no column for the "
+                         "covariates %s" % sorted(missing))
+    missing = set(obs_ids) - set(differentials.index)
+    if missing:
+        raise ValueError("The differentials have no row for %d of the "
+                         "features, e.g. %s" % (len(missing),
+                                                sorted(missing)[0]))
+    beta = differentials.loc[list(obs_ids), list(md_ids)].values.T
+    return beta[:, 1:] - beta[:, :1]
+
+
+def check_initial_differentials(B, p, D):
+    """ Checks the shape of coefficients used to initialize a model.
+
+    Parameters
+    ----------
+    B : np.array
+        Initial coefficients.
+    p : int
+        Number of covariates.
+    D : int
+        Number of features.
+
+    Returns
+    -------
+    np.array
+        The coefficients as floats.
+
+    Raises
+    ------
+    ValueError
+        If the coefficients are not of shape p x (D - 1).
+    """
+    B = np.asarray(B, dtype=np.float64)
+    if B.shape != (p, D - 1):
+        raise ValueError("Expected initial coefficients of shape %s, got %s"
+                         % ((p, D - 1), B.shape))
+    return B
+
+
+def regression_biplot(differentials):
+    """ Biplot of the differentials from their thin SVD.
+
+    Parameters
+    ----------
+    differentials : pd.DataFrame
+        Differentials, with one row per feature and one column per
+        covariate.
+
+    Returns
+    -------
+    skbio.OrdinationResults
+        Biplot with the features as samples and the covariates as
+        features, or an empty ordination if there is a single covariate.
+    """
+    if differentials.shape[-1] > 1:
+        # the thin SVD only allocates the first p columns of u
+        u, s, v = np.linalg.svd(differentials, full_matrices=False)
+        pc_ids = ['PC%d' % i for i in range(len(s))]
+        samples = pd.DataFrame(u[:, :len(s)] @ np.diag(s),
+                               columns=pc_ids, index=differentials.index)
+        features = pd.DataFrame(v.T[:, :len(s)],
+                                columns=pc_ids, index=differentials.columns)
+        short_method_name = 'regression_biplot'
+        long_method_name = 'Multinomial regression biplot'
+        eigvals = pd.Series(s, index=pc_ids)
+        proportion_explained = eigvals**2 / (eigvals**2).sum()
+        biplot = OrdinationResults(
+            short_method_name, long_method_name, eigvals,
+            samples=samples, features=features,
+            proportion_explained=proportion_explained)
+    else:
+        # this is to handle the edge case with only intercepts
+        biplot = OrdinationResults('', '', pd.Series(), pd.DataFrame())
+    return biplot